@@ -61,7 +61,7 @@ metrics = [False, False]
 formulas = []
 
 # Create the problem and expand the equations.
-problem = Problem(equations, substitutions, ndim, constants, coordinate_symbol, metrics, formulas)
+problem = Problem(equations, substitutions, ndim, constants, coordinate_symbol, metrics, formulas, cache=True)
 expanded_equations = problem.get_expanded(problem.equations)
 expanded_formulas = problem.get_expanded(problem.formulas)
 
@@ -73,7 +73,7 @@ temperature = "Eq(T, p*gama*Minf*Minf/(rho))"
 formulas = [velocity, pressure, temperature]
 
 # Create the TGV problem and expand the equations.
-problem = Problem(equations, substitutions, ndim, constants, coordinate_symbol, metrics, formulas)
+problem = Problem(equations, substitutions, ndim, constants, coordinate_symbol, metrics, formulas, cache=True)
 expanded_equations = problem.get_expanded(problem.equations)
 expanded_formulas = problem.get_expanded(problem.formulas)
 expanded_diagnostics = problem.get_expanded(problem.expand(diagnostics))
@@ -146,7 +146,7 @@ LOG.debug('The time taken to prepare the system in %d dimensions is %.2f seconds
 start = time.time()
 reduction_type = ["sum", "sum", "sum", "sum", "sum"] # List of reduction types. This should be the same length as expanded_diagnostics.
 red_eq = []
-red_eq.append([Reduction(grid, expanded_diagnostics, expanded_formulas, temporal_discretisation.prognostic_variables, spatial_scheme, reduction_type, 100)])
+red_eq.append([Reduction(grid, expanded_diagnostics, expanded_formulas, temporal_discretisation.prognostic_variables, spatial_scheme, reduction_type, 100, spatial_discretisation)])
 
 end = time.time()
 LOG.debug('The time taken to prepare the reductions in %d dimensions is %.2f seconds.' % (problem.ndim, end - start))
@@ -19,6 +19,7 @@
 #    along with OpenSBLI.  If not, see <http://www.gnu.org/licenses/>
 
 from sympy import *
+from itertools import combinations, product
 
 
 class ExchangeSelf(object):
@@ -33,9 +34,52 @@ class ExchangeSelf(object):
         self.transfer_from = [grid.halos[i][0] for i, s in enumerate(grid.shape)]
         self.transfer_to = [grid.halos[i][0] for i, s in enumerate(grid.shape)]
         self.transfer_arrays = []
+        # The direction of the grid in which the data is exchanged, if any.
+        self.direction = None
         return
 
 
+def exchange_edges_and_corners(exchanges, grid):
+    """ Combine the exchanges on the same block so that they can all be transferred in a single halo group.
+    The halo points of the exchanged directions are not read by any transfer; the face transfers only cover the interior points of the other exchanged
+    directions, and the edges and corners are filled from the diagonally opposite interior points by their own transfers. The result
+    therefore does not depend on the order in which the transfers of the group are performed.
+
+    :arg list exchanges: The ExchangeSelf objects to combine.
+    :arg grid: The numerical grid of solution points.
+    :returns: The face, edge and corner exchanges.
+    :rtype: list
+    """
+    directions = []
+    for exchange in exchanges:
+        if exchange.direction is not None and exchange.direction not in directions:
+            directions += [exchange.direction]
+    sides = dict([(d, [e for e in exchanges if e.direction == d]) for d in directions])
+
+    combined = [e for e in exchanges if e.direction is None]
+    for number in range(1, len(directions) + 1):
+        for subset in combinations(directions, number):
+            for transfers in product(*[sides[d] for d in subset]):
+                exchange = ExchangeSelf(grid)
+                for d in directions:
+                    if d not in subset:
+                        # Interior points only
+                        exchange.transfer_size[d] = grid.shape[d]
+                        exchange.transfer_from[d] = 0
+                        exchange.transfer_to[d] = 0
+                for d, transfer in zip(subset, transfers):
+                    exchange.transfer_size[d] = transfer.transfer_size[d]
+                    exchange.transfer_from[d] = transfer.transfer_from[d]
+                    exchange.transfer_to[d] = transfer.transfer_to[d]
+                # Only the arrays exchanged in all of the directions have edges and corners.
+                exchange.transfer_arrays = [a for a in transfers[0].transfer_arrays if all(a in t.transfer_arrays for t in transfers[1:])]
+                if number == 1:
+                    exchange.direction = subset[0]
+                if exchange.transfer_arrays:
+                    combined += [exchange]
+    return combined
+
+
 class BoundaryConditionBase(object):
 
     """ Base class for boundary conditions. We store the name of the boundary condition and type of the boundary for debugging purposes only.
@@ -92,6 +136,8 @@ class PeriodicBoundaryCondition(BoundaryConditionBase):
         else:
             transfers_left.transfer_arrays = arrays
             transfers_right.transfer_arrays = arrays
+            transfers_left.direction = direction
+            transfers_right.direction = direction
 
         return transfers_left, transfers_right
 
@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+
+#    OpenSBLI: An automatic code generator for solving differential equations.
+#    Copyright (C) 2016 Satya P. Jammy, Christian T. Jacobs, Neil D. Sandham
+
+#    This file is part of OpenSBLI.
+
+#    OpenSBLI is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    OpenSBLI is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with OpenSBLI.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import json
+import shutil
+import argparse
+import platform
+import tempfile
+
+import sympy
+from sympy import flatten, cos
+from sympy.core.cache import clear_cache
+
+from . import opsc
+from .problem import Problem
+from .equations import EinsteinTerm
+from .grid import Grid
+from .spatial import Central, SpatialDiscretisation
+from .timestepping import RungeKutta, TemporalDiscretisation
+from .bcs import PeriodicBoundaryCondition
+from .ics import GridBasedInitialisation
+from .io import FileIO
+from .diagnostics import Reduction
+from .profiling import profiler
+
+import logging
+LOG = logging.getLogger(__name__)
+
+# The version of the format of the benchmark results. Results in a different format are not compared.
+BENCHMARK_VERSION = 1
+
+# The default location of the baseline results.
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'benchmarks', 'baseline.json')
+
+# The dimensions and the orders of the Central schemes that are benchmarked by default.
+DIMENSIONS = [1, 2, 3]
+ORDERS = [2, 4, 6, 8, 10, 12]
+
+
+def wave(ndim):
+    """ The wave equation, as in apps/wave. """
+    return {'equations': ["Eq(Der(phi,t), -c_j*Der(phi,x_j))"], 'constants': ["c_j"],
+            'initial_conditions': ["Eq(grid.work_array(phi), sin(2*M_PI*(grid.Idx[0])*grid.deltas[0]))"],
+            'parameters': dict([('c%d' % d, 0.5) for d in range(ndim)])}
+
+
+def viscous_burgers(ndim):
+    """ The viscous Burgers equation, as in apps/viscous_burgers. """
+    return {'equations': ["Eq( Der(phi,t), -c_j*Conservative(phi*phi,x_j) + d*Der(Der(phi,x_j),x_j) )"], 'constants': ["c_j", "d"],
+            'initial_conditions': ["Eq(grid.work_array(phi), exp(-((grid.Idx[0]*grid.deltas[0]-3)**2)))"],
+            'parameters': dict([('c%d' % d, 0.5) for d in range(ndim)] + [('d', 0.02)])}
+
+
+def gaussian_bump(ndim):
+    """ The advection-diffusion of a Gaussian bump, as in apps/gaussian_bump. """
+    return {'equations': ["Eq( Der(phi,t), -Der(phi*u_j,x_j) + k*Der(Der(phi,x_j),x_j) )"], 'constants': ["k", "u_j"],
+            'initial_conditions': ["Eq(grid.work_array(phi), exp(-(grid.Idx[0]*grid.deltas[0]-5)**2))"],
+            'parameters': dict([('u%d' % d, 0.1) for d in range(ndim)] + [('k', 0.1)])}
+
+
+def mms(ndim):
+    """ The advection-diffusion equation with a manufactured source term, as in apps/mms. """
+    return {'equations': ["Eq( Der(phi,t), -Der(phi*u_j,x_j) + k*Der(Der(phi,x_j),x_j) - s )"], 'constants': ["k", "u_j", "s"],
+            'initial_conditions': ["Eq(grid.work_array(phi), 0)"], 'source': True,
+            'parameters': dict([('u%d' % d, 1.0) for d in range(ndim)] + [('k', 0.75)])}
+
+
+def taylor_green_vortex(ndim):
+    """ The compressible Navier-Stokes equations with the reductions of the Taylor-Green vortex, as in apps/taylor_green_vortex. """
+    diagnostics = ["Eq(ke, rho*(1/2)*u_j*u_j)", "Eq(rhomean, rho)"]
+    if ndim == 3:
+        diagnostics += ["Eq(enstrophy, (1/2)*rho*(LC(_i,_j,_k)*Der(u_k,x_j))**2)"]
+    return {'equations': ["Eq(Der(rho,t), - Skew(rho*u_j,x_j))",
+                          "Eq(Der(rhou_i,t) , -Skew(rhou_i*u_j,x_j) - Der(p,x_i) + Der(tau_i_j,x_j) )",
+                          "Eq(Der(rhoE,t), - Skew(rhoE*u_j,x_j) - Conservative(p*u_j,x_j) + Der(q_j,x_j) + Der(u_i*tau_i_j ,x_j) )"],
+            'substitutions': ["Eq(tau_i_j, (1.0/Re)*(Der(u_i,x_j)+ Der(u_j,x_i)- (2/3)* KD(_i,_j)* Der(u_k,x_k)))",
+                              "Eq(q_j, (1.0/((gama-1)*Minf*Minf*Pr*Re))*Der(T,x_j))"],
+            'constants': ["Re", "Pr", "gama", "Minf", "c_j"],
+            'formulas': ["Eq(u_i, rhou_i/rho)", "Eq(p, (gama-1)*(rhoE - rho*(1/2)*(u_j*u_j)))", "Eq(T, p*gama*Minf*Minf/(rho))"],
+            'diagnostics': diagnostics,
+            'initial_conditions': ["Eq(grid.work_array(rho), 1.0)", "Eq(grid.work_array(rhoE), 1.0/(gama*(gama-1)*Minf*Minf))"]
+            + ["Eq(grid.work_array(rhou%d), 0.0)" % d for d in range(ndim)],
+            'parameters': {'Re': 1600, 'Pr': 0.71, 'gama': 1.4, 'Minf': 0.1}}
+
+
+# The benchmarked problems, in the order they are run.
+PROBLEMS = [('wave', wave), ('viscous_burgers', viscous_burgers), ('gaussian_bump', gaussian_bump), ('mms', mms), ('taylor_green_vortex', taylor_green_vortex)]
+
+
+def generate(name, ndim, order):
+    """ Generate the OPSC code of a benchmark problem, from the expansion of the equations to the writing of the code.
+    The code is written to the build directory of the OPSC module.
+
+    :arg str name: The name of the problem.
+    :arg int ndim: The dimension of the problem.
+    :arg int order: The order of the Central scheme.
+    :returns: None
+    """
+
+    specification = dict(PROBLEMS)[name](ndim)
+    problem = Problem(specification['equations'], specification.get('substitutions', []), ndim, specification['constants'], "x",
+                      [False]*ndim, specification.get('formulas', []))
+    expanded_equations = problem.get_expanded(problem.equations)
+    expanded_formulas = problem.get_expanded(problem.formulas)
+
+    grid = Grid(ndim, {'delta': [2.0/16]*ndim, 'number_of_points': [16]*ndim})
+
+    if specification.get('source'):
+        # The manufactured source term, which depends on the grid coordinates.
+        source = sum([cos(grid.Idx[d]*grid.deltas[d]) for d in range(ndim)])
+        expanded_equations[0][0] = expanded_equations[0][0].subs(EinsteinTerm('s'), source)
+
+    spatial_scheme = Central(order)
+    spatial_discretisation = SpatialDiscretisation(expanded_equations, expanded_formulas, grid, spatial_scheme)
+    temporal_discretisation = TemporalDiscretisation(RungeKutta(3), grid, True, spatial_discretisation)
+
+    boundary_condition = PeriodicBoundaryCondition(grid)
+    for dim in range(ndim):
+        boundary_condition.apply(arrays=temporal_discretisation.prognostic_variables, boundary_direction=dim)
+
+    initial_conditions = GridBasedInitialisation(grid, specification['initial_conditions'])
+    io = FileIO(temporal_discretisation.prognostic_variables)
+
+    diagnostics = None
+    if specification.get('diagnostics'):
+        expanded_diagnostics = problem.get_expanded(problem.expand(specification['diagnostics']))
+        reduction = Reduction(grid, expanded_diagnostics, expanded_formulas, temporal_discretisation.prognostic_variables, spatial_scheme,
+                              ["sum"]*len(flatten(expanded_diagnostics)), 100)
+        diagnostics = [[reduction]]
+
+    simulation_parameters = {'niter': 100, 'deltat': 1.0e-3, 'precision': "double", 'name': name}
+    simulation_parameters.update(specification['parameters'])
+    opsc.OPSC(grid, spatial_discretisation, temporal_discretisation, boundary_condition, initial_conditions, io, simulation_parameters, diagnostics)
+    return
+
+
+def run_case(name, ndim, order, repeat=1):
+    """ Time the code generation of a benchmark problem. Each repetition starts with an empty SymPy cache, and the best time is kept.
+
+    :arg str name: The name of the problem.
+    :arg int ndim: The dimension of the problem.
+    :arg int order: The order of the Central scheme.
+    :arg int repeat: The number of times the code generation is timed.
+    :returns: The best time (in seconds), and the time taken by each top-level phase of the code generation in the best repetition.
+    :rtype: dict
+    """
+
+    directory = tempfile.mkdtemp(prefix='opensbli-benchmark-')
+    build_directory, have_ops, enabled = opsc.BUILD_DIR, opsc.have_ops, profiler.enabled
+    # Write the code to a temporary directory, and never call the OPS translator.
+    opsc.BUILD_DIR, opsc.have_ops = directory, False
+    profiler.enable()
+    best = None
+    try:
+        for repetition in range(repeat):
+            clear_cache()
+            profiler.reset()
+            start = time.time()
+            generate(name, ndim, order)
+            elapsed = time.time() - start
+            if best is None or elapsed < best['time']:
+                phases = {}
+                for record in profiler.report():
+                    if record['depth'] == 0:
+                        phases[record['name']] = phases.get(record['name'], 0.0) + record['time']
+                best = {'time': elapsed, 'phases': phases}
+    finally:
+        opsc.BUILD_DIR, opsc.have_ops = build_directory, have_ops
+        profiler.reset()
+        if not enabled:
+            profiler.disable()
+        shutil.rmtree(directory, ignore_errors=True)
+    return best
+
+
+def case_key(name, ndim, order):
+    """ Return the key identifying a benchmark case in the results. """
+    return '%s/%dd/order%d' % (name, ndim, order)
+
+
+def run(problems=None, dimensions=DIMENSIONS, orders=ORDERS, repeat=1):
+    """ Run the benchmark suite.
+
+    :arg list problems: The names of the problems to benchmark. If None, all the problems are benchmarked.
+    :arg list dimensions: The dimensions to benchmark.
+    :arg list orders: The orders of the Central schemes to benchmark.
+    :arg int repeat: The number of times each case is timed.
+    :returns: The versioned benchmark results.
+    :rtype: dict
+    """
+
+    if problems is None:
+        problems = [name for name, specification in PROBLEMS]
+    results = {}
+    for name in problems:
+        for ndim in dimensions:
+            for order in orders:
+                key = case_key(name, ndim, order)
+                results[key] = run_case(name, ndim, order, repeat)
+                LOG.info("Benchmark %s: %.2f seconds." % (key, results[key]['time']))
+    return {'version': BENCHMARK_VERSION, 'sympy': sympy.__version__, 'python': platform.python_version(),
+            'machine': platform.node(), 'results': results}
+
+
+def compare(results, baseline, threshold=0.2, minimum=0.1):
+    """ Compare the benchmark results with a baseline.
+
+    :arg dict results: The benchmark results.
+    :arg dict baseline: The baseline benchmark results.
+    :arg float threshold: The relative increase in time above which a case is a regression (e.g. 0.2 is 20% slower than the baseline).
+    :arg float minimum: The absolute increase in time (in seconds) below which a case is never a regression, since such small differences are mostly noise.
+    :returns: The (key, baseline time, time) of each regression.
+    :rtype: list
+    """
+
+    if baseline.get('version') != results.get('version'):
+        raise ValueError("The baseline has version %s, but the results have version %s." % (baseline.get('version'), results.get('version')))
+    if baseline.get('sympy') != results.get('sympy'):
+        LOG.warning("The baseline was recorded with SymPy %s, but the results use SymPy %s." % (baseline.get('sympy'), results.get('sympy')))
+
+    regressions = []
+    for key in sorted(results['results'].keys()):
+        if key not in baseline['results']:
+            continue
+        before = baseline['results'][key]['time']
+        after = results['results'][key]['time']
+        if after > before*(1.0 + threshold) and after - before > minimum:
+            regressions.append((key, before, after))
+    return regressions
+
+
+def table(results, baseline=None):
+    """ Return the benchmark results (and their change relative to a baseline) as a human-readable table.
+
+    :rtype: str
+    """
+
+    width = max([len(key) for key in results['results'].keys()] + [len('Case')])
+    lines = ['%s  %10s  %10s' % ('Case'.ljust(width), 'Time (s)', 'Change')]
+    for key in sorted(results['results'].keys()):
+        change = ''
+        if baseline and key in baseline['results'] and baseline['results'][key]['time'] > 0:
+            change = '%+.1f%%' % (100.0*(results['results'][key]['time']/baseline['results'][key]['time'] - 1.0))
+        lines.append('%s  %10.2f  %10s' % (key.ljust(width), results['results'][key]['time'], change))
+    return '\n'.join(lines)
+
+
+def main(arguments=None):
+    """ Run the benchmark suite from the command line, e.g.
+
+        python -m opensbli.benchmark --problems wave mms --ndim 1 2 --orders 2 4
+
+    :returns: The exit code, which is non-zero if there are any regressions.
+    :rtype: int
+    """
+
+    parser = argparse.ArgumentParser(description="Benchmark the code generation of OpenSBLI.")
+    parser.add_argument('--problems', nargs='+', choices=[name for name, specification in PROBLEMS], default=None, help="The problems to benchmark.")
+    parser.add_argument('--ndim', nargs='+', type=int, default=DIMENSIONS, help="The dimensions to benchmark.")
+    parser.add_argument('--orders', nargs='+', type=int, default=ORDERS, help="The orders of the Central schemes to benchmark.")
+    parser.add_argument('--repeat', type=int, default=1, help="The number of times each case is timed; the best time is kept.")
+    parser.add_argument('--baseline', default=BASELINE, help="The JSON file of the baseline results.")
+    parser.add_argument('--update-baseline', action='store_true', help="Store the results as the new baseline.")
+    parser.add_argument('--output', default=None, help="A JSON file to write the results to.")
+    parser.add_argument('--threshold', type=float, default=0.2, help="The relative slowdown beyond which a case is a regression.")
+    options = parser.parse_args(arguments)
+
+    results = run(options.problems, options.ndim, options.orders, options.repeat)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+    baseline = None
+    if os.path.exists(options.baseline):
+        with open(options.baseline, 'r') as f:
+            baseline = json.load(f)
+    print table(results, baseline)
+
+    regressions = []
+    if baseline and not options.update_baseline:
+        regressions = compare(results, baseline, options.threshold)
+        for key, before, after in regressions:
+            print "Regression in %s: %.2f seconds, compared to %.2f seconds in the baseline." % (key, after, before)
+
+    if options.update_baseline:
+        if baseline and baseline.get('version') == results['version']:
+            # Keep the baseline of any cases that were not run.
+            baseline['results'].update(results['results'])
+            results['results'] = baseline['results']
+        directory = os.path.dirname(os.path.abspath(options.baseline))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(options.baseline, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
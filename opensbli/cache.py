@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+
+#    OpenSBLI: An automatic code generator for solving differential equations.
+#    Copyright (C) 2016 Satya P. Jammy, Christian T. Jacobs, Neil D. Sandham
+
+#    This file is part of OpenSBLI.
+
+#    OpenSBLI is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    OpenSBLI is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with OpenSBLI.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import hashlib
+import pickle
+import tempfile
+
+import sympy
+from sympy import Basic
+
+from .equations import Equation
+
+import logging
+LOG = logging.getLogger(__name__)
+
+# The default location of the cache. This can be overridden with the OPENSBLI_CACHE_DIR environment variable.
+CACHE_DIR = os.environ.get('OPENSBLI_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.opensbli', 'cache'))
+
+
+def expansion_version():
+    """ Return a string identifying the code that performs (and stores) the expansion. Any change to the SymPy version,
+    the expansion routines in equations.py or the format of the cache changes this string, and hence invalidates all of the cached entries.
+
+    :returns: The version string.
+    :rtype: str
+    """
+
+    digest = hashlib.sha1()
+    for name in ['equations.py', 'cache.py']:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), name), 'rb') as f:
+            digest.update(f.read())
+    return '%s-%s' % (sympy.__version__, digest.hexdigest())
+
+
+class ExpressionNode(object):
+
+    """ A picklable record of a SymPy expression: its type, its (recorded) arguments and its state (i.e. the assumptions and any other attributes of the object). """
+
+    def __init__(self, func, args, state):
+        self.func = func
+        self.args = args
+        self.state = state
+        return
+
+
+def get_state(expression):
+    """ Return the attributes of a SymPy object, other than its arguments and its hash.
+
+    :arg expression: The SymPy object.
+    :returns: A dictionary of (attribute name, value) pairs.
+    :rtype: dict
+    """
+
+    state = {}
+    for cls in type(expression).__mro__:
+        for name in getattr(cls, '__slots__', []):
+            if name not in ['_args', '_mhash'] and hasattr(expression, name):
+                state[name] = getattr(expression, name)
+    state.update(getattr(expression, '__dict__', {}))
+    return state
+
+
+def record(expression):
+    """ Record an expression (or list of expressions) so that it can be pickled. Pickling a SymPy object directly re-evaluates
+    each expression when it is unpickled, which can reorder the terms of a product (e.g. when the commutativity of an EinsteinTerm
+    has changed since the product was created). Recording the structure and the state of the expression avoids this.
+
+    :arg expression: The expression, or list of expressions, to record.
+    :returns: The recorded expression(s).
+    """
+
+    if isinstance(expression, list):
+        return [record(e) for e in expression]
+    if isinstance(expression, Basic) and expression.args and not expression.is_Atom:
+        return ExpressionNode(type(expression), [record(arg) for arg in expression.args], get_state(expression))
+    return expression
+
+
+def rebuild(recorded):
+    """ Rebuild the expression(s) recorded by the record function exactly as they were recorded, without evaluating them.
+
+    :arg recorded: The recorded expression, or list of recorded expressions.
+    :returns: The expression(s).
+    """
+
+    if isinstance(recorded, list):
+        return [rebuild(r) for r in recorded]
+    if not isinstance(recorded, ExpressionNode):
+        return recorded
+    expression = Basic.__new__(recorded.func, *[rebuild(arg) for arg in recorded.args])
+    for name, value in recorded.state.items():
+        setattr(expression, name, value)
+    return expression
+
+
+class ExpandedEquation(object):
+
+    """ An equation whose Einstein expansion was performed elsewhere, i.e. retrieved from the ExpansionCache or
+    performed in a worker process. This provides the same 'original' and 'expanded' attributes as an Equation object. """
+
+    def __init__(self, expression, expanded):
+        """ Store the expanded equation.
+
+        :arg str expression: The equation, written in Einstein notation, and specified in string form.
+        :arg list expanded: The expanded equations.
+        :returns: None
+        """
+
+        self.original = expression
+        self.expanded = expanded
+        return
+
+
+class ExpansionCache(object):
+
+    """ A content-addressed on-disk cache of the Einstein expansion of equations. Each entry is keyed on the equation string,
+    the substitutions, the constants, the coordinate symbol and the dimension of the problem. The total size of the cache is bounded;
+    the least recently used entries are evicted first. """
+
+    def __init__(self, directory=None, max_size=64*1024*1024):
+        """ Set up the cache.
+
+        :arg str directory: The directory in which the cached expansions are stored. If None, CACHE_DIR is used.
+        :arg int max_size: The maximum size of the cache in bytes.
+        :returns: None
+        """
+
+        if directory is None:
+            directory = CACHE_DIR
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.max_size = max_size
+        self.version = expansion_version()
+
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+        self.time_saved = 0.0
+        return
+
+    def key(self, expression, ndim, coordinate_symbol, substitutions, constants):
+        """ Return the key of the cache entry of an equation.
+
+        :returns: The SHA-1 digest of the equation and the parameters of its expansion.
+        :rtype: str
+        """
+
+        content = repr((self.version, expression, list(substitutions), list(constants), coordinate_symbol, ndim))
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        """ Return the path of the file holding the cache entry with the given key. """
+        return os.path.join(self.directory, '%s.pkl' % key)
+
+    def expand(self, expression, ndim, coordinate_symbol, substitutions=[], constants=[]):
+        """ Return the expanded equation, using the cached expansion if one exists. The arguments are the same as those of Equation.
+
+        :returns: The expanded equation.
+        :rtype: Equation or ExpandedEquation
+        """
+
+        equation = self.lookup(expression, ndim, coordinate_symbol, substitutions, constants)
+        if equation is None:
+            start = time.time()
+            equation = Equation(expression, ndim, coordinate_symbol, substitutions, constants)
+            self.insert(expression, ndim, coordinate_symbol, substitutions, constants, equation.expanded, time.time() - start)
+        return equation
+
+    def lookup(self, expression, ndim, coordinate_symbol, substitutions=[], constants=[]):
+        """ Look up the cached expansion of an equation. The arguments are the same as those of Equation.
+
+        :returns: The expanded equation, or None if the expansion is not in the cache.
+        :rtype: ExpandedEquation
+        """
+
+        start = time.time()
+        entry = self.load(self.key(expression, ndim, coordinate_symbol, substitutions, constants))
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.time_saved += max(entry['time'] - (time.time() - start), 0.0)
+        return ExpandedEquation(expression, rebuild(entry['expanded']))
+
+    def insert(self, expression, ndim, coordinate_symbol, substitutions, constants, expanded, elapsed):
+        """ Insert the expansion of an equation into the cache.
+
+        :arg list expanded: The expanded equations.
+        :arg float elapsed: The time taken to perform the expansion, in seconds.
+        :returns: None
+        """
+
+        self.store(self.key(expression, ndim, coordinate_symbol, substitutions, constants), {'expanded': record(expanded), 'time': elapsed})
+        return
+
+    def load(self, key):
+        """ Load a cache entry.
+
+        :arg str key: The key of the entry.
+        :returns: The cache entry, or None if there is no (readable) entry for the key.
+        :rtype: dict
+        """
+
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                entry = pickle.load(f)
+        except Exception:
+            LOG.warning("Removing the unreadable expansion cache entry %s" % path)
+            self.remove(path)
+            return None
+        # Mark the entry as recently used.
+        os.utime(path, None)
+        return entry
+
+    def store(self, key, entry):
+        """ Store a cache entry, and evict old entries if the cache has grown too large.
+
+        :arg str key: The key of the entry.
+        :arg dict entry: The entry to store.
+        :returns: None
+        """
+
+        # Write to a temporary file first so that a concurrent reader never sees a partially written entry.
+        descriptor, temporary = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(descriptor, 'wb') as f:
+            pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(temporary, self.path(key))
+        self.evict()
+        return
+
+    def evict(self):
+        """ Remove the least recently used entries until the size of the cache is within max_size. """
+
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.pkl'):
+                path = os.path.join(self.directory, name)
+                try:
+                    entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+                except OSError:
+                    continue
+        entries.sort()
+        size = sum(entry[1] for entry in entries)
+        for mtime, entry_size, path in entries:
+            if size <= self.max_size:
+                break
+            self.remove(path)
+            size -= entry_size
+        return
+
+    def remove(self, path):
+        """ Remove a cache entry, ignoring entries that have already been removed (e.g. by another process). """
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return
+
+    def clear(self):
+        """ Remove all the entries in the cache. """
+        for name in os.listdir(self.directory):
+            if name.endswith('.pkl'):
+                self.remove(os.path.join(self.directory, name))
+        return
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+#    OpenSBLI: An automatic code generator for solving differential equations.
+#    Copyright (C) 2016 Satya P. Jammy, Christian T. Jacobs, Neil D. Sandham
+
+#    This file is part of OpenSBLI.
+
+#    OpenSBLI is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    OpenSBLI is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with OpenSBLI.  If not, see <http://www.gnu.org/licenses/>.
+
+from sympy import Eq, Derivative, Indexed, IndexedBase, Idx, flatten
+
+from .equations import EinsteinTerm
+from .grid import GridVariable
+
+
+class CatalogEntry(object):
+
+    """ The terms found in a single equation. Each list holds the terms in the order they are first found. """
+
+    def __init__(self, equation):
+        """ Catalog the terms of an equation with a single walk of its expression tree.
+
+        :arg equation: The equation (or, for an expression which is not an equation, the right-hand side).
+        :returns: None
+        """
+
+        from .diagnostics import ReductionVariable
+
+        self.equation = equation
+        self.lhs_bases = []  # The IndexedBase objects on the left-hand side.
+        self.rhs_bases = []  # The IndexedBase objects on the right-hand side.
+        self.indexed = []  # The Indexed objects.
+        self.count = {}  # The number of occurrences of each Indexed object.
+        self.derivatives = []  # The outermost Derivative objects (i.e. those that are not nested in another Derivative).
+        self.maximum_order = 0  # The maximum order of all the Derivative objects.
+        self.einstein_terms = []  # The EinsteinTerm objects.
+        self.reductions = []  # The ReductionVariable objects on the right-hand side.
+        self.gridvariables = []  # The GridVariable objects on the left-hand side.
+        self.has_Idx = False  # True if an Idx object is present on the right-hand side.
+
+        found = set()
+        if isinstance(equation, Eq):
+            sides = [(equation.lhs, True), (equation.rhs, False)]
+        else:
+            sides = [(equation, False)]
+
+        for expression, lhs in sides:
+            # Walk the expression in pre-order, keeping track of whether each term is nested in a Derivative.
+            stack = [(expression, False)]
+            while stack:
+                term, nested = stack.pop()
+                if isinstance(term, Indexed):
+                    if term not in self.count:
+                        self.indexed.append(term)
+                        self.count[term] = 0
+                    self.count[term] += 1
+                elif isinstance(term, IndexedBase):
+                    bases = self.lhs_bases if lhs else self.rhs_bases
+                    if (term, lhs) not in found:
+                        found.add((term, lhs))
+                        bases.append(term)
+                elif isinstance(term, Derivative):
+                    self.maximum_order = max(self.maximum_order, len(term.args) - 1)
+                    if not nested and term not in found:
+                        found.add(term)
+                        self.derivatives.append(term)
+                    nested = True
+                elif isinstance(term, EinsteinTerm):
+                    if term not in found:
+                        found.add(term)
+                        self.einstein_terms.append(term)
+                elif isinstance(term, ReductionVariable):
+                    if not lhs and term not in found:
+                        found.add(term)
+                        self.reductions.append(term)
+                elif isinstance(term, GridVariable):
+                    if lhs and term not in found:
+                        found.add(term)
+                        self.gridvariables.append(term)
+                elif isinstance(term, Idx):
+                    self.has_Idx = self.has_Idx or not lhs
+                stack.extend([(arg, nested) for arg in reversed(term.args)])
+        return
+
+
+class ExpressionCatalog(object):
+
+    """ A catalog of the terms (the Indexed objects and their indices, the Derivatives, the constants,
+    the ReductionVariables and the GridVariables) in a list of equations. Each equation is walked once,
+    and the terms are then looked up in the catalog rather than by searching the equations again. """
+
+    def __init__(self, equations=None):
+        """ Create the catalog.
+
+        :arg list equations: The equations to catalog. More equations can be added later.
+        :returns: None
+        """
+
+        self.entries = []
+        self.indexed = []  # The Indexed objects across all the equations, in the order they are first found.
+        self.count = {}  # The number of occurrences of each Indexed object.
+        self.indices = {}  # The index tuples that each IndexedBase object is used with.
+        self.derivatives = []  # The outermost Derivative objects across all the equations, in the order they are first found.
+        self.maximum_order = 0  # The maximum order of all the Derivative objects.
+        self.constants = []  # The EinsteinTerm objects that are constant.
+        self.found = set()
+
+        if equations:
+            self.add(equations)
+        return
+
+    def add(self, equations):
+        """ Add equations to the catalog.
+
+        :arg list equations: The equations to add.
+        :returns: The entries of the equations that were added.
+        :rtype: list
+        """
+
+        entries = [CatalogEntry(equation) for equation in flatten(equations)]
+        for entry in entries:
+            for term in entry.indexed:
+                if term not in self.count:
+                    self.indexed.append(term)
+                    self.count[term] = 0
+                self.count[term] += entry.count[term]
+            for term in entry.derivatives:
+                if term not in self.found:
+                    self.found.add(term)
+                    self.derivatives.append(term)
+            # The indices and the constants of each entry are added as (unordered) sets, in the same order as SymPy's atoms method would
+            # find them. Where the indices and the constants are used, the generated code follows the iteration order of the sets they
+            # are put into, so this keeps the generated code the same as when the equations were searched with the atoms method.
+            for term in set(entry.indexed):
+                self.indices.setdefault(term.base, set()).add(term.indices)
+            for term in set(entry.einstein_terms):
+                if term.is_constant and term not in self.found:
+                    self.found.add(term)
+                    self.constants.append(term)
+            self.maximum_order = max(self.maximum_order, entry.maximum_order)
+        self.entries += entries
+        return entries
+
+    def get_derivatives(self):
+        """ Return the spatial and temporal Derivative terms. Any Derivative with respect to the time 't' is assumed to be a temporal Derivative.
+
+        :returns: All of the spatial Derivative objects and all of the temporal Derivative objects.
+        :rtype: (list, list)
+        """
+
+        time = EinsteinTerm('t')
+        spatial_derivatives = [d for d in self.derivatives if all(arg != time for arg in d.args)]
+        time_derivatives = [d for d in self.derivatives if not all(arg != time for arg in d.args)]
+        return spatial_derivatives, time_derivatives
+
+    def get_used_formulas(self, formulas):
+        """ Return the formulas for the Indexed objects in the catalog.
+
+        :arg list formulas: The formulas to choose from.
+        :returns: The formulas that are used, in the order their left-hand sides are first found.
+        :rtype: list
+        """
+
+        formulas = dict([(form.lhs, form.rhs) for form in formulas])
+        return [Eq(var, formulas[var]) for var in self.indexed if var in formulas]
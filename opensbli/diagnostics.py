@@ -23,28 +23,73 @@ from sympy.tensor import Indexed
 from .utils import *
 from .evaluations import *
 from .kernel import *
+from .catalog import ExpressionCatalog
+from .profiling import profiler, profiled
+import logging
+LOG = logging.getLogger(__name__)
 
 
 class ReductionVariable(Symbol):
 
-    def __new__(self, var):
+    """ A variable into which a reduction over the grid points is accumulated. The type of reduction (sum, max or min) sets how it is accumulated. """
+
+    def __new__(self, var, reduction_type="sum"):
         self = Symbol.__xnew__(self, var)
+        self.reduction_type = reduction_type
         return self
 
 
+class Maximum(Function):
+
+    """ The maximum of two values. Unlike SymPy's Max, this is never evaluated, as the terms (e.g. EinsteinTerms) are generally not known to be real. """
+
+    nargs = 2
+
+
+class Minimum(Function):
+
+    """ The minimum of two values. Unlike SymPy's Min, this is never evaluated, as the terms (e.g. EinsteinTerms) are generally not known to be real. """
+
+    nargs = 2
+
+
 class Reduction(object):
 
-    def __init__(self, grid, equations, formulas, prognostic_variables, spatial_scheme, rtype, compute_every):
+    @profiled("Reduction")
+    def __init__(self, grid, equations, formulas, prognostic_variables, spatial_scheme, rtype, compute_every, spatial_discretisation=None):
+        """ Create the computations of the reductions of the diagnostic equations.
+
+        If the spatial discretisation is given, the work arrays of the diagnostics are numbered after those of the spatial discretisation.
+        If the reductions are also computed every few iterations, they are computed in the first stage of the time-step, just after the
+        spatial computations (i.e. when the spatial work arrays hold the terms evaluated from the prognostic variables at the start of the
+        time-step). Any formula or derivative that the spatial discretisation has already evaluated over the range required here is then reused,
+        and only the missing terms are evaluated.
+
+        :arg grid: The numerical grid of solution points.
+        :arg list equations: The diagnostic equations.
+        :arg list formulas: The formulas for the variables used in the diagnostic equations.
+        :arg list prognostic_variables: The prognostic variables, which are known.
+        :arg spatial_scheme: The spatial scheme used to evaluate the derivatives.
+        :arg list rtype: The type of reduction (sum, max or min) of each equation.
+        :arg int compute_every: The number of iterations between the computations of the reductions. If None, they are only computed at the end.
+        :arg spatial_discretisation: The spatial discretisation of the equations, whose evaluated terms may be reused.
+        :returns: None
+        """
 
         self.computations = []
 
         all_equations = flatten(equations)
         all_formulas = flatten(formulas)
+        # The Derivatives are made canonical as in the spatial discretisation, so that its evaluations can be reused.
+        all_equations = canonicalise_derivatives(all_equations)[0]
+        all_formulas = canonicalise_derivatives(all_formulas)[0]
 
         # Get all the formulas used in the equations
-        all_formulas = get_used_formulas(all_formulas, all_equations)
+        catalog = ExpressionCatalog(all_equations)
+        all_formulas = catalog.get_used_formulas(all_formulas)
+        catalog.add(all_formulas)
 
-        spatial_derivatives, time_derivatives = get_derivatives(all_equations + all_formulas)
+        spatial_derivatives, time_derivatives = catalog.get_derivatives()
 
         evaluations = {}
 
@@ -65,21 +110,39 @@ class Reduction(object):
             order_of_evaluations += [val]
             known += [val]
 
+        # The dependencies between the evaluations
+        self.evaluation_graph = EvaluationGraph(evaluations)
+
         # Sort formulas (Indexed Objects)
-        order_of_evaluations = sort_evaluations(order_of_evaluations, evaluations, Indexed)
+        order_of_evaluations = self.evaluation_graph.schedule(order_of_evaluations, Indexed)
 
         # Sort derivatives
-        order_of_evaluations = sort_evaluations(order_of_evaluations, evaluations, Derivative)
+        order_of_evaluations = self.evaluation_graph.schedule(order_of_evaluations, Derivative)
 
         # Set the range of evaluations
         set_range_of_evaluations(order_of_evaluations, evaluations, grid)
 
+        # Reuse the terms that the spatial discretisation has already evaluated
+        self.in_stage = bool(spatial_discretisation and compute_every)
+        self.reused = []
+        if self.in_stage:
+            self.reused = self.get_reused_evaluations(order_of_evaluations, evaluations, known, spatial_discretisation)
+            for term in self.reused:
+                evaluations[term].work = spatial_discretisation.evaluations[term].work
+            known += self.reused
+            LOG.info("The reductions reuse %d of the %d formulas and derivatives evaluated by the spatial discretisation."
+                     % (len(self.reused), len([ev for ev in order_of_evaluations if ev not in prognostic_variables])))
+        profiler.count('reused evaluations', len(self.reused))
+        evaluated = [ev for ev in order_of_evaluations if ev not in self.reused]
+
         # Work array name (This should be modified only if the name is changed in Spatial.py, to reduce the memory required for simulation
-        work_array_index = 0
         work_array_name = 'wk'
+        # Number the work arrays after those of the spatial discretisation, so that they do not overwrite each other.
+        work_array_index = spatial_discretisation.work_array_index if spatial_discretisation else 0
+        first_work_array_index = work_array_index
 
         # Update the work arrays depending on the order of evaluations
-        evaluations, work_array_index = update_work_arrays(order_of_evaluations, evaluations, work_array_name, work_array_index, grid)
+        evaluations, work_array_index = update_work_arrays(evaluated, evaluations, work_array_name, work_array_index, grid)
 
         # Create formula computation kernels
         self.computations += create_formula_kernels(order_of_evaluations, evaluations, known, grid)
@@ -102,18 +165,47 @@ class Reduction(object):
         # Store the iteration number used to write the if statement
         self.compute_every = compute_every
 
+        profiler.count('work arrays', work_array_index - first_work_array_index)
+        profiler.count_computations(self.computations)
+
         return
 
-    def create_reduction_variables(self, equations):
+    def get_reused_evaluations(self, order_of_evaluations, evaluations, known, spatial_discretisation):
+        """ Find the terms (formulas and derivatives) that the spatial discretisation stores over at least the range required here.
+        A derivative that is inlined in the spatial discretisation is not stored, so it cannot be reused.
+
+        :arg list order_of_evaluations: The terms to evaluate.
+        :arg dict evaluations: The evaluation of each term.
+        :arg list known: The terms that are known (i.e. the prognostic variables).
+        :arg spatial_discretisation: The spatial discretisation.
+        :returns: The terms to reuse.
+        :rtype: list
+        """
+
+        def covers(available, required):
+            # The ranges may be symbolic (e.g. nx0 + 4), so they are compared by the sign of their difference.
+            return all(sympify(r[0] - a[0]).is_nonnegative and sympify(a[1] - r[1]).is_nonnegative for a, r in zip(available, required))
+
+        reused = []
+        for term in order_of_evaluations:
+            available = spatial_discretisation.evaluations.get(term)
+            if term in known or available is None or not isinstance(available.work, Indexed):
+                continue
+            if covers(available.evaluation_range, evaluations[term].evaluation_range):
+                reused.append(term)
+        return reused
+
+    def create_reduction_variables(self, equations, rtype):
         """ Create the reduction variables for the diagnostic equations.
 
         :arg equations: The diagnostic equations.
+        :arg rtype: The type of reduction of each equation.
         :returns: A list with variables of type ReductionVariable.
         :rtype: list
         """
         reduction_variables = []
-        for eq in equations:
-            reduction_variables.append(ReductionVariable(str(eq.lhs.base)))
+        for number, eq in enumerate(equations):
+            reduction_variables.append(ReductionVariable(str(eq.lhs.base), rtype[number]))
         return reduction_variables
 
     def create_reduction_equations(self, equations, rtype, grid):
@@ -126,14 +218,18 @@ class Reduction(object):
         :rtype: list
         """
 
-        reduction_variable = self.create_reduction_variables(equations)
+        reduction_variable = self.create_reduction_variables(equations, rtype)
         reduction_equation = [None for eq in equations]
 
         for number, eq in enumerate(equations):
             if rtype[number] == "sum":
                 reduction_equation[number] = Eq(reduction_variable[number],
                                                 (eq.rhs + reduction_variable[number]))
+            elif rtype[number] == "max":
+                reduction_equation[number] = Eq(reduction_variable[number], Maximum(reduction_variable[number], eq.rhs))
+            elif rtype[number] == "min":
+                reduction_equation[number] = Eq(reduction_variable[number], Minimum(reduction_variable[number], eq.rhs))
             else:
-                raise NotImplementedError("Only summation reductions are supported")
+                raise NotImplementedError("Only summation, maximum and minimum reductions are supported")
 
         return reduction_equation
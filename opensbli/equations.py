@@ -347,6 +347,17 @@ class EinsteinTerm(Symbol):
         self.indices = [Idx(x) for x in indices]
         return self
 
+    def __getstate__(self):
+        """ Return the state used when pickling. The attributes of the EinsteinTerm (e.g. is_constant, is_coordinate)
+        are not SymPy assumptions, so they are stored alongside the assumptions here.
+
+        :returns: The state of the EinsteinTerm.
+        :rtype: dict
+        """
+        state = Symbol.__getstate__(self)
+        state.update(self.__dict__)
+        return state
+
     def get_indices(self):
         """ Return a list of the Einstein indices.
 
@@ -590,8 +601,11 @@ class Equation(object):
                 temp = parse_expr(sub, local_dict)
                 self.parsed = self.parsed.xreplace({temp.lhs: temp.rhs})
 
-        # Update the Einstein Variables in the expression that are constants
-        for term in self.parsed.atoms(EinsteinTerm):
+        # Update the Einstein Variables in the expression that are constants. The same term can occur as several (equal) objects
+        # in the parsed expression (e.g. Minf in Minf*Minf), so every occurrence is updated rather than just those in atoms().
+        for term in preorder_traversal(self.parsed):
+            if not isinstance(term, EinsteinTerm):
+                continue
             if any(constant == str(term) for constant in constants):
                 term.is_constant = True
                 term.is_commutative = True
@@ -603,6 +617,12 @@ class Equation(object):
         # Expand Einstein terms/indices
         expansion = EinsteinExpansion(self.parsed, ndim)
         self.expanded = expansion.expanded
+        # The expansion re-uses (equal) terms held in SymPy's cache, which need not be the ones updated above, so update the constants again.
+        for expanded in flatten([self.expanded]):
+            for term in preorder_traversal(expanded):
+                if isinstance(term, EinsteinTerm) and any(constant == str(term) for constant in constants):
+                    term.is_constant = True
+                    term.is_commutative = True
         # LOG.debug("The expanded expression is: %s" % (expansion.expanded))
         return
 
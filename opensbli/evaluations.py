@@ -91,6 +91,97 @@ def create_formula_evaluations(all_formulas, evals):
     return evals
 
 
+class EvaluationGraph(object):
+
+    """ The dependency graph of a set of evaluations. Each evaluation is a node of the graph, and depends on the terms it requires.
+    The graph is used to schedule the evaluations, such that each term is evaluated after all of the terms it requires. """
+
+    def __init__(self, evaluations):
+        """ Create the graph from the requirements of each evaluation.
+
+        :arg dict evaluations: The evaluation information, containing dependency information.
+        :returns: None
+        """
+
+        self.nodes = list(evaluations.keys())
+        # The position of each node is used to schedule independent nodes in the order they appear in the evaluations.
+        self.position = dict([(node, number) for number, node in enumerate(self.nodes)])
+        self.requires = {}
+        self.dependants = dict([(node, []) for node in self.nodes])
+        for node in self.nodes:
+            requires = []
+            for req in evaluations[node].requires or []:
+                if req not in requires:
+                    requires.append(req)
+            self.requires[node] = requires
+            for req in requires:
+                if req in self.dependants:
+                    self.dependants[req].append(node)
+        return
+
+    def schedule(self, order, typef):
+        """ Append the nodes of a given type to the order of evaluations, such that each node comes after the terms it requires.
+        Nodes are scheduled in levels (Kahn's algorithm); the nodes of a level only require terms in the earlier levels,
+        and are ordered as in the evaluations.
+
+        :arg list order: The terms that are already ordered (i.e. known). This is updated in-place.
+        :arg typef: The type of the nodes to schedule.
+        :returns: The ordered terms.
+        :rtype: list
+        """
+
+        scheduled = set(order)
+        nodes = [node for node in self.nodes if isinstance(node, typef) and node not in scheduled]
+        pending = set(nodes)
+
+        # The number of requirements of each node that are not yet scheduled
+        remaining = {}
+        for node in nodes:
+            unscheduled = [req for req in self.requires[node] if req not in scheduled]
+            missing = [req for req in unscheduled if req not in pending]
+            if missing:
+                raise ValueError("The evaluation of %s requires %s, which is never evaluated." % (node, ', '.join([str(req) for req in missing])))
+            remaining[node] = len(unscheduled)
+
+        level = [node for node in nodes if remaining[node] == 0]
+        while level:
+            order += level
+            scheduled.update(level)
+            ready = []
+            for node in level:
+                for dependant in self.dependants[node]:
+                    if dependant in remaining:
+                        remaining[dependant] -= 1
+                        if remaining[dependant] == 0:
+                            ready.append(dependant)
+            level = sorted(ready, key=lambda node: self.position[node])
+
+        unscheduled = [node for node in nodes if node not in scheduled]
+        if unscheduled:
+            cycle = self.find_cycle(unscheduled)
+            raise ValueError("The evaluations have a cyclic dependency: %s" % ' -> '.join([str(node) for node in cycle]))
+        return order
+
+    def find_cycle(self, nodes):
+        """ Find a cycle in the graph. Each of the nodes given should require at least one of the other nodes, as is the case for
+        the nodes that could not be scheduled.
+
+        :arg list nodes: The nodes to search.
+        :returns: The nodes in the cycle, starting and ending with the same node.
+        :rtype: list
+        """
+
+        candidates = set(nodes)
+        path = []
+        position = {}
+        node = nodes[0]
+        while node not in position:
+            position[node] = len(path)
+            path.append(node)
+            node = [req for req in self.requires[node] if req in candidates][0]
+        return path[position[node]:] + [node]
+
+
 def sort_evaluations(order, evaluations, typef):
     """ Sort the evaluations based on the requirements of each term. For example, if we have
     the primitive variables p, u0, u1, and T, then the pressure p may depend on the velocity u0 and u1, and T may depend on p,
@@ -103,57 +194,51 @@ def sort_evaluations(order, evaluations, typef):
     :returns: A list of ordered terms.
     :rtype: list
     """
-    key_list = [key for key in evaluations.keys() if isinstance(key, typef) and key not in order]
-    requires_list = [evaluations[key].requires for key in key_list]
-    zipped = zip(key_list, requires_list)
-    # Breaks after 1000 iterations
-    iter_count = 0
-    while key_list:
-        iter_count = iter_count+1
-        order += [x for (x, y) in zipped if all(req in order for req in y)]
-        key_list = [key for key in evaluations.keys() if isinstance(key, typef) and key not in order]
-        requires_list = [evaluations[key].requires for key in key_list]
-        zipped = zip(key_list, requires_list)
-        if iter_count > 1000:
-            pprint([req for req in requires_list[0]])
-            pprint(order)
-            pprint([req in order for req in requires_list[0]])
-            raise ValueError("Exiting sort evaluations ")
-
-    return order
+    return EvaluationGraph(evaluations).schedule(order, typef)
+
+
+def union_of_ranges(first, second):
+    """ Return the smallest range that contains both of the ranges, in each direction. The bounds of the ranges
+    differ by a whole number of points (e.g. 0 and -2, or nx0 and nx0 + 2).
+
+    :arg list first: The first range, as a (start, end) tuple in each direction.
+    :arg list second: The second range.
+    :returns: The union of the ranges.
+    :rtype: list
+    """
+    union = []
+    for (start0, end0), (start1, end1) in zip(first, second):
+        start = start1 if sympify(start1 - start0).is_negative else start0
+        end = end1 if sympify(end1 - end0).is_positive else end0
+        union.append(tuple([start, end]))
+    return union
 
 
 def set_range_of_evaluations(order_of_evaluations, evaluations, grid):
-    """ Set the evaluation ranges of each Evaluation object based on the shape of the grid of points.
-    First the ranges of derivatives are updated, then other ranges are updated. """
+    """ Set the evaluation ranges of each Evaluation object to the minimal range that its consumers require.
+    Every term is evaluated over the grid points (excluding the halos). The terms are then visited in the reverse order of evaluation,
+    so that the range of each term is complete before its requirements are updated; a formula requires its terms over the same range,
+    and a derivative requires its terms over its own range widened by the halo points of the stencil in the direction of the derivative.
+    The range of a term that is required by several others is the union of their requirements.
+
+    :arg list order_of_evaluations: The terms, in the order in which they are evaluated.
+    :arg dict evaluations: The evaluation information of each term.
+    :arg grid: The numerical grid of solution points.
+    :returns: None
+    """
 
-    derivatives = []
     for ev in order_of_evaluations:
-        if isinstance(ev, Derivative):
-            derivatives.append(ev)
         evaluations[ev].evaluation_range = [tuple([0, s]) for s in grid.shape]
 
-    # Update the range for the derivatives
-    grouped_derivatives = group_derivatives(derivatives)
-    for key, value in grouped_derivatives.iteritems():
-        for val in value:
-            require = evaluations[val].requires
-            formula = evaluations[val].formula
-            direction = formula[1][0]
-            halos = grid.halos[direction]
-            for req in require:
-                erange = list(evaluations[req].evaluation_range[direction])
-                if erange[0] == 0 and erange[1] == grid.shape[direction]:
-                    erange[0] += halos[0]
-                    erange[1] += halos[1]
-                evaluations[req].evaluation_range[direction] = tuple(erange)
-
-    # Update the range for the formulas this might require some modifications
-    for ev in order_of_evaluations:
-        if isinstance(ev, Indexed):
-            require = evaluations[ev].requires
-            if require:
-                for req in require:
-                    evaluations[req].evaluation_range = evaluations[ev].evaluation_range
-
+    for ev in reversed(order_of_evaluations):
+        required = list(evaluations[ev].evaluation_range)
+        if isinstance(ev, Derivative):
+            # The directions of the stencil (e.g. both directions of a mixed derivative that is evaluated directly)
+            for direction in set(evaluations[ev].formula[1]):
+                halos = grid.halos[direction]
+                start, end = required[direction]
+                required[direction] = tuple([start + halos[0], end + halos[1]])
+        for req in evaluations[ev].requires or []:
+            if req in evaluations:
+                evaluations[req].evaluation_range = union_of_ranges(evaluations[req].evaluation_range, required)
     return
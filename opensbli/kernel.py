@@ -20,9 +20,8 @@
 
 from sympy import *
 
-from .equations import EinsteinTerm
-from .grid import GridVariable
 from .utils import *
+from .catalog import ExpressionCatalog
 
 
 class Kernel(object):
@@ -52,46 +51,34 @@ class Kernel(object):
         """ Classify the individual terms in the kernel's equation(s)
         as inputs, outputs, or inputoutputs (i.e. both an input and an output). """
 
-        ins = []
-        outs = []
-        consts = []
-        allindexed = []
-
-        for eq in self.equations:
-            ins = ins + list(eq.rhs.atoms(IndexedBase))
-            outs = outs + list(eq.lhs.atoms(IndexedBase))
-            allindexed = allindexed + list(eq.atoms(Indexed))
-            consts = consts + [et for et in list(eq.atoms(EinsteinTerm)) if et.is_constant]
+        catalog = ExpressionCatalog(self.equations)
+        ins = [base for entry in catalog.entries for base in set(entry.rhs_bases)]
+        outs = [base for entry in catalog.entries for base in set(entry.lhs_bases)]
+        consts = catalog.constants
 
         indexbase_inouts = set(outs).intersection(set(ins))
         indexbase_ins = set(ins).difference(indexbase_inouts)
         indexbase_outs = set(outs).difference(indexbase_inouts)
 
         for v in indexbase_ins:
-            indexes = list(set([vin.indices for vin in allindexed if vin.base == v]))
+            indexes = list(catalog.indices.get(v, set()))
             if grid:
                 v = self.set_grid_arrays(v, grid, indexes)
             self.inputs[v] = indexes
         for v in indexbase_outs:
-            indexes = list(set([vout.indices for vout in allindexed if vout.base == v]))
+            indexes = list(catalog.indices.get(v, set()))
             if grid:
                 v = self.set_grid_arrays(v, grid, indexes)
             self.outputs[v] = indexes
         for v in indexbase_inouts:
-            indexes = list(set([vinout.indices for vinout in allindexed if vinout.base == v]))
+            indexes = list(catalog.indices.get(v, set()))
             if grid:
                 v = self.set_grid_arrays(v, grid, indexes)
             self.inputoutput[v] = indexes
 
-        idxs = flatten([list(e.rhs.atoms(Idx)) for e in self.equations])
-        if idxs:
-            self.has_Idx = True
-        else:
-            self.has_Idx = False
-
-        from .diagnostics import ReductionVariable
-        self.reductions = flatten([list(e.rhs.atoms(ReductionVariable)) for e in self.equations])
-        self.gridvariable = flatten([list(e.lhs.atoms(GridVariable)) for e in self.equations])
+        self.has_Idx = any(entry.has_Idx for entry in catalog.entries)
+        self.reductions = flatten([entry.reductions for entry in catalog.entries])
+        self.gridvariable = flatten([entry.gridvariables for entry in catalog.entries])
         if grid:
             self.constants = set(consts).difference(grid.mapped_indices.keys())
         else:
@@ -99,26 +86,95 @@ class Kernel(object):
 
         return
 
+    def rename_arrays(self, names, grid=None):
+        """ Rename the arrays (i.e. the IndexedBase objects) in the kernel's equation(s), and classify the terms again.
+
+        :arg dict names: The new name of each array to be renamed, keyed by its current name.
+        :arg grid: The numerical grid of solution points.
+        :returns: None
+        """
+
+        replacements = {}
+        for equation in self.equations:
+            for base in equation.atoms(IndexedBase):
+                if str(base) in names:
+                    replacements[base] = IndexedBase(names[str(base)])
+        self.equations = [equation.xreplace(replacements) for equation in self.equations]
+
+        self.inputs = {}
+        self.outputs = {}
+        self.inputoutput = {}
+        self.classify_grid_objects(grid)
+        return
+
     def set_grid_arrays(self, array, grid, indexes):
         """ Sets the Indexed object attribute is_grid to True if all the indices of an Indexed object
-        are in the 'mapped_indices' dictionary of the Grid. """
+        are in the 'mapped_indices' dictionary of the Grid. An Indexed object with only constant indices (e.g. deltat[0]) is not on the grid. """
         ets = [list(ind) for ind in indexes]
         ets = [list(et.atoms(Symbol)) for et in flatten(ets)]
         ets = (set(flatten(ets)))
-        if all(index in grid.mapped_indices.keys() for index in ets):
+        if ets and all(index in grid.mapped_indices.keys() for index in ets):
             array.is_grid = True
         else:
             array.is_grid = False
         return array
 
 
-def create_derivative_kernels(derivatives, evals, spatial_derivative, work_array_name, work_array_index, grid):
+def group_derivative_evaluations(derivatives, evals):
+    """ Group the derivatives of the same function which are evaluated over the same range, so that they can be evaluated by a single kernel
+    which reads the function once. Only the derivatives which are evaluated directly from the function (i.e. which require neither
+    another derivative nor a sub-evaluation) are grouped, so the derivatives in a group only read the function and each write their own work array.
+
+    :arg list derivatives: The derivatives, in the order they are evaluated.
+    :arg dict evals: The evaluation information of each derivative.
+    :returns: The group of each derivative that is grouped with at least one other derivative. Each group is in the order of the derivatives.
+    :rtype: dict
+    """
+
+    def is_direct(d):
+        return not any(isinstance(req, Derivative) for req in evals[d].requires) and all(subev is None for subev in evals[d].subevals)
+
+    direct = [d for d in derivatives if is_direct(d)]
+    groups = {}
+    for function, members in group_derivatives(direct).iteritems():
+        by_range = {}
+        for derivative in members:
+            by_range.setdefault(tuple(evals[derivative].evaluation_range), []).append(derivative)
+        for group in by_range.values():
+            if len(group) > 1:
+                group = sorted(group, key=derivatives.index)
+                for derivative in group:
+                    groups[derivative] = group
+    return groups
+
+
+def create_derivative_kernels(derivatives, evals, spatial_derivative, work_array_name, work_array_index, grid, group=False):
+    """ Create the kernels which evaluate the derivatives into their work arrays. By default each derivative is evaluated by its own kernel.
+
+    :arg list derivatives: The derivatives, in the order they are evaluated.
+    :arg dict evals: The evaluation information of each derivative.
+    :arg spatial_derivative: The formulas of the derivatives.
+    :arg str work_array_name: The name of the work arrays.
+    :arg int work_array_index: The index of the first work array available for any sub-evaluations.
+    :arg grid: The numerical grid of solution points.
+    :arg bool group: If True, the derivatives of the same function over the same range are evaluated by a single kernel (see group_derivative_evaluations).
+    :returns: The kernels.
+    :rtype: list
+    """
     computations = []
     ranges = [evals[ev].evaluation_range for ev in derivatives]
     subevals = [evals[ev].subevals for ev in derivatives]
     require = [evals[ev].requires for ev in derivatives]
+    groups = group_derivative_evaluations(derivatives, evals) if group else {}
     for number, derivative in enumerate(derivatives):
-        if not any(isinstance(req, Derivative) for req in require[number]):
+        if derivative in groups:
+            # The group is evaluated where its first derivative would have been.
+            members = groups[derivative]
+            if derivative == members[0]:
+                eqs = [Eq(evals[member].work, spatial_derivative.get_derivative_formula(member)) for member in members]
+                name = ', '.join([str_print(member) for member in members])
+                computations.append(Kernel(eqs, ranges[number], name, grid))
+        elif not any(isinstance(req, Derivative) for req in require[number]):
             if all(subev is None for subev in subevals[number]):
                 rhs = spatial_derivative.get_derivative_formula(derivative)
                 eq = Eq(evals[derivative].work, rhs)
@@ -166,3 +222,60 @@ def create_formula_kernels(ordered_evaluations, evaluations, known, grid):
     for eq in non_group:
         computation_kernels += [Kernel(eq, range_dictionary[eq], "Non-Grouped Formula Evaluation", grid)]
     return computation_kernels
+
+
+def fuse_kernels(computations, grid):
+    """ Fuse consecutive kernels into a single kernel (i.e. a single loop over the grid points) where this is safe.
+    Kernels are fused when they have the same range of evaluation, do not accumulate reductions or define the same GridVariables,
+    and no kernel reads a neighbouring point (i.e. with a non-zero stencil offset) of an array that is written in the same fused loop.
+    The access mode of each array in a fused kernel follows from its equations, e.g. an array written by one of the kernels and read
+    by another becomes an inputoutput.
+
+    :arg list computations: The computations, in the order they are executed. Any computation which is not a Kernel is left as it is.
+    :arg grid: The numerical grid of solution points.
+    :returns: The computations with the kernels fused.
+    :rtype: list
+    """
+
+    def accesses(kernel):
+        reads = set(kernel.inputs.keys() + kernel.inputoutput.keys())
+        writes = set(kernel.outputs.keys() + kernel.inputoutput.keys())
+        neighbours = set([array for array in reads if any(not index.is_Atom for indices in kernel.inputs.get(array, kernel.inputoutput.get(array)) for index in indices)])
+        return reads, writes, neighbours
+
+    def fusable(group, kernel):
+        if kernel.ranges != group[0].ranges or kernel.reductions or group[0].reductions:
+            return False
+        if set(kernel.gridvariable) & set([v for k in group for v in k.gridvariable]):
+            return False
+        written = set([array for k in group for array in accesses(k)[1]])
+        neighbours = set([array for k in group for array in accesses(k)[2]])
+        reads, writes, kernel_neighbours = accesses(kernel)
+        return not (kernel_neighbours & written or writes & neighbours)
+
+    def fuse(group):
+        if len(group) == 1:
+            return group[0]
+        names = [k.computation_type for k in group]
+        if len(names) > 3:
+            name = "%s and %d more (fused)" % (', '.join(names[:2]), len(names) - 2)
+        else:
+            name = "%s (fused)" % ', '.join(names)
+        return Kernel(flatten([k.equations for k in group]), group[0].ranges, name, grid)
+
+    fused = []
+    group = []
+    for computation in computations:
+        if isinstance(computation, Kernel) and group and fusable(group, computation):
+            group.append(computation)
+            continue
+        if group:
+            fused.append(fuse(group))
+        if isinstance(computation, Kernel):
+            group = [computation]
+        else:
+            group = []
+            fused.append(computation)
+    if group:
+        fused.append(fuse(group))
+    return fused
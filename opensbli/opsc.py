@@ -20,10 +20,16 @@
 
 from sympy import *
 from sympy.printing.ccode import CCodePrinter
+from sympy.printing.precedence import precedence
 import os
+import re
+import json
+import hashlib
+from itertools import groupby
 from string import Template
 from .equations import EinsteinTerm
 from .diagnostics import ReductionVariable
+from .profiling import profiler, profiled
 import logging
 LOG = logging.getLogger(__name__)
 BUILD_DIR = os.getcwd()
@@ -39,23 +45,78 @@ except ImportError:
     have_ops = False
 
 
+def fingerprint(code):
+    """ Return the fingerprint of a piece of code.
+
+    :arg str code: The code.
+    :returns: The SHA-1 digest of the code.
+    :rtype: str
+    """
+    return hashlib.sha1(code.encode('utf-8')).hexdigest()
+
+
+def single_precision_functions():
+    """ The single-precision versions (e.g. sinf, expf) of the C math functions known to SymPy's C code printer.
+
+    :returns: The names of the single-precision functions, in the same form as SymPy's known_functions.
+    :rtype: dict
+    """
+    from sympy.printing.ccode import known_functions
+
+    functions = {}
+    for name, function in known_functions.items():
+        if isinstance(function, str):
+            functions[name] = function + 'f'
+        else:
+            functions[name] = [(condition, f + 'f') for condition, f in function]
+    return functions
+
+
 class OPSCCodePrinter(CCodePrinter):
 
     """ Prints OPSC code. """
 
-    def __init__(self, Indexed_accs, constants):
-        """ Initialise the code printer. """
+    def __init__(self, Indexed_accs, constants, dtype='double'):
+        """ Initialise the code printer.
+
+        :arg str dtype: The C type in which the expressions are evaluated. If this is 'float', the literals and the math functions are single-precision.
+        """
 
         settings = {}
+        if dtype == 'float':
+            settings['user_functions'] = single_precision_functions()
         CCodePrinter.__init__(self, settings)
 
         # Indexed access numbers are required in dictionary
         self.Indexed_accs = Indexed_accs
         self.constants = constants
+        # The suffix of the floating-point literals and of the math functions that are not known to SymPy.
+        self.suffix = 'f' if dtype == 'float' else ''
 
     def _print_ReductionVariable(self, expr):
         return '*%s' % str(expr)
 
+    def _print_Maximum(self, expr):
+        return 'fmax%s(%s, %s)' % ((self.suffix,) + tuple([self._print(arg) for arg in expr.args]))
+
+    def _print_Minimum(self, expr):
+        return 'fmin%s(%s, %s)' % ((self.suffix,) + tuple([self._print(arg) for arg in expr.args]))
+
+    def _print_Float(self, expr):
+        return CCodePrinter._print_Float(self, expr) + self.suffix
+
+    def _print_Pow(self, expr):
+        if expr.exp == -1:
+            return '1.0%s/%s' % (self.suffix, self.parenthesize(expr.base, precedence(expr)))
+        elif expr.exp == 0.5:
+            return 'sqrt%s(%s)' % (self.suffix, self._print(expr.base))
+        return 'pow%s(%s, %s)' % (self.suffix, self._print(expr.base), self._print(expr.exp))
+
+    def _print_Pi(self, expr):
+        if self.suffix:
+            return '((float)M_PI)'
+        return CCodePrinter._print_Pi(self, expr)
+
     def _print_Rational(self, expr):
         if self.constants is not None:
             if expr in self.constants.keys():
@@ -66,7 +127,7 @@ class OPSCCodePrinter(CCodePrinter):
                 return self.constants[expr]
         else:
             p, q = int(expr.p), int(expr.q)
-            return '%d.0/%d.0' % (p, q)
+            return '%d.0%s/%d.0%s' % (p, self.suffix, q, self.suffix)
 
     def _print_Mod(self, expr):
         args = map(ccode, expr.args)
@@ -98,36 +159,250 @@ class OPSCCodePrinter(CCodePrinter):
         return out
 
 
+def define_constant(value, constants, prefix):
+    """ Return the name of the global constant with the given value, defining a new constant if there is none.
+    The value of each constant is written in terms of the other constants, e.g. 1/(gama - 1) as 1/rcf0, so that sort_constants
+    evaluates it after them rather than evaluating their values again. The values of the constants defined before a new one are
+    written in terms of it too.
+
+    :arg value: The value of the constant.
+    :arg dict constants: The global constants defined so far, as a dictionary of their values and names. This is updated with any new constant.
+    :arg str prefix: The prefix of the name of a new constant.
+    :returns: The name of the constant.
+    :rtype: str
+    """
+    defined = dict([(v, Symbol(name)) for v, name in constants.items()])
+    previous = None
+    while value != previous:
+        previous, value = value, value.xreplace(defined)
+    if value.is_Symbol:
+        return str(value)
+    if value not in constants.keys():
+        name = '%s%d' % (prefix, len(constants.keys()))
+        for v, n in constants.items():
+            rewritten = v.xreplace({value: Symbol(name)})
+            if rewritten != v and rewritten not in constants:
+                del constants[v]
+                constants[rewritten] = n
+        constants[value] = name
+    return constants[value]
+
+
 def pow_to_constant(expr, constants):
     from sympy.core.function import _coeff_isneg
+    from .grid import GridVariable
     # Only negative powers i.e. they correspond to division and they are stored into constant arrays
     inverse_terms = {}
     for at in expr.atoms(Pow):
-        if _coeff_isneg(at.exp) and not at.base.atoms(Indexed):
-            if at not in constants.keys():
-                constants[at] = 'rinv%d' % len(constants.keys())
-            inverse_terms[at] = constants[at]
+        if _coeff_isneg(at.exp) and not at.base.atoms(Indexed, GridVariable):
+            inverse_terms[at] = define_constant(at, constants, 'rinv')
     expr = expr.subs(inverse_terms)
     return expr, constants
 
 
-def ccode(expr, Indexed_accs=None, constants=None):
+def hoist_constants(expr, known, constants):
+    """ Replace each subexpression that is built only from constants (e.g. 1.0/((gama-1)*Minf*Minf*Pr*Re)) by a global constant,
+    so that it is evaluated once rather than at every grid point. For a sum or product that also involves other terms,
+    the constant terms are grouped together into a single constant.
+
+    :arg expr: The expression.
+    :arg set known: The terms that are constant.
+    :arg dict constants: The global constants defined so far, as a dictionary of their values and names. This is updated with any new constants.
+    :returns: The expression in terms of the global constants, and the updated dictionary of the global constants.
+    """
+
+    from sympy.core.function import _coeff_isneg
+
+    def is_constant(term):
+        return term.free_symbols <= known and not term.atoms(Indexed, Idx)
+
+    def constant(value):
+        # A unit numerical coefficient (e.g. the 1.0 of 1.0/Re) is dropped.
+        coefficient, rest = value.as_coeff_Mul()
+        if coefficient == 1:
+            value = rest
+        return Symbol(define_constant(value, constants, 'rinv' if value.is_Pow and _coeff_isneg(value.exp) else 'rcf'))
+
+    def hoist(term):
+        if term.is_Atom or isinstance(term, (Indexed, Idx)):
+            return term
+        if is_constant(term):
+            return term if (-term).is_Atom else constant(term)
+        if term.is_Add or term.is_Mul:
+            constant_args = [arg for arg in term.args if is_constant(arg)]
+            args = [hoist(arg) for arg in term.args if not is_constant(arg)]
+            if len(constant_args) > 1 or (constant_args and not constant_args[0].is_Atom):
+                combined = term.func(*constant_args)
+                # A negated constant is left as it is, as there is nothing to gain from evaluating it beforehand.
+                constant_args = [combined if (combined.is_Atom or (-combined).is_Atom) else constant(combined)]
+            return term.func(*(constant_args + args))
+        return term.func(*[hoist(arg) for arg in term.args])
+
+    return hoist(expr), constants
+
+
+def ccode(expr, Indexed_accs=None, constants=None, dtype='double'):
     """ Create an OPSC code printer object and write out the expression as an OPSC code string.
 
     :arg expr: The expression to translate into OPSC code.
     :arg Indexed_accs: Indexed OPS_ACC accesses.
     :arg constants: Constants that should be defined at the top of the OPSC code.
+    :arg str dtype: The C type in which the expression is evaluated.
     :returns: The expression in OPSC code.
     :rtype: str
     """
     if isinstance(expr, Eq):
         if constants:
             expr, constants = pow_to_constant(expr, constants)
-        code_print = OPSCCodePrinter(Indexed_accs, constants)
+        code_print = OPSCCodePrinter(Indexed_accs, constants, dtype)
         code = code_print.doprint(expr.lhs) \
-            + ' = ' + OPSCCodePrinter(Indexed_accs, constants).doprint(expr.rhs)
+            + ' = ' + OPSCCodePrinter(Indexed_accs, constants, dtype).doprint(expr.rhs)
         return code, code_print.constants
-    return OPSCCodePrinter(Indexed_accs, constants).doprint(expr)
+    return OPSCCodePrinter(Indexed_accs, constants, dtype).doprint(expr)
+
+
+def common_subexpressions(equations, prefix='cse'):
+    """ Eliminate the common subexpressions across a list of equations, which are evaluated in order at each grid point.
+    The equations are split into groups in which no equation reads a term written by an earlier equation of the group;
+    the common subexpressions of each group are then evaluated into local temporaries (GridVariables) at the start of the group.
+    The Indexed objects (and Idx objects) are treated as single terms, so that their indices (i.e. the OPS_ACC accesses) are never altered.
+
+    :arg list equations: The equations.
+    :arg str prefix: The prefix of the names of the temporaries.
+    :returns: The equations, with the equations for the temporaries inserted, and the number of operations before and after the elimination.
+    :rtype: (list, int, int)
+    """
+    from .grid import GridVariable
+
+    # Split the equations into groups.
+    groups = []
+    written = set()
+    for equation in equations:
+        reads = set([i.base for i in equation.rhs.atoms(Indexed)]) | equation.rhs.atoms(GridVariable)
+        if not groups or reads & written:
+            groups.append([])
+            written = set()
+        groups[-1].append(equation)
+        written |= set([i.base for i in equation.lhs.atoms(Indexed)]) | equation.lhs.atoms(GridVariable)
+
+    names = set([str(symbol) for equation in equations for symbol in equation.atoms(Symbol)])
+    temporaries = numbered_symbols(prefix, cls=GridVariable, exclude=[GridVariable(name) for name in names])
+
+    eliminated = []
+    before = 0
+    after = 0
+    for group in groups:
+        # Replace the Indexed objects by placeholders.
+        terms = set(flatten([list(equation.rhs.atoms(Indexed, Idx)) for equation in group]))
+        placeholders = dict([(term, Dummy()) for term in terms])
+        originals = dict([(value, key) for key, value in placeholders.items()])
+        expressions = [equation.rhs.xreplace(placeholders) for equation in group]
+        before += sum([count_ops(expression) for expression in expressions])
+
+        replacements, reduced = cse(expressions, symbols=temporaries)
+        after += sum([count_ops(value) for _, value in replacements]) + sum([count_ops(expression) for expression in reduced])
+
+        eliminated += [Eq(temporary, value.xreplace(originals)) for temporary, value in replacements]
+        eliminated += [Eq(equation.lhs, expression.xreplace(originals)) for equation, expression in zip(group, reduced)]
+    return eliminated, before, after
+
+
+def allocate_work_arrays(sequences, work_arrays):
+    """ Allocate the work arrays such that the values whose lifetimes do not overlap share the same array.
+    Within a sequence of kernels, a kernel that writes a work array without reading it starts the lifetime of a new value,
+    which lasts until the last kernel that reads the value. Each sequence (e.g. the kernels of a stage of the time-stepping loop)
+    may be executed any number of times, so a work array that is read before it is written in any sequence holds a value from elsewhere,
+    and is never reused.
+
+    :arg list sequences: The sequences of kernels, each in the order in which the kernels are executed.
+    :arg set work_arrays: The names of the arrays that are work arrays.
+    :returns: The name of the array that each work array of each kernel is allocated to (for each sequence, a list with a dictionary for each kernel),
+    and the maximum number of work arrays that are live at once.
+    :rtype: (list, int)
+    """
+
+    def number(name):
+        return int(re.sub(r'\D', '', name) or 0)
+
+    # Find the lifetimes of the values, as the first and last kernels which access them, and the kernels which access each value.
+    lifetimes = []
+    pinned = set()
+    for kernels in sequences:
+        values = []
+        current = {}
+        for position, kernel in enumerate(kernels):
+            reads = set([str(a) for a in kernel.inputs.keys() + kernel.inputoutput.keys()]) & work_arrays
+            writes = set([str(a) for a in kernel.outputs.keys() + kernel.inputoutput.keys()]) & work_arrays
+            for name in reads | writes:
+                if name not in reads or name not in current:
+                    if name in reads:
+                        pinned.add(name)
+                    current[name] = {'name': name, 'start': position, 'end': position, 'kernels': [position]}
+                    values.append(current[name])
+                else:
+                    current[name]['end'] = position
+                    current[name]['kernels'].append(position)
+        lifetimes.append(values)
+
+    available = sorted(set([value['name'] for sequence in lifetimes for value in sequence if value['name'] not in pinned]), key=number)
+
+    def allocate(stable):
+        # Allocate the arrays with a greedy scan of the values in the order their lifetimes start. A stable allocation keeps
+        # the name of a work array whenever it is free, so that the code only changes where an array is actually reused.
+        allocations = []
+        allocated = set()
+        peak = len(pinned)
+        for kernels, values in zip(sequences, lifetimes):
+            allocation = [dict([(name, name) for name in pinned]) for kernel in kernels]
+            free = list(available)
+            live = []
+            for value in sorted([v for v in values if v['name'] not in pinned], key=lambda v: (v['start'], number(v['name']))):
+                # Release the arrays that are no longer needed. An array read by a kernel cannot be written by the same kernel.
+                free += [array for (end, array) in live if end < value['start']]
+                free.sort(key=number)
+                live = [(end, array) for (end, array) in live if end >= value['start']]
+                choices = [a for a in free if a in allocated] or free
+                if stable and value['name'] in free:
+                    array = value['name']
+                else:
+                    array = value['name'] if value['name'] in choices else choices[0]
+                free.remove(array)
+                allocated.add(array)
+                live.append((value['end'], array))
+                for position in value['kernels']:
+                    allocation[position][value['name']] = array
+                peak = max(peak, len(pinned) + len(live))
+            allocations.append(allocation)
+        return allocations, len(pinned | allocated), peak
+
+    # Prefer the stable allocation, unless it needs more arrays.
+    allocations, count, peak = allocate(True)
+    minimal = allocate(False)
+    if minimal[1] < count:
+        allocations = minimal[0]
+    return allocations, peak
+
+
+def halo_depths(ranges, indices, shape):
+    """ Return the number of halo points, in each direction, that are accessed at the given indices of an array from the points of the ranges.
+    A bound which depends on the grid size (e.g. the right-hand boundary of a range starting at 0) does not reach into the halo.
+
+    :arg list ranges: The range of the points in each direction, as (start, end) tuples.
+    :arg list indices: The indices at which the array is accessed (e.g. (i0 + 1, i1)).
+    :arg tuple shape: The number of grid points in each direction.
+    :returns: The (negative) number of halo points before the start, and the number of halo points after the end, of the grid in each direction.
+    :rtype: list
+    """
+    offsets = []
+    for index in indices:
+        index = [ind for ind in index if ind != EinsteinTerm('t')]
+        offsets.append([ind.subs(dict([(a, 0) for a in ind.atoms(Symbol)])) for ind in index])
+    depths = []
+    for direction, (start, end) in enumerate(ranges):
+        below = [sympify(start + offset[direction]) for offset in offsets]
+        above = [sympify(end + offset[direction] - shape[direction]) for offset in offsets]
+        depths.append((min([0] + [b for b in below if b.is_Number]), max([0] + [a for a in above if a.is_Number])))
+    return depths
 
 
 class OPSC(object):
@@ -136,6 +411,10 @@ class OPSC(object):
 
     # OPS Access types, used for kernel call
     ops_access = {'inputs': 'OPS_READ', 'outputs': 'OPS_WRITE', 'inputoutput': 'OPS_RW', 'reduction': 'OPS_INC'}
+    # The data types of the arrays and of the accumulations (i.e. reductions and time-stepping accumulators) in each precision mode
+    precision_modes = {'double': ('double', 'double'), 'float': ('float', 'float'), 'mixed': ('float', 'double')}
+    # OPS access types of each type of reduction
+    ops_reduction_access = {'sum': 'OPS_INC', 'max': 'OPS_MAX', 'min': 'OPS_MIN'}
     # OPS kernel headers
     ops_header = {'inputs': 'const %s *%s', 'outputs': '%s *%s', 'inputoutput': '%s *%s', 'Idx': 'const int *%s',
                   'reduction': '%s *%s'}
@@ -164,7 +443,10 @@ class OPSC(object):
         self.initialise_ops_parameters()
         self.template()
         if have_ops:
-            self.translate()
+            if self.is_translated():
+                LOG.info("The OPSC code is unchanged since it was last translated, so it is not translated again.")
+            else:
+                self.translate()
         return
 
     def initialise_ops_parameters(self):
@@ -211,6 +493,8 @@ class OPSC(object):
 
         # Grid based arrays used for declaration and definition in OPSC format
         self.grid_based_arrays = set()
+        # The halo depths of each grid based array, which are those accessed by the computations and the exchanges (see halo_depths).
+        self.array_halos = {}
 
         # The global constants that are to be declared.
         self.constants = set()
@@ -225,15 +509,59 @@ class OPSC(object):
         # Dictionary of stencils. The key will be a stencil, and the value is the name of stencil.
         self.stencil_dictionary = {}
 
+        # Precision mode. In the 'double' and 'float' modes, everything is stored and evaluated in that type. In the 'mixed' mode,
+        # the arrays are stored and evaluated as float, but the reductions and the arrays that accumulate the time-stepping updates
+        # (e.g. the _old arrays of the Runge-Kutta scheme) are double, so that round-off errors do not accumulate in single precision.
+        self.precision = self.simulation_parameters['precision']
+        if self.precision not in self.precision_modes:
+            raise ValueError("The precision should be one of %s." % ', '.join(sorted(self.precision_modes.keys())))
         # Data type of arrays
-        self.dtype = self.simulation_parameters['precision']
+        self.dtype, self.accumulation_dtype = self.precision_modes[self.precision]
+        self.accumulation_arrays = set()
+        if self.dtype != self.accumulation_dtype:
+            self.accumulation_arrays = set([str(array) for temporal in self.temporal_discretisation for array in temporal.accumulation_arrays])
+
+        # The simulation time, which is accumulated from the time-step of each iteration if the time-step is not constant.
+        if self.temporal_discretisation[0].constant_dt:
+            self.simulation_time = '(iteration + 1)*deltat'
+        else:
+            self.simulation_time = 'simulation_time'
+            # The time-step is computed from the CFL number, which must be given.
+            cfl = str(self.temporal_discretisation[0].cfl)
+            if cfl not in self.simulation_parameters:
+                raise ValueError("The '%s' simulation parameter is required for a variable time-step." % cfl)
+
+        # Eliminate the common subexpressions across the equations of each kernel (optional). The number of operations per grid point
+        # in each kernel, before and after the elimination, is recorded.
+        self.cse = self.simulation_parameters.get('cse', False)
+
+        # Evaluate the subexpressions that only involve constants once, as global constants, rather than at every grid point.
+        self.hoist_constants = self.simulation_parameters.get('hoist_constants', True)
+
+        # Reuse the work arrays whose lifetimes do not overlap, rather than allocating a separate array for each of them.
+        self.reuse_work_arrays = self.simulation_parameters.get('reuse_work_arrays', True)
+
+        # Fuse the consecutive kernels that can safely be evaluated in a single loop over the grid points (optional).
+        self.fuse_kernels = self.simulation_parameters.get('fuse_kernels', False)
+
+        # Evaluate the time-stepping kernels only over the points that are read before they are overwritten (see minimise_ranges).
+        self.minimise_ranges = self.simulation_parameters.get('minimise_ranges', True)
+        self.range_report = {}
+        self.work_array_report = {}
+        self.operation_counts = {}
 
         # Create the code directory
         if not os.path.exists(BUILD_DIR+'/%s_opsc_code' % name):
             os.makedirs(BUILD_DIR+'/%s_opsc_code' % name)
         self.CODE_DIR = BUILD_DIR + '/%s_opsc_code' % name
+
+        # The manifest of the fingerprints of the code files and kernels, as they were last written to the code directory.
+        self.manifest_path = self.CODE_DIR + '/manifest.json'
+        self.manifest = self.load_manifest()
+        self.fingerprints = {'files': {}, 'kernels': {}}
         return
 
+    @profiled("OPSC code generation")
     def template(self):
         """ Define the algorithm in pseudo-code and get all the code. """
 
@@ -319,26 +647,44 @@ class OPSC(object):
             code_dictionary['innerloop'] = ""
             code_dictionary['end_inner_loop'] = ""
 
+        # Shrink the ranges of the time-stepping kernels
+        if self.minimise_ranges:
+            self.minimise_computation_ranges()
+
+        # Fuse the kernels
+        if self.fuse_kernels:
+            self.fuse_computations()
+
+        # Reuse the work arrays whose lifetimes do not overlap
+        if self.reuse_work_arrays:
+            self.allocate_work_arrays()
+
         # Get the computational routines
         computational_routines = self.get_block_computations()
         # Write the computational routines to block computation files
         self.write_computational_routines(computational_routines)
 
         # Computation calls
-        # First the inner computation calls
-        computations = [self.spatial_discretisation[block].computations + self.temporal_discretisation[block].computations for block in range(self.nblocks)]
-        calls = self.get_block_computation_kernels(computations)
-        code_dictionary['time_calls'] = '\n'.join(['\n'.join(calls[block]) for block in range(self.nblocks)])
+        # First the inner computation calls. The spatial and the temporal calls are kept apart, so that any diagnostics that reuse
+        # the spatial work arrays can be computed between them (see get_diagnostic_kernels).
+        spatial_calls = self.get_block_computation_kernels([self.spatial_discretisation[block].computations for block in range(self.nblocks)])
+        temporal_calls = self.get_block_computation_kernels([self.temporal_discretisation[block].computations for block in range(self.nblocks)])
+        self.stage_calls = [[spatial_calls[block], [], temporal_calls[block]] for block in range(self.nblocks)]
+        code_dictionary['time_calls'] = '\n'.join(['\n'.join(flatten(self.stage_calls[block])) for block in range(self.nblocks)])
 
         # Computations at the start of the time stepping loop
         computations = [self.temporal_discretisation[block].start_computations if self.temporal_discretisation[block].start_computations else [] for block in range(self.nblocks)]
         calls = self.get_block_computation_kernels(computations)
+        calls = [self.time_step_calls(block) + calls[block] for block in range(self.nblocks)]
         code_dictionary['time_start_calls'] = '\n'.join(['\n'.join(calls[block]) for block in range(self.nblocks)])
 
         # Computations at the end of the time stepping loop
         computations = [self.temporal_discretisation[block].end_computations if self.temporal_discretisation[block].end_computations else [] for block in range(self.nblocks)]
         calls = self.get_block_computation_kernels(computations)
         code_dictionary['time_end_calls'] = '\n'.join(['\n'.join(calls[block]) for block in range(self.nblocks)])
+        if not self.temporal_discretisation[0].constant_dt:
+            dt = ccode(self.temporal_discretisation[0].dt)
+            code_dictionary['time_end_calls'] += '\n%s = %s + %s%s' % (self.simulation_time, self.simulation_time, dt, self.end_of_statement)
 
         # computations for the initialisation, if there are computations, later this should be included to read from file
         computations = [self.initial_conditions[block].computations if self.initial_conditions[block].computations else [] for block in range(self.nblocks)]
@@ -371,56 +717,226 @@ class OPSC(object):
 
         # Reduction declarations
         code_dictionary['declare_reductions'] = '\n'.join(self.declare_reduction_variables())
+        if not self.temporal_discretisation[0].constant_dt:
+            code_dictionary['declare_reductions'] += '\n%s %s = 0.0%s' % (self.accumulation_dtype, self.simulation_time, self.end_of_statement)
 
         # Write the main file
         code_template = code_template.safe_substitute(code_dictionary)
         self.write_main_file(code_template)
+
+        # Record what has been written
+        self.update_manifest()
         return
 
+    @profiled("Kernel fusion")
+    def fuse_computations(self):
+        """ Fuse the consecutive kernels in each list of computations where this is safe (see fuse_kernels).
+
+        :returns: None
+        """
+        from .kernel import fuse_kernels
+        from .diagnostics import Reduction
+
+        for block in range(self.nblocks):
+            grid = self.grid[block]
+            temporal = self.temporal_discretisation[block]
+            objects = [(self.spatial_discretisation[block], 'computations'), (temporal, 'computations'), (temporal, 'start_computations'),
+                       (temporal, 'end_computations'), (self.initial_conditions[block], 'computations')]
+            if self.diagnostics:
+                objects += [(diagnostic, 'computations') for diagnostic in self.diagnostics[block] if isinstance(diagnostic, Reduction)]
+            for instance, attribute in objects:
+                computations = getattr(instance, attribute)
+                if computations:
+                    fused = fuse_kernels(computations, grid)
+                    LOG.debug("Fused %d computations into %d." % (len(computations), len(fused)))
+                    profiler.count('computations before fusion', len(computations))
+                    profiler.count('computations after fusion', len(fused))
+                    setattr(instance, attribute, fused)
+        return
+
+    @profiled("Range inference")
+    def minimise_computation_ranges(self):
+        """ Shrink the ranges of the time-stepping kernels of each block to the points that are read by the other computations.
+        The points of an array that are read are found from the ranges of the kernels which read it and the stencils they read it with
+        (see halo_depths). The boundary conditions are applied after each stage, so the halo points of an array are not read from
+        the time-stepping kernels if the boundary conditions overwrite the halo points of the array on every face of the block.
+        Shrinking the range of one kernel may reduce the points that another kernel needs to write (e.g. the 'old' arrays of the
+        Runge-Kutta scheme), so this is repeated until none of the ranges change. The points saved in each stage, and at the start of
+        each time-step, are recorded in the range report.
+
+        :returns: None
+        """
+        from .bcs import ExchangeSelf
+        from .kernel import Kernel
+
+        def points(ranges):
+            return Mul(*[end - start for start, end in ranges])
+
+        for block in range(self.nblocks):
+            grid = self.grid[block]
+            temporal = self.temporal_discretisation[block]
+
+            # The arrays whose halo points are overwritten by the boundary conditions on every face of the block.
+            faces = []
+            for computation in self.boundary_condition[block].computations:
+                if isinstance(computation, ExchangeSelf):
+                    faces.append(set([str(a.base) for a in computation.transfer_arrays]))
+                elif isinstance(computation, Kernel):
+                    faces.append(set([str(a) for a in computation.outputs.keys() + computation.inputoutput.keys()]))
+                else:
+                    faces.append(set())
+            refreshed = set.intersection(*faces) if faces else set()
+
+            stage = temporal.computations or []
+            start = temporal.start_computations or []
+            readers = [c for c in self.get_computations(block) if isinstance(c, Kernel)]
+            before = dict([(kernel, points(kernel.ranges)) for kernel in stage + start])
+
+            changed = True
+            while changed:
+                changed = False
+                for kernel in stage + start:
+                    depths = [(0, 0) for s in grid.shape]
+                    written = [str(a) for a in kernel.outputs.keys() + kernel.inputoutput.keys() if a.is_grid]
+                    for reader in readers:
+                        if reader is kernel:
+                            continue
+                        for array, indices in reader.inputs.items() + reader.inputoutput.items():
+                            if array.is_grid and str(array) in written and str(array) not in refreshed:
+                                read = halo_depths(reader.ranges, indices, grid.shape)
+                                depths = [(min(d[0], r[0]), max(d[1], r[1])) for d, r in zip(depths, read)]
+                    # The ranges are only ever shrunk.
+                    ranges = []
+                    for (start_point, end_point), depth, s in zip(kernel.ranges, depths, grid.shape):
+                        needed = (0 + depth[0], s + depth[1])
+                        ranges.append(tuple([needed[0] if sympify(needed[0] - start_point).is_positive else start_point,
+                                             needed[1] if sympify(needed[1] - end_point).is_negative else end_point]))
+                    if ranges != list(kernel.ranges):
+                        kernel.ranges = ranges
+                        changed = True
+
+            report = {'stage': expand(sum([before[kernel] - points(kernel.ranges) for kernel in stage])),
+                      'time-step': expand(sum([before[kernel] - points(kernel.ranges) for kernel in start]))}
+            self.range_report[block] = report
+            LOG.info("Block %d: the minimal ranges of the time-stepping kernels save %s points in each stage and %s points at the start of each time-step."
+                     % (block, report['stage'], report['time-step']))
+        return
+
+    def get_computations(self, block):
+        """ Return all the computations of a block, including the boundary conditions and the diagnostics.
+
+        :arg int block: The block number.
+        :returns: The computations.
+        :rtype: list
+        """
+        temporal = self.temporal_discretisation[block]
+        computations = (self.initial_conditions[block].computations or []) + (self.spatial_discretisation[block].computations or []) + \
+            (temporal.start_computations or []) + (temporal.computations or []) + (temporal.end_computations or []) + \
+            [c for c in self.boundary_condition[block].computations or [] if c is not None]
+        if temporal.time_step_computation:
+            computations.append(temporal.time_step_computation)
+        if self.diagnostics:
+            for diagnostic in self.diagnostics[block]:
+                computations += diagnostic.computations
+        return computations
+
+    @profiled("Work array allocation")
+    def allocate_work_arrays(self):
+        """ Reuse the work arrays of each block whose lifetimes do not overlap. The kernels are renamed in place, before any code is generated.
+        The number of work arrays before and after, and the maximum number that are live at once, are recorded in the work array report.
+
+        :returns: None
+        """
+        from .kernel import Kernel
+        from .diagnostics import Reduction
+
+        for block in range(self.nblocks):
+            # The sequences of kernels, in the order they are executed.
+            temporal = self.temporal_discretisation[block]
+            # The reductions computed in the first stage run between the spatial and the temporal computations (see get_diagnostic_kernels).
+            reductions = [diagnostic for diagnostic in self.diagnostics[block] if isinstance(diagnostic, Reduction)] if self.diagnostics else []
+            in_stage = [computation for diagnostic in reductions if diagnostic.in_stage for computation in diagnostic.computations]
+            stage = (self.spatial_discretisation[block].computations or []) + in_stage + (temporal.computations or [])
+            stage += self.boundary_condition[block].computations or []
+            sequences = [self.initial_conditions[block].computations or [], temporal.start_computations or [], stage,
+                         temporal.end_computations or []]
+            sequences += [diagnostic.computations for diagnostic in reductions if not diagnostic.in_stage]
+            sequences = [[c for c in sequence if isinstance(c, Kernel)] for sequence in sequences]
+
+            arrays = set([str(a) for sequence in sequences for kernel in sequence
+                          for a in kernel.inputs.keys() + kernel.outputs.keys() + kernel.inputoutput.keys()])
+            work_arrays = set([a for a in arrays if re.match(r'^wk\d+$', a)])
+            allocations, peak = allocate_work_arrays(sequences, work_arrays)
+
+            for sequence, allocation in zip(sequences, allocations):
+                for kernel, arrays in zip(sequence, allocation):
+                    kernel.rename_arrays(dict([(name, array) for name, array in arrays.items() if name != array]), self.grid[block])
+
+            after = set([array for allocation in allocations for arrays in allocation for array in arrays.values()])
+            report = {'before': len(work_arrays), 'after': len(after), 'peak': peak}
+            self.work_array_report[block] = report
+            LOG.info("Block %d uses %d work arrays rather than %d (at most %d are live at once)." % (block, report['after'], report['before'], report['peak']))
+            profiler.count('work arrays before', report['before'])
+            profiler.count('work arrays after', report['after'])
+        return
+
+    @profiled("Diagnostics")
     def get_diagnostic_kernels(self, code_dictionary):
         """ Loop over blocks, loop over each diagnostics object (can be reduction etc.), and get the kernel call.
-        If it is a Reduction, get the reduction result and write the output to a file. """
+        If it is a Reduction, get the reduction result and write the output to a file. A Reduction that reuses the spatial work arrays
+        is computed in the first stage of the time-step, just after the spatial computations, when it reports the state at the start of the time-step. """
 
         from .diagnostics import Reduction as R
         for block in range(self.nblocks):
             for diagnostic in self.diagnostics[block]:
                 if isinstance(diagnostic, R):
+                    # The time of the state that the reductions are computed from
+                    time = self.simulation_time
+                    if diagnostic.in_stage and self.temporal_discretisation[block].constant_dt:
+                        time = 'iteration*deltat'
                     calls = []
                     for computation in diagnostic.computations:
                         calls += self.kernel_call(computation)
                         if computation.reductions:
                             calls += self.get_reduction_results(computation.reductions)
-                            calls += self.print_reduction_results(computation.reductions)
+                            calls += self.print_reduction_results(computation.reductions, time)
                     if diagnostic.compute_every:
-                        condition = ccode(Mod('iteration', diagnostic.compute_every))
-                        calls = ['if(%s == 0)' % condition] + [self.left_brace] + calls
+                        condition = '%s == 0' % ccode(Mod('iteration', diagnostic.compute_every))
+                        if diagnostic.in_stage and self.temporal_discretisation[block].nstages > 1:
+                            condition += ' && %s == 0' % self.temporal_discretisation[block].scheme.stage
+                        calls = ['if(%s)' % condition] + [self.left_brace] + calls
                         calls += [self.right_brace]
-                        code_dictionary['io_time'] += '\n'.join(calls)
+                        if diagnostic.in_stage:
+                            self.stage_calls[block][1] += calls
+                        else:
+                            code_dictionary['io_time'] += '\n'.join(calls)
                     else:
                         code_dictionary['io_calls'] += '\n'.join(calls)
 
+        code_dictionary['time_calls'] = '\n'.join(['\n'.join(flatten(self.stage_calls[block])) for block in range(self.nblocks)])
         return code_dictionary
 
-    def print_reduction_results(self, reductions):
+    def print_reduction_results(self, reductions, time):
         """ Prints the reduction results, as these are called at the end of the simulation
         prints time + all reduction results in a single line"""
 
         template = "ops_printf(\"%s\\n\", %s)%s"
         all_reductions = '%g, ' + ', '.join([str('%g') for red in reductions])
-        all_reduction_results = '(iteration + 1)*deltat, ' + ', '.join([str('%s_reduction') % red for red in reductions])
+        all_reduction_results = '%s, ' % time + ', '.join([str('%s_reduction') % red for red in reductions])
         return [template % (all_reductions, all_reduction_results, self.end_of_statement)]
 
     def get_reduction_results(self, reductions):
         """ Returns the code for OPS reduction result"""
 
         template = "%s %s_reduction = 0.0%s \n ops_reduction_result(%s, &%s_reduction)%s"
-        return [template % (self.dtype, red, self.end_of_statement, red, red, self.end_of_statement)
+        return [template % (self.accumulation_dtype, red, self.end_of_statement, red, red, self.end_of_statement)
                 for red in reductions]
 
     def declare_reduction_variables(self):
         template = "ops_reduction %s = ops_decl_reduction_handle(sizeof(%s), \"%s\", \"reduction_%s\")%s"
-        return [template % (red, self.dtype, self.dtype, red, self.end_of_statement) for red in self.reduction_variables]
+        return [template % (red, self.accumulation_dtype, self.accumulation_dtype, red, self.end_of_statement) for red in self.reduction_variables]
 
+    @profiled("Constants")
     def initialise_constants(self):
         """ Initialise all constant values. """
 
@@ -438,9 +954,9 @@ class OPSC(object):
                 if constant.ranges != len(val):
                     raise ValueError("The indexed constant %s should have only %d values" % (constant, constant.ranges))
                 for r in range(constant.ranges):
-                    constant_initialisation += ["%s[%d] = %s%s" % (constant, r, ccode(val[r]), self.end_of_statement)]
+                    constant_initialisation += ["%s[%d] = %s%s" % (constant, r, ccode(val[r], dtype=self.dtype), self.end_of_statement)]
             else:
-                constant_initialisation += ["%s = %s%s" % (constant, ccode(val), self.end_of_statement)]
+                constant_initialisation += ["%s = %s%s" % (constant, ccode(val, dtype=self.dtype), self.end_of_statement)]
         return constant_initialisation
 
     def sort_constants(self, constant_dictionary, sorted_constants):
@@ -466,7 +982,9 @@ class OPSC(object):
         iter_count = 0
         while key_list:
             iter_count = iter_count+1
-            sorted_constants += [x for (x, y) in zipped if all(req in sorted_constants for req in y)]
+            # A constant may be required by name (e.g. a hoisted constant defined in terms of another one), so the names are compared.
+            sorted_names = set([str(constant) for constant in sorted_constants])
+            sorted_constants += [x for (x, y) in zipped if all(str(req) in sorted_names for req in y)]
             key_list = [key for key in constant_dictionary.keys() if key not in sorted_constants]
             requires_list = [constant_dictionary[key].atoms(Symbol) for key in key_list]
             zipped = zip(key_list, requires_list)
@@ -495,6 +1013,7 @@ class OPSC(object):
                 ops_const += ["ops_decl_const(\"%s\" , 1, \"%s\", &%s)%s" % (constant, self.dtype, constant, self.end_of_statement)]
         return ops_const
 
+    @profiled("Writing the main file")
     def write_main_file(self, code_template):
         """ Write the main .cpp file. The base name of the file will be the same as the simulation's name.
 
@@ -502,12 +1021,82 @@ class OPSC(object):
         :returns: None
         """
 
-        mainfile = open(self.CODE_DIR+'/'+'%s.cpp' % self.simulation_parameters["name"], 'w')
         code_template = self.indent_code(code_template)
-        mainfile.write(code_template)
-        mainfile.close()
+        self.write_file('%s.cpp' % self.simulation_parameters["name"], code_template)
+        return
+
+    def write_file(self, filename, code):
+        """ Write code to a file in the code directory. The file is left untouched if it already contains exactly the same code,
+        so that its modification time is kept and it is not needlessly translated or compiled again.
+
+        :arg str filename: The name of the file.
+        :arg str code: The code to write.
+        :returns: True if the file was written, or False if it was unchanged.
+        :rtype: bool
+        """
+
+        path = self.CODE_DIR + '/' + filename
+        self.fingerprints['files'][filename] = fingerprint(code)
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                if fingerprint(f.read()) == self.fingerprints['files'][filename]:
+                    LOG.debug("The file %s is unchanged." % filename)
+                    return False
+        with open(path, 'w') as f:
+            f.write(code)
+        return True
+
+    def load_manifest(self):
+        """ Load the manifest of the code last written to the code directory.
+
+        :returns: The manifest, which is empty if there is no (readable) manifest.
+        :rtype: dict
+        """
+
+        manifest = {'files': {}, 'kernels': {}, 'translated': None}
+        if os.path.exists(self.manifest_path):
+            try:
+                with open(self.manifest_path, 'r') as f:
+                    manifest.update(json.load(f))
+            except ValueError:
+                LOG.warning("Ignoring the unreadable manifest %s" % self.manifest_path)
+        return manifest
+
+    def save_manifest(self):
+        """ Write the manifest to the code directory. """
+        with open(self.manifest_path, 'w') as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+        return
+
+    def update_manifest(self):
+        """ Compare the fingerprints of the code just written with those in the manifest, and then update the manifest. """
+
+        kernels = self.fingerprints['kernels']
+        changed = [name for name in kernels.keys() if self.manifest['kernels'].get(name) != kernels[name]]
+        files = self.fingerprints['files']
+        written = [name for name in files.keys() if self.manifest['files'].get(name) != files[name]]
+        LOG.info("%d of the %d kernels and %d of the %d files have changed since the code was last generated." % (len(changed), len(kernels), len(written), len(files)))
+        self.manifest['kernels'] = kernels
+        self.manifest['files'] = files
+        self.save_manifest()
         return
 
+    def code_fingerprint(self):
+        """ Return the fingerprint of all the code files together.
+
+        :rtype: str
+        """
+        return fingerprint(repr(sorted(self.fingerprints['files'].items())))
+
+    def is_translated(self):
+        """ Return True if exactly the same code was successfully translated by the OPS translator before, and the translated code still exists.
+
+        :rtype: bool
+        """
+
+        translated = self.CODE_DIR + '/%s_ops.cpp' % self.simulation_parameters["name"]
+        return self.manifest['translated'] == self.code_fingerprint() and os.path.exists(translated)
+
     def indent_code(self, code_lines):
         """ Indent the code.
 
@@ -519,6 +1108,7 @@ class OPSC(object):
         p = CCodePrinter()
         return p.indent_code(code_lines)
 
+    @profiled("Boundary conditions")
     def update_boundary_conditions(self, code_dictionary):
         """ Generate OPSC code to affect a boundary condition update.
 
@@ -526,28 +1116,37 @@ class OPSC(object):
         :returns: The updated/modified code dictionary.
         :rtype: dict
         """
-        from .bcs import ExchangeSelf
+        from .bcs import ExchangeSelf, exchange_edges_and_corners
         from .kernel import Kernel
 
         bc_call = [[] for block in range(self.nblocks)]
         bc_exchange_code = [[] for block in range(self.nblocks)]
 
         for block in range(self.nblocks):
-            for computation in self.boundary_condition[block].computations:
-                if isinstance(computation, Kernel):
-                    bc_call[block] += self.kernel_call(computation)
-                elif isinstance(computation, ExchangeSelf):
-                    call, code = self.bc_exchange_call_code(computation)
+            # Consecutive exchanges are batched into a single halo group, which is transferred with one call.
+            computations = self.boundary_condition[block].computations
+            for is_exchange, group in groupby(computations, lambda c: isinstance(c, ExchangeSelf)):
+                group = list(group)
+                if is_exchange:
+                    call, code = self.bc_exchange_call_code(exchange_edges_and_corners(group, self.grid[block]), block)
+                    LOG.debug("Batched %d exchanges into a single halo transfer." % len(group))
+                    profiler.count('halo transfers before batching', len(group))
+                    profiler.count('halo transfers after batching', 1)
                     bc_call[block] += call
                     bc_exchange_code[block] += code
-                else:
-                    raise ValueError("Boundary condition of type %s cannot be classified" % (type(computation)))
+                    continue
+                for computation in group:
+                    if isinstance(computation, Kernel):
+                        bc_call[block] += self.kernel_call(computation)
+                    else:
+                        raise ValueError("Boundary condition of type %s cannot be classified" % (type(computation)))
 
         # Update the code dictionary
         code_dictionary['bc_exchange'] = '\n'.join(['\n'.join(bc_exchange_code[block]) for block in range(self.nblocks)])
         code_dictionary['bc_calls'] = '\n'.join(['\n'.join(bc_call[block]) for block in range(self.nblocks)])
         return code_dictionary
 
+    @profiled("IO")
     def get_io(self, code_dictionary):
         """ As of now IO is performed only at the end of the simulation. No intermediate dumps are allowed.
 
@@ -582,6 +1181,7 @@ class OPSC(object):
         code_dictionary['io_time'] = '\n'.join(['\n'.join(io_time[block]) for block in range(self.nblocks)])
         return code_dictionary
 
+    @profiled("Kernel calls")
     def get_block_computation_kernels(self, instances):
         """ Get all computational kernel calls for each block.
 
@@ -596,6 +1196,31 @@ class OPSC(object):
                     calls[block] += self.kernel_call(instance)
         return calls
 
+    def time_step_calls(self, block):
+        """ Get the calls that compute the time-step at the start of each time-step, if the time-step is not constant.
+        The maximum over the grid of the wave speed over the grid point spacing is found with a reduction, and the time-step
+        is the CFL number divided by this maximum.
+
+        :arg int block: The block number.
+        :returns: The OPSC code lines computing the time-step.
+        :rtype: list
+        """
+
+        temporal = self.temporal_discretisation[block]
+        if temporal.constant_dt:
+            return []
+
+        computation = temporal.time_step_computation
+        reduction = computation.reductions[0]
+        # The time-step is set before it is first used, so its initial value does not matter.
+        self.simulation_parameters[str(temporal.dt.base)] = [0.0]
+        self.constants.add(temporal.cfl)
+
+        calls = self.kernel_call(computation)
+        calls += self.get_reduction_results([reduction])
+        calls += ['%s = %s/%s_reduction%s' % (ccode(temporal.dt), temporal.cfl, reduction, self.end_of_statement)]
+        return calls
+
     def kernel_call(self, computation):
         """ Generate an OPS kernel call via the ops_par_loop function.
 
@@ -627,7 +1252,7 @@ class OPSC(object):
                    for inp, value in computation.inputoutput.iteritems() if not inp.is_grid]
         # Reductions
         if computation.reductions:
-            nongrid += [self.ops_argument_reduction(inp, self.ops_access['reduction'])
+            nongrid += [self.ops_argument_reduction(inp, self.ops_reduction_access[inp.reduction_type])
                         for inp in computation.reductions if isinstance(inp, ReductionVariable)]
 
         if computation.has_Idx:
@@ -718,13 +1343,31 @@ class OPSC(object):
 
     def ops_argument_call(self, array, stencil, precision, access_type):
         template = 'ops_arg_dat(%s, %d, %s, \"%s\", %s)'
-        return template % (array, 1, stencil, self.dtype, access_type)
+        return template % (array, 1, stencil, self.array_dtype(array), access_type)
 
     def ops_argument_reduction(self, name, access_type):
         template = 'ops_arg_reduce(%s, %d, \"%s\", %s)'
-        return template % (name, 1, self.dtype, access_type)
+        return template % (name, 1, self.accumulation_dtype, access_type)
+
+    def array_dtype(self, array):
+        """ Return the data type of a grid-based array, which depends on whether it accumulates the time-stepping updates.
 
-    def bc_exchange_call_code(self, instance):
+        :arg array: The array (or its name).
+        :returns: The C type of the array.
+        :rtype: str
+        """
+        if str(array) in self.accumulation_arrays:
+            return self.accumulation_dtype
+        return self.dtype
+
+    def bc_exchange_call_code(self, instances, block_number=0):
+        """ Generate the OPSC code for a group of exchange boundary conditions, which are declared as a single OPS halo group
+        and transferred with a single call. The transfers of a group must not depend on each other (see exchange_edges_and_corners).
+
+        :arg list instances: The ExchangeSelf objects to transfer.
+        :returns: The call to the halo transfer and the code declaring the halo group.
+        :rtype: (list, list)
+        """
         off = 0
         halo = 'halo'
         # Name of the halo exchange
@@ -733,16 +1376,20 @@ class OPSC(object):
         code = ['%s Boundary condition exchange code' % self.line_comment]
         code += ['ops_halo_group %s %s' % (name, self.end_of_statement)]
         code += [self.left_brace]
-        code += ['int halo_iter[] = {%s}%s' % (', '.join([str(s) for s in instance.transfer_size]), self.end_of_statement)]
-        code += ['int from_base[] = {%s}%s' % (', '.join([str(s) for s in instance.transfer_from]), self.end_of_statement)]
-        code += ['int to_base[] = {%s}%s' % (', '.join([str(s) for s in instance.transfer_to]), self.end_of_statement)]
         # dir in OPSC. FIXME: Not sure what it is, but 1 to ndim works.
-        code += ['int dir[] = {%s}%s' % (', '.join([str(ind+1) for ind in range(len(instance.transfer_to))]), self.end_of_statement)]
-        # Process the arrays
-        for arr in instance.transfer_arrays:
-            code += ['ops_halo %s%d = ops_decl_halo(%s, %s, halo_iter, from_base, to_base, dir, dir)%s'
-                     % (halo, off, arr.base, arr.base, self.end_of_statement)]
-            off = off+1
+        code += ['int dir[] = {%s}%s' % (', '.join([str(ind+1) for ind in range(len(instances[0].transfer_to))]), self.end_of_statement)]
+        for number, instance in enumerate(instances):
+            code += ['int halo_iter%d[] = {%s}%s' % (number, ', '.join([str(s) for s in instance.transfer_size]), self.end_of_statement)]
+            code += ['int from_base%d[] = {%s}%s' % (number, ', '.join([str(s) for s in instance.transfer_from]), self.end_of_statement)]
+            code += ['int to_base%d[] = {%s}%s' % (number, ', '.join([str(s) for s in instance.transfer_to]), self.end_of_statement)]
+            # Process the arrays
+            for arr in instance.transfer_arrays:
+                code += ['ops_halo %s%d = ops_decl_halo(%s, %s, halo_iter%d, from_base%d, to_base%d, dir, dir)%s'
+                         % (halo, off, arr.base, arr.base, number, number, number, self.end_of_statement)]
+                for base in [instance.transfer_from, instance.transfer_to]:
+                    ranges = [(b, b + size) for b, size in zip(base, instance.transfer_size)]
+                    self.update_array_halos(arr.base, halo_depths(ranges, [[S.Zero for b in base]], self.grid[block_number].shape))
+                off = off+1
         code += ['ops_halo grp[] = {%s}%s' % (','.join([str('%s%s' % (halo, of)) for of in range(off)]), self.end_of_statement)]
         code += ['%s = ops_decl_halo_group(%d,grp)%s' % (name, off, self.end_of_statement)]
         code += [self.right_brace]
@@ -761,18 +1408,58 @@ class OPSC(object):
         dtype_int = 'int'
         if not self.multiblock:
             grid = self.grid[0]
-            code += [self.array(dtype_int, 'halo_p', [halo[1] for halo in grid.halos])]
-            code += [self.array(dtype_int, 'halo_m', [halo[0] for halo in grid.halos])]
             code += [self.array(dtype_int, 'size', grid.shape)]
             code += [self.array(dtype_int, 'base', [0 for g in grid.shape])]
+            # Each array is only declared with the halo points it is accessed at. The arrays with the same halos share the declaration of the halo depths.
+            halos = {}
+            for arr in sorted(self.grid_based_arrays, key=str):
+                depths = tuple(self.array_halos.get(str(arr), [(0, 0) for g in grid.shape]))
+                if depths not in halos:
+                    halos[depths] = len(halos)
+                    code += [self.array(dtype_int, 'halo_p%d' % halos[depths], [depth[1] for depth in depths])]
+                    code += [self.array(dtype_int, 'halo_m%d' % halos[depths], [depth[0] for depth in depths])]
+            self.report_halos(grid, halos)
             code += ['%s* val = NULL;' % (self.dtype)]
-            init_format = '%%s = ops_decl_dat(%s, 1, size, base, halo_m, halo_p, val, \"%%s\", \"%%s\")%s' % (self.block_name, self.end_of_statement)
-            inits = [init_format % (arr, self.dtype, arr) for arr in self.grid_based_arrays]
+            init_format = '%%s = ops_decl_dat(%s, 1, size, base, halo_m%%d, halo_p%%d, %%s, \"%%s\", \"%%s\")%s' % (self.block_name, self.end_of_statement)
+
+            def init(arr, pointer, dtype):
+                number = halos[tuple(self.array_halos.get(str(arr), [(0, 0) for g in grid.shape]))]
+                return init_format % (arr, number, number, pointer, dtype, arr)
+            inits = [init(arr, 'val', self.dtype) for arr in self.grid_based_arrays if self.array_dtype(arr) == self.dtype]
+            # The (NULL) data pointer of an array sets the size of its elements, so the arrays of the accumulation type need their own pointer.
+            accumulations = [arr for arr in self.grid_based_arrays if self.array_dtype(arr) != self.dtype]
+            if accumulations:
+                code += ['%s* accumulation_val = NULL;' % (self.accumulation_dtype)]
+                inits += [init(arr, 'accumulation_val', self.accumulation_dtype) for arr in accumulations]
             code = code + inits
         else:
             raise NotImplementedError("Multi-block is not implemented")
         return code
 
+    def report_halos(self, grid, halos):
+        """ Log how many of the grid based arrays need halo points, and the number of halo points that are saved in each array
+        compared with declaring every array with the halos of the grid.
+
+        :arg grid: The numerical grid of solution points.
+        :arg dict halos: The distinct halo depths of the arrays.
+        :returns: None
+        """
+        def points(depths):
+            return Mul(*[s + depth[1] - depth[0] for s, depth in zip(grid.shape, depths)]) - Mul(*grid.shape)
+
+        full = points(grid.halos)
+        saved = 0
+        without = 0
+        for arr in self.grid_based_arrays:
+            depths = self.array_halos.get(str(arr), [(0, 0) for g in grid.shape])
+            saved += full - points(depths)
+            if all(depth == (0, 0) for depth in depths):
+                without += 1
+        LOG.info("%d of the %d grid based arrays need no halo points; %d distinct halo depths are declared, saving %s halo points in total."
+                 % (without, len(self.grid_based_arrays), len(halos), expand(saved)))
+        profiler.count('arrays without halos', without)
+        return
+
     def declare_stencils(self):
         """ Declare all the stencils used in the code. We do not differentiate between the stencils for each block.
 
@@ -800,6 +1487,7 @@ class OPSC(object):
             code += variables_to_hdf5
         return code
 
+    @profiled("Kernel code")
     def get_block_computations(self):
         """ Get all the block computations to be performed.
         Extra stuff like diagnostic computations or boundary condition computations should be added here.
@@ -821,6 +1509,8 @@ class OPSC(object):
                 block_computations += self.temporal_discretisation[block].start_computations
             if self.temporal_discretisation[block].end_computations:
                 block_computations += self.temporal_discretisation[block].end_computations
+            if self.temporal_discretisation[block].time_step_computation:
+                block_computations.append(self.temporal_discretisation[block].time_step_computation)
             if self.initial_conditions[block].computations:
                 block_computations += self.initial_conditions[block].computations
             if self.diagnostics:
@@ -829,8 +1519,11 @@ class OPSC(object):
             if self.boundary_condition[block].computations:
                 block_computations += [t for t in self.boundary_condition[block].computations if isinstance(t, Kernel)]
 
+            profiler.count_computations(block_computations)
             for computation in block_computations:
-                kernels[block] += self.kernel_computation(computation, block)
+                code = self.kernel_computation(computation, block)
+                self.fingerprints['kernels'][computation.name] = fingerprint('\n'.join(code))
+                kernels[block] += code
         return kernels
 
     def kernel_computation(self, computation, block_number):
@@ -850,9 +1543,9 @@ class OPSC(object):
 
         # Indexed objects based on the grid that are inputs/outputs or inouts. This is used to write the pointers to the kernel.
         # Grid-based objects
-        grid_based = ([self.ops_header['inputs'] % (self.dtype, inp) for inp in computation.inputs.keys() if inp.is_grid] +
-                      [self.ops_header['outputs'] % (self.dtype, inp) for inp in computation.outputs.keys() if inp.is_grid] +
-                      [self.ops_header['inputoutput'] % (self.dtype, inp) for inp in computation.inputoutput.keys() if inp.is_grid])
+        grid_based = ([self.ops_header['inputs'] % (self.array_dtype(inp), inp) for inp in computation.inputs.keys() if inp.is_grid] +
+                      [self.ops_header['outputs'] % (self.array_dtype(inp), inp) for inp in computation.outputs.keys() if inp.is_grid] +
+                      [self.ops_header['inputoutput'] % (self.array_dtype(inp), inp) for inp in computation.inputoutput.keys() if inp.is_grid])
 
         # Non grid-based objects
         nongrid = ([self.ops_header['inputs'] % (self.dtype, inp) for inp in computation.inputs.keys() if not inp.is_grid] +
@@ -862,7 +1555,7 @@ class OPSC(object):
         header += grid_based + nongrid
 
         if computation.reductions:
-            header += [self.ops_header['reduction'] % (self.dtype, inp) for inp in computation.reductions]
+            header += [self.ops_header['reduction'] % (self.accumulation_dtype, inp) for inp in computation.reductions]
         if computation.has_Idx:
             header += [self.ops_header['Idx'] % ('idx')]
 
@@ -871,8 +1564,24 @@ class OPSC(object):
         code = header
         ops_accs = self.get_OPS_ACC_number(computation)
 
-        for equation in computation.equations:
-            code_kernel, self.rational_constants = ccode(equation, ops_accs, self.rational_constants)
+        equations = computation.equations
+        if self.hoist_constants:
+            hoisted = []
+            for equation in equations:
+                rhs, self.rational_constants = hoist_constants(equation.rhs, set(computation.constants), self.rational_constants)
+                hoisted.append(Eq(equation.lhs, rhs))
+            equations = hoisted
+        if self.cse:
+            equations, before, after = common_subexpressions(equations)
+            LOG.debug("Common subexpression elimination in %s reduced the operations per grid point from %d to %d." % (computation.name, before, after))
+            self.operation_counts[computation.name] = (before, after)
+            profiler.count('operations before CSE', before)
+            profiler.count('operations after CSE', after)
+
+        for equation in equations:
+            # The reductions are evaluated in the type they are accumulated in.
+            dtype = self.accumulation_dtype if isinstance(equation.lhs, ReductionVariable) else self.dtype
+            code_kernel, self.rational_constants = ccode(equation, ops_accs, self.rational_constants, dtype)
             if isinstance(equation.lhs, GridVariable):
 
                 code += [self.dtype + ' ' + code_kernel + self.end_of_statement]
@@ -881,13 +1590,14 @@ class OPSC(object):
 
         code += [self.right_brace] + ['\n']
 
-        self.update_definitions(computation)
+        self.update_definitions(computation, block_number)
 
         # Update the kernel name index
         self.kernel_name_number[block_number] += 1
 
         return code
 
+    @profiled("Writing the kernel files")
     def write_computational_routines(self, kernels):
         """ Write the computational routines to files. """
         for block in range(self.nblocks):
@@ -895,9 +1605,7 @@ class OPSC(object):
             code_lines = ["#ifndef block_%d_KERNEL_H" % block + '\n' + "#define block_%d_KERNEL_H" % block + '\n']
             code_lines += kernels[block]
             code_lines += ["#endif"]
-            kernel_file = open(self.CODE_DIR + '/' + self.computational_routines_filename[block], 'w')
-            kernel_file.write('\n'.join(code_lines))
-            kernel_file.close()
+            self.write_file(self.computational_routines_filename[block], '\n'.join(code_lines))
         return
 
     def loop_open(self, var, range_of_loop):
@@ -1077,6 +1785,17 @@ class OPSC(object):
 
         return
 
+    def update_array_halos(self, array, depths):
+        """ Widen the halos of an array to (at least) the given depths.
+
+        :arg array: The array (or its name).
+        :arg list depths: The halo depths before and after the grid in each direction.
+        :returns: None
+        """
+        current = self.array_halos.get(str(array), [(0, 0) for d in depths])
+        self.array_halos[str(array)] = [(min(c[0], d[0]), max(c[1], d[1])) for c, d in zip(current, depths)]
+        return
+
     def to_list(self, var):
         """ Convert a non list object into a list.
 
@@ -1089,8 +1808,8 @@ class OPSC(object):
         else:
             return [var]
 
-    def update_definitions(self, computation):
-        """ Update the grid based arrays and constants to be declared. """
+    def update_definitions(self, computation, block_number):
+        """ Update the grid based arrays, their halo depths, and the constants to be declared. """
 
         arrays = set([inp for inp in computation.inputs.keys() if inp.is_grid] +
                      [inp for inp in computation.outputs.keys() if inp.is_grid] +
@@ -1105,6 +1824,10 @@ class OPSC(object):
                              if not isinstance(r, int)]))
 
         self.grid_based_arrays = self.grid_based_arrays.union(arrays)
+        for d in [computation.inputs, computation.outputs, computation.inputoutput]:
+            for array, indices in d.iteritems():
+                if array.is_grid:
+                    self.update_array_halos(array, halo_depths(computation.ranges, indices, self.grid[block_number].shape))
 
         self.constants = self.constants.union(constant_arrays).union(constants).union(self.rational_constants.values())\
             .union(const)
@@ -1146,6 +1869,7 @@ class OPSC(object):
         """
         return '%s %s[] = {%s}%s' % (dtype, name, ', '.join([str(s) for s in values]), self.end_of_statement)
 
+    @profiled("OPS translation")
     def translate(self):
         # Translate the generated code using the OPSC translator.
         LOG.debug("Translating OPSC code...")
@@ -1153,6 +1877,10 @@ class OPSC(object):
         if(exit_code != 0):
             # Something went wrong
             LOG.error("Unable to translate OPSC code. Check that OPS is installed.")
+        else:
+            # Record the code that has been translated, so that it need not be translated again.
+            self.manifest['translated'] = self.code_fingerprint()
+            self.save_manifest()
         return
 
 
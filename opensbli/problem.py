@@ -19,8 +19,11 @@
 #    along with OpenSBLI.  If not, see <http://www.gnu.org/licenses/>.
 
 import time
+import multiprocessing
 
 from .equations import *
+from .cache import ExpansionCache, ExpandedEquation, record, rebuild
+from .profiling import profiler
 
 import logging
 LOG = logging.getLogger(__name__)
@@ -30,32 +33,78 @@ class Problem(object):
 
     """ Describes the system we want to generate code for. """
 
-    def __init__(self, equations, substitutions, ndim, constants, coordinate_symbol, metrics, formulas):
-        """ Store problem parameters, and create Equation objects for each user-provided equation/formula written in Einstien notation. """
+    def __init__(self, equations, substitutions, ndim, constants, coordinate_symbol, metrics, formulas, cache=None, workers=1):
+        """ Store problem parameters, and create Equation objects for each user-provided equation/formula written in Einstien notation.
+
+        :arg cache: An ExpansionCache in which the expanded equations are stored and looked up. If True, a cache in the default location is used. If None, the equations are always expanded.
+        :arg int workers: The number of worker processes used to expand the equations and formulas concurrently. By default, the expansion is performed serially.
+        """
 
         self.substitutions = substitutions
         self.ndim = ndim
         self.constants = constants
         self.coordinate_symbol = coordinate_symbol
         self.metrics = metrics
+        if cache is True:
+            cache = ExpansionCache()
+        self.cache = cache
+        self.workers = workers
 
         LOG.info("Expanding equations...")
         start = time.time()
-        # expand the equations
-        self.equations = self.expand(equations)
-        # expand the formulas
-        self.formulas = self.expand(formulas)
+        with profiler.phase("Problem expansion"):
+            # expand the equations and the formulas together, so that they can all be expanded concurrently.
+            expanded = self.expand(list(equations) + list(formulas))
+            self.equations = expanded[:len(equations)]
+            self.formulas = expanded[len(equations):]
+            profiler.count('equations', len(self.equations))
+            profiler.count('formulas', len(self.formulas))
+            profiler.count('expanded equations', len(flatten(self.get_expanded(expanded))))
         end = time.time()
         LOG.debug('The time taken for tensor expansion of equations in %d Dimensions is %.2f seconds.' % (self.ndim, end - start))
+        if self.cache:
+            LOG.debug('The expansion cache had %d hits and %d misses, saving %.2f seconds.' % (self.cache.hits, self.cache.misses, self.cache.time_saved))
         return
 
     def expand(self, equations):
         """ Find the Einstein indices in the equations and formulas, and then expand them. """
 
+        if self.workers > 1 and len(equations) > 1:
+            return self.expand_concurrently(equations)
+
         expanded = []
         for e in equations:
-            expanded.append(Equation(e, self.ndim, self.coordinate_symbol, self.substitutions, self.constants))
+            if self.cache:
+                expanded.append(self.cache.expand(e, self.ndim, self.coordinate_symbol, self.substitutions, self.constants))
+            else:
+                expanded.append(Equation(e, self.ndim, self.coordinate_symbol, self.substitutions, self.constants))
+
+        return expanded
 
+    def expand_concurrently(self, equations):
+        """ Expand the equations in a pool of worker processes. The expanded equations are returned in the same order as the equations provided.
+        Any equations found in the cache are not expanded again. """
+
+        expanded = [None for e in equations]
+        if self.cache:
+            for number, e in enumerate(equations):
+                expanded[number] = self.cache.lookup(e, self.ndim, self.coordinate_symbol, self.substitutions, self.constants)
+        pending = [number for number, e in enumerate(equations) if expanded[number] is None]
+        if not pending:
+            return expanded
+
+        arguments = [(equations[number], self.ndim, self.coordinate_symbol, self.substitutions, self.constants) for number in pending]
+        pool = multiprocessing.Pool(min(self.workers, len(pending)))
+        try:
+            results = pool.map(expand_equation, arguments)
+        finally:
+            pool.close()
+            pool.join()
+
+        for number, (recorded, elapsed) in zip(pending, results):
+            expanded[number] = ExpandedEquation(equations[number], rebuild(recorded))
+            if self.cache:
+                self.cache.insert(equations[number], self.ndim, self.coordinate_symbol, self.substitutions, self.constants, expanded[number].expanded, elapsed)
         return expanded
 
     def get_expanded(self, equations):
@@ -66,3 +115,17 @@ class Problem(object):
             expanded_equations.append(e.expanded)
 
         return expanded_equations
+
+
+def expand_equation(arguments):
+    """ Expand a single equation. This is performed by each of the worker processes used in Problem.expand_concurrently.
+    The expansion is recorded before it is returned, so that it (and the attributes of the EinsteinTerms in it) survives the transfer between processes unchanged.
+
+    :arg tuple arguments: The arguments of the Equation to expand.
+    :returns: The recorded expansion and the time taken to perform it.
+    :rtype: tuple
+    """
+
+    start = time.time()
+    equation = Equation(*arguments)
+    return record(equation.expanded), time.time() - start
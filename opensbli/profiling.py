@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+#    OpenSBLI: An automatic code generator for solving differential equations.
+#    Copyright (C) 2016 Satya P. Jammy, Christian T. Jacobs, Neil D. Sandham
+
+#    This file is part of OpenSBLI.
+
+#    OpenSBLI is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    OpenSBLI is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with OpenSBLI.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import time
+import json
+import functools
+from contextlib import contextmanager
+
+from sympy import count_ops
+
+import logging
+LOG = logging.getLogger(__name__)
+
+try:
+    import resource
+except ImportError:
+    # The resource module is only available on Unix platforms.
+    resource = None
+
+
+def peak_rss():
+    """ Return the peak resident set size of the process so far.
+
+    :returns: The peak resident set size in megabytes, or None if it cannot be measured.
+    :rtype: float
+    """
+    if resource is None:
+        return None
+    # ru_maxrss is in bytes on macOS, and in kilobytes on Linux.
+    scale = 1024.0*1024.0 if sys.platform == 'darwin' else 1024.0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/scale
+
+
+class Profiler(object):
+
+    """ Records the wall time, the peak memory usage and any counts (e.g. the number of kernels) of each phase of the code generation.
+    Phases can be nested; each phase is recorded in the order it starts. Profiling is disabled by default. To profile the code generation, use
+
+        from opensbli.profiling import profiler
+        profiler.enable()
+        ... (set up the problem and generate the code as usual)
+        profiler.write("profile.json")
+        print profiler.table()
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+        return
+
+    def enable(self):
+        """ Start recording the phases. """
+        self.enabled = True
+        return
+
+    def disable(self):
+        """ Stop recording the phases. The phases recorded so far are kept. """
+        self.enabled = False
+        return
+
+    def reset(self):
+        """ Discard all the phases recorded so far. """
+        self.phases = []
+        self.stack = []
+        return
+
+    @contextmanager
+    def phase(self, name):
+        """ Record a phase of the code generation, i.e. the code executed within the 'with' statement.
+
+        :arg str name: The name of the phase.
+        """
+
+        if not self.enabled:
+            yield None
+            return
+        record = {'name': name, 'depth': len(self.stack), 'time': 0.0, 'peak_rss': None, 'counts': {}}
+        self.phases.append(record)
+        self.stack.append(record)
+        start = time.time()
+        try:
+            yield record
+        finally:
+            record['time'] = time.time() - start
+            record['peak_rss'] = peak_rss()
+            self.stack.pop()
+            LOG.debug("%s took %.2f seconds." % (name, record['time']))
+        return
+
+    def count(self, name, value=1):
+        """ Add to a count of the current phase.
+
+        :arg str name: The name of the count (e.g. 'kernels').
+        :arg int value: The amount to add to the count.
+        :returns: None
+        """
+
+        if self.enabled and self.stack:
+            counts = self.stack[-1]['counts']
+            counts[name] = counts.get(name, 0) + value
+        return
+
+    def count_computations(self, computations):
+        """ Count the kernels in a list of computations, and the operations in the equations they evaluate.
+
+        :arg list computations: The computations (e.g. Kernel objects).
+        :returns: None
+        """
+
+        if not (self.enabled and self.stack):
+            return
+        from .kernel import Kernel
+        kernels = [c for c in computations if isinstance(c, Kernel)]
+        self.count('kernels', len(kernels))
+        self.count('equations', sum([len(k.equations) for k in kernels]))
+        self.count('operations', sum([count_ops(eq.rhs) for k in kernels for eq in k.equations]))
+        return
+
+    def report(self):
+        """ Return the recorded phases.
+
+        :returns: The phases, each with its name, depth of nesting, wall time (in seconds), peak resident set size (in megabytes) and counts.
+        :rtype: list
+        """
+        return [dict(record) for record in self.phases]
+
+    def write(self, filename):
+        """ Write the report to a file in JSON format.
+
+        :arg str filename: The name of the file.
+        :returns: None
+        """
+
+        with open(filename, 'w') as f:
+            json.dump({'phases': self.report()}, f, indent=1, sort_keys=True)
+        return
+
+    def table(self):
+        """ Return the report as a human-readable table. Nested phases are indented below the phase they belong to.
+
+        :returns: The table.
+        :rtype: str
+        """
+
+        width = max([len(record['name']) + 2*record['depth'] for record in self.phases] + [len('Phase')])
+        lines = ['%s  %10s  %14s  %s' % ('Phase'.ljust(width), 'Time (s)', 'Peak RSS (MB)', 'Counts')]
+        for record in self.phases:
+            name = ('  '*record['depth'] + record['name']).ljust(width)
+            rss = '%14.1f' % record['peak_rss'] if record['peak_rss'] is not None else '%14s' % '-'
+            counts = ', '.join(['%s=%d' % (key, record['counts'][key]) for key in sorted(record['counts'].keys())])
+            lines.append('%s  %10.2f  %s  %s' % (name, record['time'], rss, counts))
+        return '\n'.join(lines)
+
+
+def profiled(name):
+    """ A decorator that records each call of a function or method as a phase of the code generation.
+
+    :arg str name: The name of the phase.
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with profiler.phase(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# The profiler used throughout OpenSBLI.
+profiler = Profiler()
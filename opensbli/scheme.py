@@ -18,6 +18,43 @@
 #    You should have received a copy of the GNU General Public License
 #    along with OpenSBLI.  If not, see <http://www.gnu.org/licenses/>
 
+from sympy import Add, Integer, S, finite_diff_weights
+
+# The finite difference weights computed so far, keyed on the order of the derivative and the points of the stencil.
+FD_WEIGHTS = {}
+
+
+def fd_weights(order, points):
+    """ Return the weights of the finite difference approximation to a derivative. The weights only depend on the order of the derivative
+    and the points of the stencil, so they are computed once (with Fornberg's algorithm, as implemented in SymPy's finite_diff_weights)
+    and looked up thereafter.
+
+    :arg int order: The order of the derivative.
+    :arg list points: The offsets of the points of the stencil (in grid points) from the point at which the derivative is evaluated.
+    :returns: The exact (rational) weight of each point of the stencil.
+    :rtype: tuple
+    """
+
+    key = (order, tuple(points))
+    if key not in FD_WEIGHTS:
+        FD_WEIGHTS[key] = tuple(finite_diff_weights(order, [Integer(point) for point in points], S.Zero)[order][-1])
+    return FD_WEIGHTS[key]
+
+
+def fd_formula(expression, wrt, order, points):
+    """ Return the finite difference approximation to the derivative of an expression, with the grid spacing taken as one.
+    The expression is evaluated at each point of the stencil by substituting the shifted grid index.
+
+    :arg expression: The expression to differentiate.
+    :arg wrt: The grid index with respect to which the expression is differentiated.
+    :arg int order: The order of the derivative.
+    :arg list points: The offsets of the points of the stencil (in grid points) from the point at which the derivative is evaluated.
+    :returns: The finite difference formula.
+    """
+
+    weights = fd_weights(order, points)
+    return Add(*[weight*expression.subs({wrt: wrt + point}) for weight, point in zip(weights, points) if weight != 0])
+
 
 class Scheme(object):
 
@@ -29,6 +29,8 @@ from .utils import *
 from .kernel import *
 from .scheme import *
 from .evaluations import *
+from .catalog import ExpressionCatalog
+from .profiling import profiler, profiled
 
 
 class Central(Scheme):
@@ -45,35 +47,32 @@ class Central(Scheme):
         return
 
 
-class SpatialDerivative(object):
+class SpatialDerivative(SymbolicDerivative):
 
     """ The spatial derivatives of an arbitrary function 'F'
     on the numerical grid with the provided spatial scheme.
+    The formula of each derivative is obtained in the same way as a SymbolicDerivative.
 
     For a wall boundary condition this will have a dependency on the grid range. """
 
-    def __init__(self, spatial_scheme, grid, max_order):
+    def __init__(self, spatial_scheme, grid, max_order, direct_second_derivatives=False):
         """ Initialise the spatial derivative, which gives the equations
         of spatial Derivatives for the various combinations of the spatial scheme and order of accuracy.
 
         :arg spatial_scheme: The spatial discretisation scheme to use.
         :arg grid: The numerical grid of solution points.
         :arg int max_order: The maximum order of the derivative in the function.
+        :arg bool direct_second_derivatives: If True, the mixed second derivatives are evaluated directly (see SymbolicDerivative).
         :returns: None
         """
 
+        SymbolicDerivative.__init__(self, spatial_scheme, grid, direct_second_derivatives)
         self.stencil = self.create_stencil(spatial_scheme, grid)
-        self.points = spatial_scheme.points
 
-        self.derivatives = []
-        self.derivative_direction = grid.indices
-        self.index_mapping = grid.mapped_indices
-        self.deltas = grid.deltas
         base = IndexedBase('f', shape=grid.shape)
         base.is_grid = True
         base.is_constant = False
         fn = base[grid.indices]
-        self.fn = fn
 
         self.create_derivative_formulas(fn, max_order, grid)
         return
@@ -99,8 +98,9 @@ class SpatialDerivative(object):
         return stencil
 
     def create_derivative_formulas(self, fn, max_order, grid):
-        """ Create the formulas for the derivatives of the given function,
-        based on the stencil pattern provided.
+        """ Set up the formulas for the derivatives of the given function,
+        based on the stencil pattern provided. The formula of each derivative is only created when it is first used
+        (see get_derivative_entry), rather than creating the formulas for every combination of directions up front.
 
         :arg fn: The function whose differential needs computing.
         :arg int max_order: The maximum order of the derivative in the function.
@@ -108,123 +108,137 @@ class SpatialDerivative(object):
         :returns: None
         """
 
-        derivatives = []
-        derivatives += [fn]  # FIXME: Later change this to interpolation
-        derivative_formula = []
-        derivative_formula += [fn]
-        kernels = []
-        kernels += [fn]
-
-        # Create derivatives for each order, up to the maximum order of derivative that is present in the equation.
-        for order in range(1, max_order+1):
-            shape = tuple([len(grid.indices) for ind in range(order)])
-            array = MutableDenseNDimArray.zeros(*shape)
-            fdarray = MutableDenseNDimArray.zeros(*shape)
-            derivative_kernel = MutableDenseNDimArray.zeros(*shape)
-
-            for ind in numpy.ndindex(*array.shape):
-                # Arguments to the derivative in terms of grid indices
-                derivative_args = [grid.indices[i] for i in ind]
-                # The derivative kernel's name
-                name = [str(arg) for arg in ind]
-                name = "[%d][%s]" % (order, ','.join(name))
-                derivative_kernel[ind] = Symbol(name)
-
-                # Find the finite difference formula
-                array[ind] = fn.diff(*derivative_args)
-                if order == 1 or len(set(derivative_args)) == 1:
-                    fdarray[ind] = as_finite_diff(array[ind], self.stencil[ind[0]])*pow(grid.deltas[ind[0]], -order)
-                else:
-                    new_derivative = array[ind].subs(derivatives[order-1][ind[:-1]], derivative_formula[order-1][ind[:-1]])
-                    fdarray[ind] = as_finite_diff(new_derivative, self.stencil[ind[-1]], wrt=grid.indices[ind[-1]])*pow(grid.deltas[ind[-1]], -1)
-
-            derivatives.append(array)
-            derivative_formula.append(fdarray)
-            kernels.append(derivative_kernel)
-
-        self.derivatives = derivatives
-        self.derivative_formula = derivative_formula
-        self.derivative_kernel = kernels
+        self.fn = fn
+        self.max_order = max_order
+        # The derivative, its finite difference formula and its kernel's name, for each order and tuple of directions.
+        self.derivative_entries = {}
         return
 
-    def get_derivative_formula(self, derivative):
-        """ Returns the formula for the derivative function. """
-        order = len(derivative.args[1:])
-        indices = list(derivative.args[1:])
-        if order == 1 or len(set(indices)) == 1:
-            wrt = indices[0]
-            gridpoints = [wrt + i for i in self.points]
-            formula = apply_finite_diff(order, gridpoints, [derivative.expr.subs({wrt: x}) for x in gridpoints], wrt)
-            d1 = self.derivative_direction.index(self.index_mapping[derivative.args[1]])
-            delta = self.deltas[d1]
-            formula = formula*pow(delta, -order)
-        elif order == 2:
-            # Do the derivative of derivative
-            raise NotImplementedError("Derivatives of order == 2 are not implemented.")
-        else:
-            raise NotImplementedError("Derivatives of order > 2 are not implemented.")
-        return formula
-
-    def get_derivative(self, derivative):
-        """ Return a tuple to which the derivative formula exists in
-        the already-evaluated derivatives.
+    def get_derivative_entry(self, order, direction):
+        """ Return the derivative of the function in the given directions, its finite difference formula and the name of its kernel.
+        Each entry is created once and then reused.
 
-        :arg derivative: The derivative you want to get the formula for.
+        :arg int order: The order of the derivative.
+        :arg tuple direction: The direction (i.e. the dimension) of each of the derivatives (e.g. (0, 1) for the derivative with respect to x0 and x1).
+        :returns: The derivative, its finite difference formula and the name of its kernel.
+        :rtype: tuple
         """
-        order = len(derivative.args[1:])
-        indices = []
-        for arg in derivative.args[1:]:
-            indices = indices + [self.derivative_direction.index(self.index_mapping[arg])]
-        general_formula = []
-        subevals = []
-        requires = []
-        if order == 1 or len(set(indices)) == 1:
-            general_formula += [order, tuple(indices)]
-            if len(derivative.args[0].atoms(Indexed)) > 1:
-                subevals += [derivative.args[0]]
-                requires += list(derivative.args[0].atoms(Indexed))
-            else:
-                subevals += [None]
-                requires += list(derivative.args[0].atoms(Indexed))
-        else:
-            if len(derivative.args[0].atoms(Indexed)) > 1:
-                subevals += [derivative.args[0]]
-                requires += list(derivative.args[0].atoms(Indexed))
+
+        direction = tuple(direction)
+        if len(direction) != order:
+            raise ValueError("A derivative of order %d requires %d directions, not %d." % (order, order, len(direction)))
+        key = (order, direction)
+        if key not in self.derivative_entries:
+            # Arguments to the derivative in terms of grid indices
+            derivative_args = [self.derivative_direction[i] for i in direction]
+            # The derivative kernel's name
+            name = "[%d][%s]" % (order, ','.join([str(d) for d in direction]))
+            derivative = self.fn.diff(*derivative_args)
+            # Find the finite difference formula
+            if order == 1 or len(set(derivative_args)) == 1:
+                formula = fd_formula(self.fn, derivative_args[0], order, self.points)*pow(self.deltas[direction[0]], -order)
             else:
-                subevals += [None]
-                requires += [derivative.args[0]]
-            general_formula += [order-1, tuple([indices[-1]])]
-            requires += [Derivative(derivative.args[0], *derivative.args[1:-1])]
+                # The first derivative of the formula of the lower order derivative
+                lower = self.get_derivative_entry(order-1, direction[:-1])[1]
+                formula = fd_formula(lower, derivative_args[-1], 1, self.points)*pow(self.deltas[direction[-1]], -1)
+            self.derivative_entries[key] = (derivative, formula, Symbol(name))
+        return self.derivative_entries[key]
+
+    def get_derivative_tensors(self, entry):
+        """ Return the full tensor of one part of the derivative entries for each order, up to the maximum order of derivative.
+        This creates every entry that has not been used so far.
+
+        :arg int entry: The part of the entries (0 for the derivatives, 1 for the formulas and 2 for the kernel names).
+        :returns: The function itself, followed by the tensor for each order.
+        :rtype: list
+        """
+
+        tensors = [self.fn]  # FIXME: Later change this to interpolation
+        for order in range(1, self.max_order+1):
+            shape = tuple([len(self.derivative_direction) for ind in range(order)])
+            array = MutableDenseNDimArray.zeros(*shape)
+            for ind in numpy.ndindex(*shape):
+                array[ind] = self.get_derivative_entry(order, ind)[entry]
+            tensors.append(array)
+        return tensors
+
+    @property
+    def derivatives(self):
+        """ The derivatives of the function for each order, up to the maximum order of derivative. """
+        return self.get_derivative_tensors(0)
 
-        return general_formula, subevals, requires
+    @property
+    def derivative_formula(self):
+        """ The finite difference formulas of the derivatives for each order, up to the maximum order of derivative. """
+        return self.get_derivative_tensors(1)
+
+    @property
+    def derivative_kernel(self):
+        """ The names of the derivative kernels for each order, up to the maximum order of derivative. """
+        return self.get_derivative_tensors(2)
 
 
 class SpatialDiscretisation(object):
 
     """ The spatial discretisation using the provided scheme on the provided grid. """
 
-    def __init__(self, expanded_equations, expanded_formulas, grid, spatial_scheme):
+    @profiled("Spatial discretisation")
+    def __init__(self, expanded_equations, expanded_formulas, grid, spatial_scheme, inline_derivatives=None, direct_second_derivatives=False,
+                 group_derivative_kernels=False):
         """ Perform the spatial discretisation.
 
+        By default each spatial Derivative is evaluated into a work array by its own kernel, and the residual kernel reads the work arrays.
+        The first derivatives of stored quantities (i.e. of a single Indexed object) can instead be inlined, i.e. their finite difference
+        formulas are substituted directly into the residual kernel. This trades the recomputation of the formula for the memory traffic of
+        writing and reading a work array.
+
+        A repeated second derivative (e.g. Der(u0, x0, x0)) is always evaluated directly with the second derivative stencil. A mixed second derivative
+        (e.g. Der(u0, x0, x1)) is by default evaluated as the first derivative of the stored first derivative, which must then be evaluated over
+        the halo points too. It can instead be evaluated directly, with the product of the first derivative stencils in its two directions,
+        which needs neither the extra work array nor the extra kernel.
+
+        The derivatives of the same function (e.g. Der(u0, x0), Der(u0, x1) and Der(u0, x2)) can be evaluated by a single kernel,
+        so that the function is read once rather than once for each derivative.
+
+        The spatial Derivatives are first made canonical, so that e.g. Der(u0, x1, x0) and Der(u0, x0, x1), or Der(-rho*u0, x0) and Der(rho*u0, x0),
+        are evaluated once.
+
         :arg list expanded_equations: A list of the equations expanded with respect to the Einstein indices.
         :arg list expanded_formulas: A list of the formulas expanded with respect to the Einstein indices.
         :arg grid: The numerical grid of solution points.
         :arg spatial_scheme: The spatial scheme used to perform the spatial discretisation.
+        :arg inline_derivatives: The Derivatives to inline. This is either a list of Derivative objects, True to inline all the Derivatives
+        that can be inlined, or 'auto' to inline those that are used only once in the equations (so that no formula is evaluated more than once).
+        By default, no Derivative is inlined.
+        :arg bool direct_second_derivatives: If True, the mixed second derivatives are evaluated directly.
+        :arg bool group_derivative_kernels: If True, the derivatives of the same function over the same range are evaluated by a single kernel.
         :returns: None
         """
 
-        all_equations = flatten(expanded_equations)
-        all_formulas = flatten(expanded_formulas)
-        all_formulas = get_used_formulas(all_formulas, all_equations)
-        max_order = maximum_derivative_order(all_equations)
-
-        spatial_derivative = SpatialDerivative(spatial_scheme, grid, max_order)
-
-        spatial_derivatives, time_derivatives = get_derivatives(all_equations + all_formulas)
-
-        evaluations = {}
-        evaluations = create_formula_evaluations(all_formulas, evaluations)
-        evaluations = create_derivative_evaluations(spatial_derivatives, evaluations, spatial_derivative)
+        with profiler.phase("Derivative creation"):
+            all_equations = flatten(expanded_equations)
+            all_formulas = flatten(expanded_formulas)
+            all_equations, merged = canonicalise_derivatives(all_equations)
+            all_formulas, merged_formulas = canonicalise_derivatives(all_formulas)
+            merged += merged_formulas
+            if merged:
+                LOG.info("Merged %d spatial derivatives into their canonical forms." % merged)
+            profiler.count('merged derivatives', merged)
+            # Catalog the terms in the equations, and then in the formulas they use.
+            catalog = ExpressionCatalog(all_equations)
+            all_formulas = catalog.get_used_formulas(all_formulas)
+            max_order = catalog.maximum_order
+            catalog.add(all_formulas)
+
+            spatial_derivative = SpatialDerivative(spatial_scheme, grid, max_order, direct_second_derivatives)
+
+            spatial_derivatives, time_derivatives = catalog.get_derivatives()
+
+            evaluations = {}
+            evaluations = create_formula_evaluations(all_formulas, evaluations)
+            evaluations = create_derivative_evaluations(spatial_derivatives, evaluations, spatial_derivative)
+            profiler.count('formulas', len(all_formulas))
+            profiler.count('derivatives', len(spatial_derivatives))
 
         # We will assume that all the functions in time derivative are known at the start
         order_of_evaluations = []
@@ -234,45 +248,68 @@ class SpatialDiscretisation(object):
             evaluations[val] = evaluated
             order_of_evaluations += [val]
 
-        # Sort the terms in the order they should be evaluated (with respect to their dependencies).
-        # First get the primitive variables that the time derivatives are applied to (e.g. u_i in Der(u_i, t))
-        order_of_evaluations = sort_evaluations(order_of_evaluations, evaluations, Indexed)
-        # Then sort the derivatives
-        order_of_evaluations = sort_evaluations(order_of_evaluations, evaluations, Derivative)
-
-        # Update the range of evaluations for each evaluation
-        set_range_of_evaluations(order_of_evaluations, evaluations, grid)
-
-        work_array_index = 0
-        work_array_name = 'wk'
-        # update the work arrays
-        evaluations, work_array_index = update_work_arrays(order_of_evaluations, evaluations, work_array_name, work_array_index, grid)
-
-        self.computations = []
-        self.computations += create_formula_kernels(order_of_evaluations, evaluations, known, grid)
-        derivatives = [ev for ev in order_of_evaluations if isinstance(ev, Derivative) and ev not in known]
-        self.computations += create_derivative_kernels(derivatives, evaluations,
-                                                       spatial_derivative, work_array_name, work_array_index, grid)
-
-        # All the spatial computations are evaluated by this point. Now get the updated equations.
-        updated_equations = substitute_work_arrays(order_of_evaluations, evaluations, all_equations)
-
-        # The final computations of the residual (change in the RHS terms of the equations).
-        # The residual equations are also named as work arrays.
-        # The residual arrays are tracked for use in the evaluation of the temporal scheme.
-        residual_equations = []
-        residual_arrays = []
-        for e in updated_equations:
-            work_array = grid.work_array('%s%d' % (work_array_name, work_array_index))
-            work_array_index += 1
-            residual_arrays.append({e.lhs: work_array})
-            residual_equations.append(Eq(work_array, e.rhs))
-        evaluation_range = [tuple([0, s]) for s in grid.shape]
-        self.computations.append(Kernel(residual_equations, evaluation_range, "Residual of equation", grid))
+        with profiler.phase("Sorting"):
+            # Sort the terms in the order they should be evaluated (with respect to their dependencies).
+            self.evaluation_graph = EvaluationGraph(evaluations)
+            # First get the primitive variables that the time derivatives are applied to (e.g. u_i in Der(u_i, t))
+            order_of_evaluations = self.evaluation_graph.schedule(order_of_evaluations, Indexed)
+            # Then sort the derivatives
+            order_of_evaluations = self.evaluation_graph.schedule(order_of_evaluations, Derivative)
+
+        with profiler.phase("Range setting"):
+            # Update the range of evaluations for each evaluation
+            set_range_of_evaluations(order_of_evaluations, evaluations, grid)
+
+        with profiler.phase("Kernel creation"):
+            # The inlined Derivatives are evaluated in the residual kernel, so they need neither a work array nor a kernel of their own.
+            self.inlined_derivatives = self.select_inlined_derivatives(inline_derivatives, spatial_derivatives, all_equations)
+            for derivative in self.inlined_derivatives:
+                evaluations[derivative].work = spatial_derivative.get_derivative_formula(derivative)
+            if self.inlined_derivatives:
+                LOG.info("Inlined %d of the %d spatial derivatives into the residual kernel." % (len(self.inlined_derivatives), len(spatial_derivatives)))
+            profiler.count('inlined derivatives', len(self.inlined_derivatives))
+            stored_evaluations = [ev for ev in order_of_evaluations if ev not in self.inlined_derivatives]
+
+            work_array_index = 0
+            work_array_name = 'wk'
+            # update the work arrays
+            evaluations, work_array_index = update_work_arrays(stored_evaluations, evaluations, work_array_name, work_array_index, grid)
+
+            self.computations = []
+            self.computations += create_formula_kernels(order_of_evaluations, evaluations, known, grid)
+            derivatives = [ev for ev in stored_evaluations if isinstance(ev, Derivative) and ev not in known]
+            derivative_kernels = create_derivative_kernels(derivatives, evaluations, spatial_derivative, work_array_name, work_array_index,
+                                                           grid, group_derivative_kernels)
+            if group_derivative_kernels:
+                LOG.info("The %d derivatives are evaluated by %d kernels." % (len(derivatives), len(derivative_kernels)))
+            self.computations += derivative_kernels
+
+            # All the spatial computations are evaluated by this point. Now get the updated equations.
+            updated_equations = substitute_work_arrays(order_of_evaluations, evaluations, all_equations)
+
+            # The final computations of the residual (change in the RHS terms of the equations).
+            # The residual equations are also named as work arrays.
+            # The residual arrays are tracked for use in the evaluation of the temporal scheme.
+            residual_equations = []
+            residual_arrays = []
+            for e in updated_equations:
+                work_array = grid.work_array('%s%d' % (work_array_name, work_array_index))
+                work_array_index += 1
+                residual_arrays.append({e.lhs: work_array})
+                residual_equations.append(Eq(work_array, e.rhs))
+            evaluation_range = [tuple([0, s]) for s in grid.shape]
+            self.computations.append(Kernel(residual_equations, evaluation_range, "Residual of equation", grid))
+            profiler.count('work arrays', work_array_index)
+            profiler.count_computations(self.computations)
 
         # Update the residual arrays
         self.residual_arrays = residual_arrays
 
+        # The evaluation of each term and the index of the next free work array, so that other computations (e.g. diagnostics)
+        # can reuse the terms evaluated here and avoid the work arrays used here.
+        self.evaluations = evaluations
+        self.work_array_index = work_array_index
+
         # Vectors in the LHS of the equations, which are used for symmetry boundary conditions. These will be stored as
         # prognostic_classified in the temporal discretisation.
         self.lhs_vectors = []
@@ -284,3 +321,35 @@ class SpatialDiscretisation(object):
                 self.lhs_vectors += list(eq[0].lhs.atoms(Indexed))
 
         return
+
+    def select_inlined_derivatives(self, inline_derivatives, spatial_derivatives, equations):
+        """ Choose the spatial Derivatives to inline into the residual kernel. Only a first derivative of a stored quantity
+        (i.e. of a single Indexed object) which no other term requires (e.g. a mixed derivative) can be inlined.
+
+        :arg inline_derivatives: The Derivatives to inline, True for all the Derivatives that can be inlined, 'auto' for those that are used
+        only once in the equations, or None.
+        :arg list spatial_derivatives: The spatial Derivatives in the equations and formulas.
+        :arg list equations: The equations.
+        :returns: The Derivatives to inline, in the order of the spatial Derivatives.
+        :rtype: list
+        """
+
+        def can_inline(derivative):
+            return (derivative in spatial_derivatives and len(derivative.args) == 2 and isinstance(derivative.expr, Indexed)
+                    and not self.evaluation_graph.dependants[derivative])
+
+        def uses(derivative):
+            return len([term for eq in equations for term in preorder_traversal(eq.rhs) if term == derivative])
+
+        if not inline_derivatives:
+            return []
+        elif inline_derivatives is True:
+            return [d for d in spatial_derivatives if can_inline(d)]
+        elif inline_derivatives == 'auto':
+            return [d for d in spatial_derivatives if can_inline(d) and uses(d) == 1]
+        else:
+            for derivative in inline_derivatives:
+                if not can_inline(derivative):
+                    raise ValueError("The derivative %s cannot be inlined, as it is not a first derivative of a stored quantity "
+                                     "or it is required to evaluate another term." % str(derivative))
+            return [d for d in spatial_derivatives if d in inline_derivatives]
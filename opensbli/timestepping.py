@@ -21,19 +21,24 @@
 from .equations import EinsteinTerm
 from .scheme import *
 from .kernel import *
+from .diagnostics import ReductionVariable, Maximum
+from .profiling import profiler, profiled
 
 
 class TemporalDiscretisation(object):
 
     """ Perform a temporal discretisation of the equations on the numerical grid of solution points. """
 
-    def __init__(self, temporal_scheme, grid, constant_dt, spatial_discretisation):
+    @profiled("Temporal discretisation")
+    def __init__(self, temporal_scheme, grid, constant_dt, spatial_discretisation, wave_speeds=None, formulas=None):
         """ Formulate the time discretisation scheme as a series of computational kernels.
 
         :arg temporal_scheme: The time discretisation scheme.
         :arg grid: The numerical Grid of solution points.
         :arg bool constant_dt: True if the time-step is constant, and False otherwise.
         :arg spatial_discretisation: The object that performs the spatial discretisation.
+        :arg list wave_speeds: The maximum wave speed in each direction (e.g. Abs(u0) + a), which is required if the time-step is not constant.
+        :arg list formulas: The formulas for any variables in the wave speeds that are not prognostic variables.
         :returns: None
         """
 
@@ -41,21 +46,39 @@ class TemporalDiscretisation(object):
         self.scheme = temporal_scheme
 
         # Constant or variable time-step
+        self.constant_dt = constant_dt
         if constant_dt:
             dt = EinsteinTerm('deltat')
             dt.is_constant = True
             dt.is_commutative = True
+            self.cfl = None
+            self.time_step_computation = None
         else:
-            raise NotImplementedError("Varying delta t is not implemented in the code.")
+            # The time-step is computed at the start of each time-step from the CFL number, so it is passed to the kernels as a global variable.
+            if not wave_speeds or len(wave_speeds) != len(grid.shape):
+                raise ValueError("The wave speed in each direction is required for a variable time-step.")
+            dt = IndexedBase('deltat')
+            dt.is_grid = False
+            dt.is_constant = True
+            dt.ranges = 1
+            dt = dt[0]
+            self.cfl = EinsteinTerm('CFL')
+            self.cfl.is_constant = True
+            self.time_step_computation = self.create_time_step_kernel(wave_speeds, formulas, grid)
+        self.dt = dt
 
         # Coefficients required for the time-stepping scheme, from the relevant Butcher tableau.
         self.nstages = temporal_scheme.order
+        self.low_storage = isinstance(temporal_scheme, LowStorageRungeKutta)
         if isinstance(temporal_scheme, ForwardEuler) and self.nstages == 1:
             self.coeff = None
         elif isinstance(temporal_scheme, RungeKutta) and self.nstages == 3:
             self.coeff = self.scheme.get_coefficients()
+        elif self.low_storage:
+            self.nstages = temporal_scheme.nstages
+            self.coeff = self.scheme.get_coefficients()
         else:
-            raise ValueError("Only first-order Forward or third-order Runge-Kutta temporal discretisation schemes are allowed.")
+            raise ValueError("Only first-order Forward, third-order Runge-Kutta or low-storage Runge-Kutta temporal discretisation schemes are allowed.")
 
         # Start computations: Any computations at the start of the time-step. Generally these are the 'save' equations.
         self.start_computations = []
@@ -70,6 +93,13 @@ class TemporalDiscretisation(object):
         # to this attribute for code generation
         self.end_computations = None
 
+        # The arrays that accumulate the updates of the stages of the time-stepping scheme (e.g. the _old arrays of the Runge-Kutta scheme).
+        self.accumulation_arrays = []
+
+        if self.low_storage:
+            # The residual of each equation is accumulated into its own residual array, which is the second storage register of the scheme.
+            self.accumulate_residuals(spatial_discretisation, dt, grid)
+
         # The residual arrays that contain the change in the RHS of each equation.
         out = []
         for residual in spatial_discretisation.residual_arrays:
@@ -78,11 +108,17 @@ class TemporalDiscretisation(object):
 
         # Formulate each step of the time-stepping scheme here as a computational Kernel.
         range_of_evaluation = [tuple([0, s]) for i, s in enumerate(grid.shape)]  # Grid point index 0 to nx (or ny or nz)
-        if self.nstages != 1:
+        if self.low_storage:
+            # There is nothing to save at the start of the time-step, as the update only needs the accumulated residuals.
+            self.start_computations = None
+            self.computations.append(Kernel(out, range_of_evaluation, "Low-storage RK update", grid))
+            self.accumulation_arrays = [residual.values()[0].base for residual in spatial_discretisation.residual_arrays]
+        elif self.nstages != 1:
             # The 'save' equations.
             start = [o[-1] for o in out]
             range_of_evaluation = [tuple([0 + grid.halos[i][0], s + grid.halos[i][1]]) for i, s in enumerate(grid.shape)]
             self.start_computations.append(Kernel(start, range_of_evaluation, "Save equations", grid))
+            self.accumulation_arrays = [equation.lhs.base for equation in start]
 
             # The 'update' equations of the variables at time 't + k', where k is the Runge-Kutta loop iteration.
             equations = [o[0] for o in out]
@@ -96,8 +132,31 @@ class TemporalDiscretisation(object):
         # Copy the LHS vectors and scalars in spatial discretisation to prognostic_classified
         self.prognostic_classified = spatial_discretisation.lhs_vectors
 
+        profiler.count_computations((self.start_computations or []) + self.computations)
         return
 
+    def create_time_step_kernel(self, wave_speeds, formulas, grid):
+        """ Create the kernel that finds the maximum over the grid of the sum of the wave speed over the grid point spacing in each direction.
+        The time-step is then the CFL number divided by this maximum.
+
+        :arg list wave_speeds: The maximum wave speed in each direction.
+        :arg list formulas: The formulas for any variables in the wave speeds that are not prognostic variables.
+        :arg grid: The numerical Grid of solution points.
+        :returns: The reduction kernel.
+        :rtype: Kernel
+        """
+
+        formulas = dict([(formula.lhs, formula.rhs) for formula in flatten(formulas or [])])
+        rate = sum([(speed.rhs if isinstance(speed, Eq) else speed)/grid.deltas[direction] for direction, speed in enumerate(wave_speeds)])
+
+        # Substitute the formulas (which may depend on other formulas), so that the wave speeds only depend on the prognostic variables.
+        while any(term in formulas for term in rate.atoms(Indexed)):
+            rate = rate.xreplace(formulas)
+
+        wave_speed = ReductionVariable('wave_speed', 'max')
+        range_of_evaluation = [tuple([0, s]) for s in grid.shape]
+        return Kernel(Eq(wave_speed, Maximum(wave_speed, rate)), range_of_evaluation, "Maximum wave speed", grid)
+
     def time_derivative(self, function, dt, residual, grid):
         """ Return the equation(s) used to advance the model equations forward in time.
 
@@ -109,7 +168,10 @@ class TemporalDiscretisation(object):
         :rtype: sympy.Eq, or list of sympy.Eq
         """
 
-        if self.nstages == 1:
+        if self.low_storage:
+            # The residual array already holds the time-step multiplied by the accumulated residual.
+            equation = Eq(function, function + self.scheme.b*residual, evaluate=False)
+        elif self.nstages == 1:
             equation = Eq(function, function + dt*residual, evaluate=False)
         elif self.nstages == 3:
             old = grid.work_array('%s_old' % function.base)
@@ -119,6 +181,23 @@ class TemporalDiscretisation(object):
             equation = [equation_function, equation_old, save_equation]
         return equation
 
+    def accumulate_residuals(self, spatial_discretisation, dt, grid):
+        """ Change the residual kernel of the spatial discretisation, so that each residual array accumulates
+        the residuals of the stages of a low-storage Runge-Kutta scheme (i.e. dq = a*dq + dt*residual) rather than being overwritten.
+
+        :arg spatial_discretisation: The object that performs the spatial discretisation.
+        :arg dt: The time-step.
+        :arg grid: The grid of solution points.
+        :returns: None
+        """
+
+        residual_arrays = set([residual.values()[0] for residual in spatial_discretisation.residual_arrays])
+        for number, computation in enumerate(spatial_discretisation.computations):
+            if any(eq.lhs in residual_arrays for eq in computation.equations):
+                equations = [Eq(eq.lhs, self.scheme.a*eq.lhs + dt*eq.rhs) if eq.lhs in residual_arrays else eq for eq in computation.equations]
+                spatial_discretisation.computations[number] = Kernel(equations, computation.ranges, computation.computation_type, grid)
+        return
+
 
 class RungeKutta(Scheme):
 
@@ -170,3 +249,64 @@ class ForwardEuler(Scheme):
         Scheme.__init__(self, "ForwardEuler", 1)
 
         return
+
+
+class LowStorageRungeKutta(Scheme):
+
+    """ Low-storage (2N) Runge-Kutta time-stepping scheme in the form of Williamson, which only needs two arrays for each
+    prognostic variable: the variable itself and its accumulated residual. Each stage performs
+
+        dq = a[stage]*dq + dt*residual(q)
+        q = q + b[stage]*dq
+
+    There is no 'save' step, since no copy of the variables at the start of the time-step is needed. Since a[0] is zero,
+    the accumulated residuals do not need initialising. The third-order scheme has three stages (Williamson, 1980),
+    and the fourth-order scheme has five stages (Carpenter and Kennedy, 1994). """
+
+    def __init__(self, order):
+        """ Set up the Runge-Kutta stages and the coefficients.
+
+        :arg int order: The order of accuracy of the scheme (3 or 4).
+        """
+
+        Scheme.__init__(self, "LowStorageRungeKutta", order)
+
+        if order == 3:
+            self.nstages = 3
+        elif order == 4:
+            self.nstages = 5
+        else:
+            raise ValueError("Only third- and fourth-order low-storage Runge-Kutta schemes are allowed.")
+
+        self.stage = Symbol('stage', integer=True)
+        self.a = IndexedBase('rka')
+        self.a.is_grid = False
+        self.a.is_constant = True
+        self.a.ranges = self.nstages
+        self.b = IndexedBase('rkb')
+        self.b.is_grid = False
+        self.b.is_constant = True
+        self.b.ranges = self.nstages
+        self.a = self.a[self.stage]
+        self.b = self.b[self.stage]
+
+        return
+
+    def get_coefficients(self):
+        """ Return the coefficients of the low-storage Runge-Kutta update equations.
+
+        :returns: A dictionary of (update_equation, coefficients) pairs.
+        :rtype: dict
+        """
+
+        coeffs = {}
+        if self.order == 3:
+            coeffs[self.a.base] = [0, Rational(-5, 9), Rational(-153, 128)]
+            coeffs[self.b.base] = [Rational(1, 3), Rational(15, 16), Rational(8, 15)]
+        elif self.order == 4:
+            coeffs[self.a.base] = [0, Rational(-567301805773, 1357537059087), Rational(-2404267990393, 2016746695238),
+                                   Rational(-3550918686646, 2091501179385), Rational(-1275806237668, 842570457699)]
+            coeffs[self.b.base] = [Rational(1432997174477, 9575080441755), Rational(5161836677717, 13612068292357),
+                                   Rational(1720146321549, 2090206949498), Rational(3134564353537, 4481467310338),
+                                   Rational(2277821191437, 14882151754819)]
+        return coeffs
@@ -19,6 +19,8 @@
 #    along with OpenSBLI.  If not, see <http://www.gnu.org/licenses/>.
 
 from sympy import *
+from .scheme import fd_formula
+from .catalog import ExpressionCatalog
 from .equations import EinsteinTerm
 
 
@@ -62,34 +64,27 @@ def get_indexed_variables(equations):
     :rtype: (list, int)
     """
 
-    variables = []
-    count = {}
-    for eq in equations:
-        pot = preorder_traversal(eq)
-        for p in pot:
-            if p in variables:
-                pot.skip()
-                count[p] = count[p]+1
-                continue
-            elif isinstance(p, Indexed):
-                pot.skip()
-                variables.append(p)
-                count[p] = 1
-            else:
-                continue
-    return variables, count
+    catalog = ExpressionCatalog(equations)
+    return catalog.indexed, catalog.count
 
 
 def substitute_work_arrays(ordered_evaluations, evaluations, equations):
-    updated_equations = [eq for eq in equations]
-    for equation_number, equation in enumerate(updated_equations):
-        spatial_derivatives = [ev for ev in ordered_evaluations if isinstance(ev, Derivative)]
-        formulas = [ev for ev in ordered_evaluations if isinstance(ev, Indexed)]
-        spatial_derivatives = (sorted(spatial_derivatives, cmp=decreasing_order))
-        for var in spatial_derivatives + formulas:
-            new = evaluations[var].work
-            updated_equations[equation_number] = updated_equations[equation_number].subs(var, new)
-    return updated_equations
+    """ Replace the evaluated terms (e.g. the spatial Derivatives) in the equations by the work arrays they are evaluated into.
+    All the replacements are made in a single walk of each equation. The walk is top-down, so a (higher order) Derivative is replaced
+    as a whole before any of the terms nested inside it are considered.
+
+    :arg list ordered_evaluations: The evaluated terms.
+    :arg dict evaluations: The evaluation information, containing the work array of each term.
+    :arg list equations: The equations to update.
+    :returns: The updated equations.
+    :rtype: list
+    """
+
+    replacements = {}
+    for var in ordered_evaluations:
+        if isinstance(var, (Derivative, Indexed)) and evaluations[var].work != var:
+            replacements[var] = evaluations[var].work
+    return [eq.xreplace(replacements) for eq in equations]
 
 
 def update_work_arrays(ordered_evaluations, evaluations, work_array_name, work_array_index, grid):
@@ -134,18 +129,21 @@ class SymbolicDerivative(object):
 
     For a wall boundary condition this will have a dependency on the grid range. """
 
-    def __init__(self, spatial_scheme, grid):
+    def __init__(self, spatial_scheme, grid, direct_second_derivatives=False):
         """ Initialise the spatial derivative, which gives the equations
         of spatial Derivatives for the various combinations of the spatial scheme and order of accuracy.
 
         :arg spatial_scheme: The spatial discretisation scheme to use.
         :arg grid: The numerical grid of solution points.
+        :arg bool direct_second_derivatives: If True, the mixed second derivatives are evaluated directly with a two-dimensional stencil,
+        rather than as the derivative of a stored first derivative.
         :returns: None
         """
         self.derivative_direction = grid.indices
         self.index_mapping = grid.mapped_indices
         self.deltas = grid.deltas
         self.points = spatial_scheme.points
+        self.direct_second_derivatives = direct_second_derivatives
         return
 
     def get_derivative_formula(self, derivative):
@@ -154,14 +152,16 @@ class SymbolicDerivative(object):
         indices = list(derivative.args[1:])
         if order == 1 or len(set(indices)) == 1:
             wrt = indices[0]
-            gridpoints = [wrt + i for i in self.points]
-            formula = apply_finite_diff(order, gridpoints, [derivative.expr.subs({wrt: x}) for x in gridpoints], wrt)
+            formula = fd_formula(derivative.expr, wrt, order, self.points)
             d1 = self.derivative_direction.index(self.index_mapping[derivative.args[1]])
             delta = self.deltas[d1]
             formula = formula*pow(delta, -order)
         elif order == 2:
-            # Do the derivative of derivative
-            raise NotImplementedError("Derivatives of order == 2 are not implemented.")
+            # The stencil of a mixed derivative is the product of the first derivative stencils in each of its directions.
+            formula = derivative.expr
+            for wrt in indices:
+                d1 = self.derivative_direction.index(self.index_mapping[wrt])
+                formula = fd_formula(formula, wrt, 1, self.points)*pow(self.deltas[d1], -1)
         else:
             raise NotImplementedError("Derivatives of order > 2 are not implemented.")
         return formula
@@ -179,7 +179,7 @@ class SymbolicDerivative(object):
         general_formula = []
         subevals = []
         requires = []
-        if order == 1 or len(set(indices)) == 1:
+        if order == 1 or len(set(indices)) == 1 or (order == 2 and self.direct_second_derivatives):
             general_formula += [order, tuple(indices)]
             if len(derivative.args[0].atoms(Indexed)) > 1:
                 subevals += [derivative.args[0]]
@@ -202,13 +202,7 @@ class SymbolicDerivative(object):
 
 def get_used_formulas(formulas, equations):
     """ Return the formulas used in the equations. """
-    variables, count = get_indexed_variables(equations)
-
-    formulas = dict(zip([form.lhs for form in formulas], [form.rhs for form in formulas]))
-
-    used_formulas = [Eq(var, formulas[var]) for var in variables if var in formulas.keys()]
-
-    return used_formulas
+    return ExpressionCatalog(equations).get_used_formulas(formulas)
 
 
 def get_derivatives(equations):
@@ -218,28 +212,47 @@ def get_derivatives(equations):
     :arg equations: A list of equations to search.
     :returns: All of the spatial Derivative objects and all of the temporal Derivative objects.
     """
+    return ExpressionCatalog(equations).get_derivatives()
 
-    spatial_derivatives = []
-    time_derivatives = []
-
-    for eq in equations:
-        pot = preorder_traversal(eq)
-
-        for p in pot:
-            if p in spatial_derivatives:
-                pot.skip()
-                continue
-            elif isinstance(p, Derivative):
-                if all(arg != EinsteinTerm('t') for arg in p.args):
-                    pot.skip()
-                    spatial_derivatives.append(p)
-                else:
-                    pot.skip()
-                    time_derivatives.append(p)
-            else:
-                continue
 
-    return spatial_derivatives, time_derivatives
+def canonical_derivative(expr):
+    """ Return an expression with each spatial Derivative in its canonical form. The variables of a Derivative are sorted (so that mixed derivatives
+    in different orders are the same term), and the constant factors of the differentiated term (i.e. the factors which depend on neither
+    the grid functions nor the variables, including the sign) are taken out of the Derivative. The factors of a product are already sorted by SymPy.
+    Any Derivative nested inside another Derivative is made canonical first. Temporal Derivatives are left as they are.
+
+    :arg expr: The expression.
+    :returns: The expression with the canonical Derivatives.
+    """
+    if not expr.args or isinstance(expr, Indexed):
+        return expr
+    args = [canonical_derivative(arg) for arg in expr.args]
+    if isinstance(expr, Derivative) and EinsteinTerm('t') not in args[1:]:
+        variables = sorted(args[1:], key=str)
+        factors = Mul.make_args(args[0])
+        constant = [f for f in factors if not f.atoms(Indexed) and not f.free_symbols & set(variables)]
+        dependent = [f for f in factors if f not in constant]
+        if dependent:
+            return Mul(*constant)*Derivative(Mul(*dependent), *variables)
+        return Derivative(args[0], *variables)
+    if args == list(expr.args):
+        return expr
+    return expr.func(*args)
+
+
+def canonicalise_derivatives(equations):
+    """ Rewrite the spatial Derivatives of the equations in their canonical form (see canonical_derivative), so that the Derivatives which only
+    differ in the order of their variables or by a constant factor are evaluated once.
+
+    :arg list equations: The equations.
+    :returns: The equations with the canonical Derivatives, and the number of the spatial Derivatives that were merged with another.
+    :rtype: (list, int)
+    """
+    before = len(ExpressionCatalog(equations).get_derivatives()[0])
+    equations = [Eq(eq.lhs, canonical_derivative(eq.rhs), evaluate=False) if isinstance(eq, Equality) else canonical_derivative(eq)
+                 for eq in equations]
+    after = len(ExpressionCatalog(equations).get_derivatives()[0])
+    return equations, before - after
 
 
 def str_print(expr):
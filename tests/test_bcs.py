@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+#    OpenSBLI: An automatic code generator for solving differential equations.
+#    Copyright (C) 2016 Satya P. Jammy, Christian T. Jacobs, Neil D. Sandham
+
+#    This file is part of OpenSBLI.
+
+#    OpenSBLI is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    OpenSBLI is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with OpenSBLI.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import pytest
+
+# OpenSBLI classes and functions
+from opensbli.grid import Grid
+from opensbli.bcs import PeriodicBoundaryCondition, exchange_edges_and_corners
+
+
+def test_exchange_edges_and_corners():
+    """ Ensure that the periodic exchanges of all the directions are combined into face, edge and corner transfers which only read interior points. """
+
+    grid = Grid(ndim=2)
+    grid.halos = [(-2, 2), (-2, 2)]
+    u, v = [grid.work_array(name) for name in ['u', 'v']]
+    bc = PeriodicBoundaryCondition(grid)
+    for direction in range(2):
+        bc.apply([u, v], direction)
+
+    exchanges = exchange_edges_and_corners(bc.computations, grid)
+    # Four faces and four corners
+    assert len(exchanges) == 8
+    assert [e.direction for e in exchanges] == [0, 0, 1, 1, None, None, None, None]
+    for exchange in exchanges:
+        assert exchange.transfer_arrays == [u, v]
+        for d, s in enumerate(grid.shape):
+            assert (exchange.transfer_from[d], exchange.transfer_size[d]) in [(0, s), (0, 2), (s - 2, 2)]
+    # The face in the first direction fills the right halo from the interior points
+    assert exchanges[0].transfer_size == [2, grid.shape[1]]
+    assert exchanges[0].transfer_to == [grid.shape[0], 0]
+    # The corner filling the left halo of both directions
+    assert exchanges[-1].transfer_from == [grid.shape[0] - 2, grid.shape[1] - 2]
+    assert exchanges[-1].transfer_to == [-2, -2]
+    return
+
+
+if __name__ == '__main__':
+    pytest.main(os.path.abspath(__file__))
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+#    OpenSBLI: An automatic code generator for solving differential equations.
+#    Copyright (C) 2016 Satya P. Jammy, Christian T. Jacobs, Neil D. Sandham
+
+#    This file is part of OpenSBLI.
+
+#    OpenSBLI is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    OpenSBLI is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with OpenSBLI.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import pytest
+
+# OpenSBLI classes and functions
+from opensbli.benchmark import run, compare, main, BENCHMARK_VERSION
+
+
+def test_run():
+    """ Ensure that a benchmark case generates the code and records the time taken by each phase. """
+
+    results = run(['wave'], [1], [2])
+    assert results['version'] == BENCHMARK_VERSION
+    case = results['results']['wave/1d/order2']
+    assert case['time'] > 0
+    assert "Spatial discretisation" in case['phases']
+    assert "OPSC code generation" in case['phases']
+    return
+
+
+def test_compare():
+    """ Ensure that only significant slowdowns are flagged as regressions. """
+
+    baseline = {'version': BENCHMARK_VERSION, 'results': {'a': {'time': 1.0}, 'b': {'time': 1.0}, 'c': {'time': 0.01}}}
+    results = {'version': BENCHMARK_VERSION, 'results': {'a': {'time': 1.1}, 'b': {'time': 1.5}, 'c': {'time': 0.05}, 'd': {'time': 9.0}}}
+    assert compare(results, baseline, threshold=0.2) == [('b', 1.0, 1.5)]
+
+    with pytest.raises(ValueError):
+        compare(results, {'version': BENCHMARK_VERSION + 1, 'results': {}})
+    return
+
+
+def test_baseline(tmpdir):
+    """ Ensure that the baseline is written, and then used to check for regressions. """
+
+    baseline = str(tmpdir.join('baseline.json'))
+    arguments = ['--problems', 'wave', '--ndim', '1', '--orders', '2', '--baseline', baseline]
+    assert main(arguments + ['--update-baseline']) == 0
+    with open(baseline) as f:
+        assert list(json.load(f)['results'].keys()) == ['wave/1d/order2']
+    # Nothing can be slower than a very slow baseline.
+    with open(baseline) as f:
+        results = json.load(f)
+    results['results']['wave/1d/order2']['time'] = 1000.0
+    with open(baseline, 'w') as f:
+        json.dump(results, f)
+    assert main(arguments) == 0
+    return
+
+
+if __name__ == '__main__':
+    pytest.main(os.path.abspath(__file__))
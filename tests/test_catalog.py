@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+#    OpenSBLI: An automatic code generator for solving differential equations.
+#    Copyright (C) 2016 Satya P. Jammy, Christian T. Jacobs, Neil D. Sandham
+
+#    This file is part of OpenSBLI.
+
+#    OpenSBLI is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    OpenSBLI is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with OpenSBLI.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import pytest
+
+from sympy import IndexedBase, Idx, Eq, Derivative
+
+# OpenSBLI classes and functions
+from opensbli.catalog import ExpressionCatalog
+from opensbli.equations import EinsteinTerm
+from opensbli.grid import GridVariable
+
+
+def test_expression_catalog():
+    """ Ensure that the terms of the equations are cataloged correctly. """
+
+    i = Idx('i')
+    t = EinsteinTerm('t')
+    x = EinsteinTerm('x')
+    c = EinsteinTerm('c')
+    c.is_constant = True
+    rho, u, p = [IndexedBase(name) for name in ['rho', 'u', 'p']]
+    work = GridVariable('work')
+    equations = [Eq(Derivative(rho[i], t), -c*Derivative(rho[i]*u[i], x)), Eq(p[i], rho[i]*u[i+1]*u[i]), Eq(work, c*u[i])]
+
+    catalog = ExpressionCatalog(equations)
+    assert catalog.indexed == [rho[i], u[i], p[i], u[i+1]]
+    assert catalog.count[u[i]] == 3
+    assert catalog.indices[u] == set([(i,), (i+1,)])
+    assert catalog.constants == [c]
+    assert catalog.maximum_order == 1
+    assert catalog.get_derivatives() == ([Derivative(rho[i]*u[i], x)], [Derivative(rho[i], t)])
+
+    first, second, third = catalog.entries
+    assert first.lhs_bases == [rho]
+    assert second.lhs_bases == [p]
+    assert set(second.rhs_bases) == set([rho, u])
+    assert second.has_Idx
+    assert third.gridvariables == [work]
+
+    # Only the formulas for the Indexed objects in the equations are used.
+    formulas = [Eq(u[i], rho[i]*p[i]), Eq(EinsteinTerm('T'), p[i]/rho[i])]
+    assert catalog.get_used_formulas(formulas) == formulas[:1]
+
+    # Equations can be added to the catalog later.
+    catalog.add([Eq(p[i], Derivative(u[i], x, x))])
+    assert catalog.maximum_order == 2
+    assert catalog.get_derivatives()[0] == [Derivative(rho[i]*u[i], x), Derivative(u[i], x, x)]
+    assert catalog.count[p[i]] == 2
+    return
+
+
+if __name__ == '__main__':
+    pytest.main(os.path.abspath(__file__))
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+#    OpenSBLI: An automatic code generator for solving differential equations.
+#    Copyright (C) 2016 Satya P. Jammy, Christian T. Jacobs, Neil D. Sandham
+
+#    This file is part of OpenSBLI.
+
+#    OpenSBLI is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    OpenSBLI is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with OpenSBLI.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import pytest
+
+from sympy import Derivative
+
+# OpenSBLI classes and functions
+from opensbli.equations import Equation
+from opensbli.diagnostics import Reduction
+from opensbli.spatial import Central, SpatialDiscretisation
+from opensbli.grid import Grid
+
+
+@pytest.fixture
+def grid():
+    return Grid(ndim=2)
+
+
+@pytest.fixture
+def central_scheme():
+    return Central(order=4)
+
+
+@pytest.fixture
+def spatial_discretisation(grid, central_scheme):
+    mass = Equation("Eq(Der(phi,t),- c_j*Der(phi,x_j))", 2, "x", substitutions=[], constants=["c_j"])
+    return SpatialDiscretisation([mass.expanded], [], grid, central_scheme)
+
+
+@pytest.fixture
+def gradient():
+    return Equation("Eq(gradient, Der(phi,x_j)*Der(phi,x_j))", 2, "x", substitutions=[], constants=[])
+
+
+def test_reduction_reuses_spatial_derivatives(grid, central_scheme, spatial_discretisation, gradient):
+    """ Ensure that a Reduction reuses the derivatives already evaluated by the spatial discretisation, rather than evaluating them again. """
+
+    phi = [a.keys()[0].args[0] for a in spatial_discretisation.residual_arrays]
+
+    # Without the spatial discretisation, both derivatives are evaluated into work arrays starting at wk0.
+    reduction = Reduction(grid, [gradient.expanded], [], phi, central_scheme, ["sum"], 10)
+    assert not reduction.in_stage
+    assert len(reduction.computations) == 3
+    assert "wk0" in [str(a) for a in reduction.computations[0].outputs.keys()]
+
+    reduction = Reduction(grid, [gradient.expanded], [], phi, central_scheme, ["sum"], 10, spatial_discretisation)
+    assert reduction.in_stage
+    assert len(reduction.reused) == 2 and all(isinstance(term, Derivative) for term in reduction.reused)
+    # Only the reduction kernel remains, which reads the spatial work arrays.
+    assert len(reduction.computations) == 1
+    spatial_work_arrays = set([str(spatial_discretisation.evaluations[term].work.base) for term in reduction.reused])
+    assert set([str(a) for a in reduction.computations[0].inputs.keys()]) == spatial_work_arrays
+
+    # Reductions computed only at the end of the simulation cannot reuse the spatial work arrays, but their own work arrays do not collide with them.
+    reduction = Reduction(grid, [gradient.expanded], [], phi, central_scheme, ["sum"], None, spatial_discretisation)
+    assert not reduction.in_stage and not reduction.reused
+    written = set([str(a) for computation in reduction.computations for a in computation.outputs.keys()])
+    assert not written & spatial_work_arrays
+    return
+
+
+if __name__ == '__main__':
+    pytest.main(os.path.abspath(__file__))
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+#    OpenSBLI: An automatic code generator for solving differential equations.
+#    Copyright (C) 2016 Satya P. Jammy, Christian T. Jacobs, Neil D. Sandham
+
+#    This file is part of OpenSBLI.
+
+#    OpenSBLI is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    OpenSBLI is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with OpenSBLI.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import pytest
+
+from sympy import IndexedBase, Idx, Eq, Indexed, Derivative, Symbol
+
+# OpenSBLI classes and functions
+from opensbli.evaluations import Evaluations, EvaluationGraph, create_formula_evaluations, sort_evaluations, set_range_of_evaluations
+from opensbli.grid import Grid
+
+
+@pytest.fixture
+def variables():
+    i = Idx('i')
+    return [IndexedBase(name)[i] for name in ['rho', 'rhou0', 'u0', 'p', 'T']]
+
+
+def test_sort_evaluations(variables):
+    """ Ensure that the formulas are ordered such that each is evaluated after the terms it requires. """
+
+    rho, rhou0, u0, p, T = variables
+    formulas = [Eq(T, p/rho), Eq(p, rho*u0*u0), Eq(u0, rhou0/rho)]
+    evaluations = create_formula_evaluations(formulas, {})
+    for known in [rho, rhou0]:
+        evaluations[known] = Evaluations(known, known, None, None, known)
+
+    order = sort_evaluations([rho, rhou0], evaluations, Indexed)
+    assert order == [rho, rhou0, u0, p, T]
+
+    # The graph records the dependants of each term.
+    graph = EvaluationGraph(evaluations)
+    assert set(graph.dependants[rho]) == set([T, p, u0])
+    assert graph.dependants[T] == []
+
+    return
+
+
+def test_sort_evaluations_cycle(variables):
+    """ Ensure that a cyclic dependency is reported. """
+
+    rho, rhou0, u0, p, T = variables
+    formulas = [Eq(u0, rhou0/p), Eq(p, rho*T), Eq(T, u0*u0)]
+    evaluations = create_formula_evaluations(formulas, {})
+    for known in [rho, rhou0]:
+        evaluations[known] = Evaluations(known, known, None, None, known)
+
+    with pytest.raises(ValueError) as error:
+        sort_evaluations([rho, rhou0], evaluations, Indexed)
+    assert "cyclic dependency" in str(error.value)
+    for term in [u0, p, T]:
+        assert str(term) in str(error.value)
+
+    # A requirement that is never evaluated is reported too.
+    evaluations = create_formula_evaluations([Eq(u0, rhou0/rho)], {})
+    with pytest.raises(ValueError) as error:
+        sort_evaluations([rho], evaluations, Indexed)
+    assert "never evaluated" in str(error.value)
+
+    return
+
+
+def test_set_range_of_evaluations():
+    """ Ensure that each term is evaluated over the points required by the terms that depend on it, however indirectly. """
+
+    grid = Grid(ndim=2)
+    grid.halos = [(-2, 2), (-2, 2)]
+    i0, i1 = grid.indices
+    nx0, nx1 = grid.shape
+    x0, x1 = Symbol('x0'), Symbol('x1')
+    rho, rhou0, u0, p, T = [IndexedBase(name)[i0, i1] for name in ['rho', 'rhou0', 'u0', 'p', 'T']]
+    formulas = [Eq(T, p/rho), Eq(p, rho*u0*u0), Eq(u0, rhou0/rho)]
+    evaluations = create_formula_evaluations(formulas, {})
+    for known in [rho, rhou0]:
+        evaluations[known] = Evaluations(known, known, None, None, known)
+    # Derivatives of T in the first direction, and of p in the second direction
+    dTdx = Derivative(T, x0)
+    dpdy = Derivative(p, x1)
+    evaluations[dTdx] = Evaluations(dTdx, [1, (0,)], [T])
+    evaluations[dpdy] = Evaluations(dpdy, [1, (1,)], [p])
+
+    order = sort_evaluations([rho, rhou0], evaluations, Indexed)
+    order = sort_evaluations(order, evaluations, Derivative)
+    set_range_of_evaluations(order, evaluations, grid)
+
+    assert evaluations[dTdx].evaluation_range == [(0, nx0), (0, nx1)]
+    assert evaluations[T].evaluation_range == [(-2, nx0 + 2), (0, nx1)]
+    # p (and so u0) is required over the halos of both directions.
+    assert evaluations[p].evaluation_range == [(-2, nx0 + 2), (-2, nx1 + 2)]
+    assert evaluations[u0].evaluation_range == [(-2, nx0 + 2), (-2, nx1 + 2)]
+    return
+
+
+if __name__ == '__main__':
+    pytest.main(os.path.abspath(__file__))
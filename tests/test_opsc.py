@@ -21,10 +21,13 @@
 import os
 import pytest
 
-from sympy import symbols, pi, cos
+from sympy import symbols, pi, cos, Eq, IndexedBase, Idx
 
 # OpenSBLI classes and functions
-from opensbli.opsc import ccode
+from opensbli.opsc import ccode, OPSC, common_subexpressions, hoist_constants, allocate_work_arrays, halo_depths
+from opensbli.kernel import Kernel, fuse_kernels
+from opensbli.grid import Grid
+from opensbli.grid import GridVariable
 
 def test_ccode():
     """ Check that the OPSC code writer outputs the expected C code statement.
@@ -37,5 +40,163 @@ def test_ccode():
     assert result == expected
 
 
+def test_ccode_single_precision():
+    """ Check that single-precision code uses float literals and the single-precision math functions. """
+
+    x, y = symbols("x y")
+    assert ccode(0.5*cos(x)**y + x**0.5, dtype='float') == "sqrtf(x) + 0.5f*powf(cosf(x), y)"
+    assert ccode(0.5*cos(x)**y + x**0.5) == "sqrt(x) + 0.5*pow(cos(x), y)"
+
+
+def test_incremental_writes(tmpdir):
+    """ Ensure that unchanged code files are not rewritten, and that the manifest records what was written and translated. """
+
+    def writer():
+        # Only the parts of OPSC that write the code files are needed here.
+        opsc = OPSC.__new__(OPSC)
+        opsc.CODE_DIR = str(tmpdir)
+        opsc.manifest_path = str(tmpdir.join('manifest.json'))
+        opsc.manifest = opsc.load_manifest()
+        opsc.fingerprints = {'files': {}, 'kernels': {}}
+        opsc.simulation_parameters = {'name': 'test'}
+        return opsc
+
+    first = writer()
+    assert first.write_file('test.cpp', 'int main(){}')
+    assert first.write_file('test_block_0_kernel.h', 'void kernel(){}')
+    first.update_manifest()
+    assert not first.is_translated()
+
+    # Pretend that the code has been translated.
+    tmpdir.join('test_ops.cpp').write('')
+    first.manifest['translated'] = first.code_fingerprint()
+    first.save_manifest()
+
+    second = writer()
+    assert not second.write_file('test.cpp', 'int main(){}')
+    assert second.write_file('test_block_0_kernel.h', 'void kernel(){ return; }')
+    assert tmpdir.join('test_block_0_kernel.h').read() == 'void kernel(){ return; }'
+    second.update_manifest()
+    assert not second.is_translated()
+
+    third = writer()
+    assert not third.write_file('test.cpp', 'int main(){}')
+    assert not third.write_file('test_block_0_kernel.h', 'void kernel(){ return; }')
+    assert third.manifest['files'] == third.fingerprints['files']
+    return
+
+
+def test_common_subexpressions():
+    """ Ensure that the common subexpressions of the equations of a kernel are evaluated into temporaries,
+    without altering the indices of the Indexed objects or reading a term before it is written. """
+
+    i = Idx('i')
+    rho, u, p, q = [IndexedBase(name) for name in ['rho', 'u', 'p', 'q']]
+    c = symbols('c')
+    equations = [Eq(p[i], c*u[i+1]/rho[i] + u[i]), Eq(q[i], c*u[i+1]/rho[i] - u[i]), Eq(rho[i], p[i]/rho[i] + c*p[i]/rho[i])]
+
+    eliminated, before, after = common_subexpressions(equations)
+    assert after < before
+    temporaries = [e for e in eliminated if isinstance(e.lhs, GridVariable)]
+    assert [str(t.lhs) for t in temporaries] == ['cse0', 'cse1']
+    assert temporaries[0].rhs == c*u[i+1]/rho[i]
+    # The last equation reads p, which is written by the first one, so its temporary is evaluated after the first two equations.
+    assert [str(e.lhs) for e in eliminated] == ['cse0', 'p[i]', 'q[i]', 'cse1', 'rho[i]']
+    assert eliminated[1].rhs == temporaries[0].lhs + u[i]
+    assert temporaries[1].rhs == p[i]/rho[i]
+    return
+
+
+def test_hoist_constants():
+    """ Ensure that the subexpressions that only involve constants are replaced by global constants. """
+
+    i = Idx('i')
+    u = IndexedBase('u')
+    gama, Minf, Re, c = symbols('gama Minf Re c')
+    known = set([gama, Minf, Re, c])
+    constants = {}
+
+    expression, constants = hoist_constants(u[i+1]/((gama - 1)*Minf**2*Re) - c*u[i] + 2*c, known, constants)
+    assert len(constants) == 2
+    names = dict([(value, symbols(name)) for value, name in constants.items()])
+    assert expression == names[1/((gama - 1)*Minf**2*Re)]*u[i+1] - c*u[i] + names[2*c]
+
+    # The same constant is only defined once.
+    expression, constants = hoist_constants(2*c*u[i], known, constants)
+    assert expression == names[2*c]*u[i]
+    assert len(constants) == 2
+
+    # A unit coefficient is dropped, and each constant is defined in terms of the others.
+    constants = {}
+    expression, constants = hoist_constants(1.0*u[i]/Re, known, constants)
+    assert expression == symbols('rinv0')*u[i]
+    assert constants == {1/Re: 'rinv0'}
+    expression, constants = hoist_constants(u[i]/(Re*(gama - 1)), known, constants)
+    assert expression == symbols('rcf1')*u[i]
+    assert constants[symbols('rinv0')/(gama - 1)] == 'rcf1'
+    # The constants defined before a new constant are written in terms of it.
+    expression, constants = hoist_constants(u[i]*(gama - 1), known, constants)
+    assert expression == symbols('rcf2')*u[i]
+    assert constants == {1/Re: 'rinv0', symbols('rinv0')/symbols('rcf2'): 'rcf1', gama - 1: 'rcf2'}
+    return
+
+
+def test_allocate_work_arrays():
+    """ Ensure that the work arrays whose lifetimes do not overlap share the same array. """
+
+    grid = Grid(ndim=1)
+    wk0, wk1, wk2, wk3, u = [grid.work_array(name) for name in ['wk0', 'wk1', 'wk2', 'wk3', 'u']]
+    ranges = [(0, grid.shape[0])]
+    kernels = [Kernel(Eq(wk0, 2*u), ranges, "First", grid), Kernel(Eq(wk1, wk0 + u), ranges, "Second", grid),
+               Kernel(Eq(wk2, 2*wk1), ranges, "Third", grid), Kernel(Eq(u, wk2 + wk3), ranges, "Fourth", grid)]
+
+    allocations, peak = allocate_work_arrays([kernels], set(['wk0', 'wk1', 'wk2', 'wk3']))
+    # wk0 is no longer needed once wk2 is written, and wk3 is read before it is written so it is never reused.
+    assert allocations[0][2] == {'wk2': 'wk0', 'wk1': 'wk1', 'wk3': 'wk3'}
+    assert allocations[0][3] == {'wk2': 'wk0', 'wk3': 'wk3'}
+    assert peak == 3
+
+    kernels[2].rename_arrays({'wk2': 'wk0'}, grid)
+    assert [str(a) for a in kernels[2].outputs.keys()] == ['wk0']
+    assert kernels[2].equations[0].lhs == wk0
+    return
+
+
+def test_halo_depths():
+    """ Ensure that the halo depths of an array are those accessed from the range of a kernel. """
+
+    grid = Grid(ndim=2)
+    i0, i1 = grid.indices
+    nx0, nx1 = grid.shape
+    interior = [(0, nx0), (0, nx1)]
+    # Read pointwise over the interior
+    assert halo_depths(interior, [(i0, i1)], grid.shape) == [(0, 0), (0, 0)]
+    # Read with a stencil in the first direction
+    assert halo_depths(interior, [(i0 - 2, i1), (i0 + 1, i1), (i0, i1)], grid.shape) == [(-2, 1), (0, 0)]
+    # Written over the halos of the second direction
+    assert halo_depths([(0, nx0), (-2, nx1 + 2)], [(i0, i1)], grid.shape) == [(0, 0), (-2, 2)]
+    # A boundary kernel at the right-hand end of the first direction
+    assert halo_depths([(nx0 - 1, nx0), (0, nx1)], [(i0 + 2, i1), (i0 - 2, i1)], grid.shape) == [(0, 2), (0, 0)]
+    return
+
+
+def test_fuse_kernels():
+    """ Ensure that consecutive kernels are fused unless a kernel reads a neighbouring point of an array written in the same loop. """
+
+    grid = Grid(ndim=1)
+    wk0, wk1, wk2, u = [grid.work_array(name) for name in ['wk0', 'wk1', 'wk2', 'u']]
+    i = grid.indices[0]
+    ranges = [(0, grid.shape[0])]
+    kernels = [Kernel(Eq(wk0, 2*u), ranges, "First", grid), Kernel(Eq(wk1, wk0 + u), ranges, "Second", grid),
+               Kernel(Eq(wk2, wk1.base[i+1]), ranges, "Third", grid), Kernel(Eq(u, wk2), [(1, grid.shape[0])], "Fourth", grid)]
+
+    fused = fuse_kernels(kernels, grid)
+    assert [k.computation_type for k in fused] == ["First, Second (fused)", "Third", "Fourth"]
+    assert fused[0].equations == [Eq(wk0, 2*u), Eq(wk1, wk0 + u)]
+    # wk0 is written and then read at the same grid point, so it is an input-output of the fused kernel.
+    assert set([str(a) for a in fused[0].inputoutput.keys()]) == set(['wk0'])
+    return
+
+
 if __name__ == '__main__':
     pytest.main(os.path.abspath(__file__))
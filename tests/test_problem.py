@@ -21,10 +21,12 @@
 import os
 import pytest
 
-from sympy import flatten
+from sympy import flatten, preorder_traversal
 
 # OpenSBLI classes and functions
 from opensbli.problem import Problem
+from opensbli.cache import ExpansionCache
+from opensbli.equations import EinsteinTerm
 
 def test_expand():
     """ Ensure that an equation is expanded correctly. """
@@ -55,5 +57,69 @@ def test_expand():
 
     return
 
+
+def test_expand_cached(tmpdir):
+    """ Ensure that the expansion of an equation retrieved from the cache is the same as the expansion itself. """
+
+    equations = ["Eq(Der(rho,t), -c*Conservative(rhou_j,x_j))"]
+    substitutions = []
+    ndim = 2
+    constants = ["c"]
+    coordinate_symbol = "x"
+    metrics = [False, False]
+    formulas = ["Eq(u_i, rhou_i/rho)"]
+
+    cache = ExpansionCache(directory=str(tmpdir))
+    first = Problem(equations, substitutions, ndim, constants, coordinate_symbol, metrics, formulas, cache=cache)
+    assert cache.hits == 0
+    assert cache.misses == 2
+
+    second = Problem(equations, substitutions, ndim, constants, coordinate_symbol, metrics, formulas, cache=cache)
+    assert cache.hits == 2
+    assert cache.misses == 2
+    assert second.get_expanded(second.equations) == first.get_expanded(first.equations)
+    assert second.get_expanded(second.formulas) == first.get_expanded(first.formulas)
+
+    # The attributes of the constant EinsteinTerms should survive the round trip to disk.
+    c = [term for term in flatten(second.get_expanded(second.equations))[0].atoms(EinsteinTerm) if str(term) == "c"][0]
+    assert c.is_constant
+    assert c.is_commutative
+
+    # A change in the dimension of the problem is a different cache entry.
+    Problem(equations, substitutions, 1, constants, coordinate_symbol, metrics, formulas, cache=cache)
+    assert cache.misses == 4
+
+    # Evict everything once the cache is limited to zero bytes.
+    cache.max_size = 0
+    cache.evict()
+    assert tmpdir.listdir() == []
+
+    return
+
+
+def test_expand_concurrently():
+    """ Ensure that expanding the equations in worker processes gives the same expansions, in the same order, as expanding them serially. """
+
+    equations = ["Eq(Der(rho,t), -c*Conservative(rhou_j,x_j))", "Eq(Der(rhou_i,t), -Conservative(rhou_i*u_j + KD(_i,_j)*p,x_j))"]
+    substitutions = []
+    ndim = 2
+    constants = ["c", "gama", "Minf"]
+    coordinate_symbol = "x"
+    metrics = [False, False]
+    formulas = ["Eq(u_i, rhou_i/rho)", "Eq(T, p*gama*Minf*Minf/(rho))"]
+
+    serial = Problem(equations, substitutions, ndim, constants, coordinate_symbol, metrics, formulas)
+    concurrent = Problem(equations, substitutions, ndim, constants, coordinate_symbol, metrics, formulas, workers=2)
+    assert concurrent.get_expanded(concurrent.equations) == serial.get_expanded(serial.equations)
+    assert concurrent.get_expanded(concurrent.formulas) == serial.get_expanded(serial.formulas)
+
+    # Every occurrence of a constant should still be flagged as such.
+    temperature = flatten(concurrent.get_expanded(concurrent.formulas))[-1]
+    minf = [term for term in preorder_traversal(temperature) if str(term) == "Minf"]
+    assert minf
+    assert all(term.is_constant for term in minf)
+
+    return
+
 if __name__ == '__main__':
     pytest.main(os.path.abspath(__file__))
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+#    OpenSBLI: An automatic code generator for solving differential equations.
+#    Copyright (C) 2016 Satya P. Jammy, Christian T. Jacobs, Neil D. Sandham
+
+#    This file is part of OpenSBLI.
+
+#    OpenSBLI is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    OpenSBLI is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with OpenSBLI.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import pytest
+
+# OpenSBLI classes and functions
+from opensbli.profiling import Profiler
+
+
+def test_profiler(tmpdir):
+    """ Ensure that nested phases and their counts are recorded and reported. """
+
+    profiler = Profiler()
+    with profiler.phase("Not recorded"):
+        profiler.count('kernels', 1)
+    assert profiler.report() == []
+
+    profiler.enable()
+    with profiler.phase("Outer"):
+        profiler.count('kernels', 2)
+        with profiler.phase("Inner"):
+            profiler.count('work arrays', 3)
+            profiler.count('work arrays', 1)
+
+    report = profiler.report()
+    assert [(record['name'], record['depth']) for record in report] == [("Outer", 0), ("Inner", 1)]
+    assert report[0]['counts'] == {'kernels': 2}
+    assert report[1]['counts'] == {'work arrays': 4}
+    assert report[0]['time'] >= report[1]['time']
+
+    table = profiler.table().split('\n')
+    assert len(table) == 3
+    assert table[2].startswith("  Inner")
+    assert "work arrays=4" in table[2]
+
+    filename = str(tmpdir.join('profile.json'))
+    profiler.write(filename)
+    with open(filename) as f:
+        assert [record['name'] for record in json.load(f)['phases']] == ["Outer", "Inner"]
+
+    return
+
+
+if __name__ == '__main__':
+    pytest.main(os.path.abspath(__file__))
@@ -21,10 +21,12 @@
 import os
 import pytest
 
-from sympy import Symbol, Idx, flatten
+from sympy import Symbol, Idx, flatten, Rational, IndexedBase, Derivative, Indexed
 
 # OpenSBLI classes and functions
-from opensbli.spatial import SpatialDerivative, Central
+from opensbli.spatial import SpatialDerivative, SpatialDiscretisation, Central
+from opensbli.equations import Equation
+from opensbli.scheme import fd_weights, fd_formula, FD_WEIGHTS
 from opensbli.grid import Grid
 
 @pytest.fixture
@@ -71,5 +73,120 @@ def test_central_scheme():
     return
 
 
+def test_fd_weights():
+    """ Ensure that the finite difference weights are exact, and are only computed once for each order and set of stencil points. """
+
+    assert fd_weights(1, [-1, 0, 1]) == (Rational(-1, 2), 0, Rational(1, 2))
+    assert fd_weights(2, [-1, 0, 1]) == (1, -2, 1)
+    assert fd_weights(1, [-2, -1, 0, 1, 2]) == (Rational(1, 12), Rational(-2, 3), 0, Rational(2, 3), Rational(-1, 12))
+    assert (1, (-1, 0, 1)) in FD_WEIGHTS
+    assert fd_weights(1, [-1, 0, 1]) is FD_WEIGHTS[(1, (-1, 0, 1))]
+
+    i = Idx(Symbol('i', integer=True))
+    f = IndexedBase('f')
+    assert fd_formula(f[i], i, 1, [-1, 0, 1]) == f[i+1]/2 - f[i-1]/2
+    return
+
+
+def test_lazy_derivative_formulas(central_scheme):
+    """ Ensure that the derivative formulas are only created when they are used, and are then reused. """
+
+    grid = Grid(ndim=3)
+    spatial_derivative = SpatialDerivative(central_scheme, grid, 2)
+    assert spatial_derivative.derivative_entries == {}
+
+    # A mixed derivative requires the formula of the lower order derivative.
+    derivative, formula, kernel = spatial_derivative.get_derivative_entry(2, (0, 1))
+    assert sorted(spatial_derivative.derivative_entries.keys()) == [(1, (0,)), (2, (0, 1))]
+    assert derivative == spatial_derivative.fn.diff(grid.indices[0], grid.indices[1])
+    assert str(kernel) == "[2][0,1]"
+    first = spatial_derivative.get_derivative_entry(1, (0,))[1]
+    assert formula == fd_formula(first, grid.indices[1], 1, central_scheme.points)/grid.deltas[1]
+    assert spatial_derivative.get_derivative_entry(2, (0, 1)) is spatial_derivative.derivative_entries[(2, (0, 1))]
+
+    # The full tensors are still available.
+    formulas = spatial_derivative.derivative_formula
+    assert len(formulas) == 3
+    assert formulas[2].shape == (3, 3)
+    assert formulas[2][0, 1] == formula
+    assert len(spatial_derivative.derivative_entries) == 3 + 9
+    return
+
+
+def test_inline_derivatives(grid, central_scheme):
+    """ Ensure that the first derivatives of stored quantities can be evaluated in the residual kernel rather than in work arrays. """
+
+    advection = Equation("Eq(Der(phi,t),- c_j*Der(phi,x_j))", 2, "x", substitutions=[], constants=["c_j"])
+    spatial_discretisation = SpatialDiscretisation([advection.expanded], [], grid, central_scheme)
+    assert len(spatial_discretisation.computations) == 3
+    assert spatial_discretisation.inlined_derivatives == []
+    derivatives = list(advection.expanded[0].rhs.atoms(Derivative))
+
+    # Inline all of the derivatives, so that only the residual kernel is left.
+    spatial_discretisation = SpatialDiscretisation([advection.expanded], [], grid, central_scheme, inline_derivatives=True)
+    assert len(spatial_discretisation.computations) == 1
+    assert set(spatial_discretisation.inlined_derivatives) == set(derivatives)
+    residual = spatial_discretisation.computations[0].equations[0].rhs
+    assert not residual.atoms(Derivative)
+    assert len(residual.atoms(Indexed)) == 8  # The four neighbouring points in each direction.
+
+    # Inline a single derivative.
+    spatial_discretisation = SpatialDiscretisation([advection.expanded], [], grid, central_scheme, inline_derivatives=derivatives[:1])
+    assert len(spatial_discretisation.computations) == 2
+    assert spatial_discretisation.inlined_derivatives == derivatives[:1]
+
+    # Each derivative is used once, so the cost heuristic inlines all of them.
+    spatial_discretisation = SpatialDiscretisation([advection.expanded], [], grid, central_scheme, inline_derivatives='auto')
+    assert len(spatial_discretisation.computations) == 1
+
+    with pytest.raises(ValueError):
+        SpatialDiscretisation([advection.expanded], [], grid, central_scheme, inline_derivatives=[derivatives[0].diff(grid.indices[0])])
+    return
+
+
+def test_group_derivative_kernels(grid, central_scheme):
+    """ Ensure that the derivatives of the same function are evaluated by a single kernel which reads the function once. """
+
+    equations = [Equation("Eq(Der(%s,t),- c_j*Der(%s,x_j))" % (f, f), 2, "x", substitutions=[], constants=["c_j"]).expanded for f in ['phi', 'psi']]
+    spatial_discretisation = SpatialDiscretisation(equations, [], grid, central_scheme)
+    assert len(spatial_discretisation.computations) == 5
+
+    spatial_discretisation = SpatialDiscretisation(equations, [], grid, central_scheme, group_derivative_kernels=True)
+    assert len(spatial_discretisation.computations) == 3
+    for kernel in spatial_discretisation.computations[:2]:
+        assert len(kernel.equations) == 2
+        assert len(kernel.inputs) == 1
+        assert len(kernel.outputs) == 2
+    assert set([str(k.inputs.keys()[0]) for k in spatial_discretisation.computations[:2]]) == set(['phi', 'psi'])
+    return
+
+
+def test_direct_second_derivatives(grid, central_scheme):
+    """ Ensure that the mixed second derivatives can be evaluated directly, rather than as the derivative of a stored first derivative. """
+
+    diffusion = Equation("Eq(Der(phi,t), c_i_j*Der(Der(phi,x_i),x_j) + a_j*Der(phi,x_j))", 2, "x", substitutions=[], constants=["c_i_j", "a_j"])
+    derivatives = diffusion.expanded[0].rhs.atoms(Derivative)
+    mixed = [d for d in derivatives if len(set(d.args[1:])) == 2][0]
+    phi, x0 = mixed.expr, mixed.args[1]
+    first = [d for d in derivatives if d.args[1:] == (x0,)][0]
+    interior = [(0, s) for s in grid.shape]
+
+    # By default, the mixed derivative is the derivative of the first derivative, which is evaluated over the halos of the second direction.
+    spatial_discretisation = SpatialDiscretisation([diffusion.expanded], [], grid, central_scheme)
+    assert first in spatial_discretisation.evaluations[mixed].requires
+    assert spatial_discretisation.evaluations[first].evaluation_range == [(0, grid.shape[0]), (-2, grid.shape[1] + 2)]
+    nested = [c for c in spatial_discretisation.computations if c.computation_type == "D(phi[x0 x1 t] x0 x1)"][0]
+
+    spatial_discretisation = SpatialDiscretisation([diffusion.expanded], [], grid, central_scheme, direct_second_derivatives=True)
+    assert spatial_discretisation.evaluations[mixed].requires == [phi]
+    assert spatial_discretisation.evaluations[first].evaluation_range == interior
+    direct = [c for c in spatial_discretisation.computations if c.computation_type == "D(phi[x0 x1 t] x0 x1)"][0]
+    assert direct.ranges == interior
+    # The 16 points of the product of the first derivative stencils
+    assert len(direct.equations[0].rhs.atoms(Indexed)) == 16
+    assert nested.inputs.keys() != direct.inputs.keys()
+    return
+
+
 if __name__ == '__main__':
     pytest.main(os.path.abspath(__file__))
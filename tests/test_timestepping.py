@@ -21,13 +21,14 @@
 import os
 import pytest
 
-from sympy import Symbol, IndexedBase, Rational
+from sympy import Symbol, IndexedBase, Rational, Abs, exp, log
 
 # OpenSBLI classes and functions
 from opensbli.equations import Equation
-from opensbli.timestepping import TemporalDiscretisation, RungeKutta, ForwardEuler
+from opensbli.timestepping import TemporalDiscretisation, RungeKutta, ForwardEuler, LowStorageRungeKutta
 from opensbli.spatial import Central, SpatialDiscretisation
 from opensbli.grid import Grid
+from opensbli.diagnostics import Maximum
 
 @pytest.fixture
 def coordinate_symbol():
@@ -106,7 +107,65 @@ def test_temporal_discretisation(temporal_discretisation):
     assert len(temporal_discretisation.computations) == 2 # There should be 2 stages in the main body of the computation, since an RK3 scheme is being used.
     
     return
-    
-    
+
+
+def test_low_storage_runge_kutta(mass, grid, central_scheme):
+    """ Ensure that the low-storage Runge-Kutta schemes have the expected order of accuracy, and that the residual arrays accumulate the residuals. """
+
+    for order, nstages in [(3, 3), (4, 5)]:
+        scheme = LowStorageRungeKutta(order)
+        assert scheme.nstages == nstages
+        a, b = [scheme.get_coefficients()[c.base] for c in [scheme.a, scheme.b]]
+
+        # Integrate dy/dt = -y from t = 0 to t = 1 with two different time-steps. Halving the time-step should reduce the error by 2**order.
+        errors = []
+        for steps in [10, 20]:
+            dt = 1.0/steps
+            y = 1.0
+            for step in range(steps):
+                dy = 0.0
+                for stage in range(nstages):
+                    dy = float(a[stage])*dy - dt*y
+                    y += float(b[stage])*dy
+            errors.append(abs(y - exp(-1.0)))
+        assert abs(log(errors[0]/errors[1], 2) - order) < 0.1
+
+    spatial_discretisation = SpatialDiscretisation([mass.expanded], [], grid, central_scheme)
+    temporal_discretisation = TemporalDiscretisation(LowStorageRungeKutta(4), grid, True, spatial_discretisation)
+    assert temporal_discretisation.nstages == 5
+    assert temporal_discretisation.start_computations is None  # There are no 'save' equations.
+    assert len(temporal_discretisation.computations) == 1
+    residual = spatial_discretisation.computations[-1].equations[0]
+    assert residual.rhs.has(residual.lhs)
+    assert [str(a) for a in spatial_discretisation.computations[-1].inputoutput.keys()] == [str(residual.lhs.base)]
+
+    with pytest.raises(ValueError):
+        LowStorageRungeKutta(2)
+    return
+
+
+def test_variable_time_step(mass, grid, spatial_discretisation):
+    """ Ensure that a variable time-step is computed from the maximum wave speed, and used in the update equations. """
+
+    phi = spatial_discretisation.residual_arrays[0].keys()[0].args[0]
+    wave_speeds = [Abs(phi), Abs(phi)]
+    temporal_discretisation = TemporalDiscretisation(RungeKutta(3), grid, False, spatial_discretisation, wave_speeds)
+
+    computation = temporal_discretisation.time_step_computation
+    assert len(computation.reductions) == 1
+    assert computation.reductions[0].reduction_type == "max"
+    assert isinstance(computation.equations[0].rhs, Maximum)
+    assert [str(a) for a in computation.inputs.keys()] == [str(phi.base)]
+
+    # The time-step is passed to the update kernels as a global variable, rather than being a constant.
+    dt = temporal_discretisation.dt
+    assert all(eq.rhs.has(dt) for kernel in temporal_discretisation.computations for eq in kernel.equations)
+    assert dt.base in temporal_discretisation.computations[0].inputs and not dt.base.is_grid
+
+    with pytest.raises(ValueError):
+        TemporalDiscretisation(RungeKutta(3), grid, False, spatial_discretisation)
+    return
+
+
 if __name__ == '__main__':
     pytest.main(os.path.abspath(__file__))
@@ -21,13 +21,14 @@
 import os
 import pytest
 
-from sympy import flatten, IndexedBase
+from sympy import flatten, IndexedBase, Derivative, Symbol, Eq
 
 # OpenSBLI classes and functions
 from opensbli.grid import Grid
 from opensbli.equations import Equation, EinsteinTerm
 from opensbli.problem import Problem
-from opensbli.utils import get_indexed_variables, get_derivatives
+from opensbli.utils import get_indexed_variables, get_derivatives, substitute_work_arrays, canonicalise_derivatives
+from opensbli.evaluations import Evaluations
 
 @pytest.fixture
 def grid():
@@ -106,4 +107,47 @@ def test_get_derivatives(navier_stokes_problem, grid):
     
     assert str(temporal_derivatives) == "[Derivative(rho[x0, x1, t], t), Derivative(rhou0[x0, x1, t], t), Derivative(rhou1[x0, x1, t], t), Derivative(rhoE[x0, x1, t], t)]"
     
-    return 
+    return
+
+
+def test_substitute_work_arrays(grid):
+    """ Ensure that the evaluated Derivatives are replaced by their work arrays, with higher order Derivatives replaced as a whole. """
+
+    x0 = Symbol('x0')
+    u0 = IndexedBase('u0')[x0]
+    first = Derivative(u0, x0)
+    second = Derivative(u0, x0, x0)
+    evaluations = {u0: Evaluations(u0, u0, None, None, u0)}
+    evaluations[first] = Evaluations(first, first, [u0], None, grid.work_array('wk0'))
+    evaluations[second] = Evaluations(second, second, [first], None, grid.work_array('wk1'))
+
+    equations = [Eq(IndexedBase('r')[x0], u0*second + first), Eq(IndexedBase('s')[x0], u0)]
+    updated = substitute_work_arrays([u0, first, second], evaluations, equations)
+    assert updated[0] == Eq(IndexedBase('r')[x0], u0*grid.work_array('wk1') + grid.work_array('wk0'))
+    assert updated[1] == equations[1]
+
+    return
+
+
+def test_canonicalise_derivatives():
+    """ Ensure that the spatial Derivatives which only differ in the order of their variables or by a constant factor are merged,
+    and that the temporal Derivatives are left as they are. """
+
+    x0, x1, t = Symbol('x0'), Symbol('x1'), EinsteinTerm('t')
+    c = Symbol('c')
+    rho, u0, r, s = [IndexedBase(name)[x0, x1] for name in ['rho', 'u0', 'r', 's']]
+    equations = [Eq(Derivative(rho, t), Derivative(u0, x1, x0) - Derivative(-2*c*rho*u0, x0)),
+                 Eq(r, Derivative(u0, x0, x1) + Derivative(rho*u0, x0) + Derivative(x0*u0, x0))]
+
+    canonical, merged = canonicalise_derivatives(equations)
+    assert merged == 2
+    assert canonical[0].lhs == Derivative(rho, t)
+    assert canonical[0].rhs == Derivative(u0, x0, x1) + 2*c*Derivative(rho*u0, x0)
+    # The coordinate that the term is differentiated with respect to is not a constant factor.
+    assert canonical[1].rhs == Derivative(u0, x0, x1) + Derivative(rho*u0, x0) + Derivative(x0*u0, x0)
+    assert set(get_derivatives(canonical)[0]) == set([Derivative(u0, x0, x1), Derivative(rho*u0, x0), Derivative(x0*u0, x0)])
+
+    # Nested Derivatives are made canonical too.
+    nested = canonicalise_derivatives([Eq(s, Derivative(-rho*Derivative(u0, x1, x0), x0))])[0]
+    assert nested[0].rhs == -Derivative(rho*Derivative(u0, x0, x1), x0)
+    return